@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The analysis of analysis_pipeline_full.py run as a DAG of cached stages
+(see modules/module_pipeline_runner.py)
+
+    preprocess -> [ica] -> block_average ---> W_build -> reconstruction -> plotting
+                  head_model ----------------/
+
+Every stage output is cached in derivatives/pipeline_cache. Rerunning the script skips
+the stages whose cfg, code and inputs did not change, so changing e.g. cfg_img_recon only
+reruns W_build, reconstruction and plotting, and a run that crashed resumes from the last
+completed stage. head_model does not depend on the data and runs in parallel with the
+preprocessing when cfg_runner['n_workers'] > 1.
+"""
+
+# %% Imports
+##############################################################################
+
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+from cedalion import units
+
+sys.path.append('/projectnb/nphfnirs/ns/Shannon/Code/cedalion-dab-funcs2/modules')
+import module_pipeline_runner as pfDAB_run
+import module_instrument as pfDAB_inst
+import module_threads as pfDAB_threads
+
+# Turn off all warnings
+import warnings
+warnings.filterwarnings('ignore')
+
+
+# %% Analysis parameters
+##############################################################################
+
+cfg_hrf = {
+    'stim_lst' : ['ST', 'DT'],
+    't_pre' : 5 *units.s,
+    't_post' : 33 *units.s
+    }
+
+cfg_dataset = {
+    'root_dir' : "/projectnb/nphfnirs/ns/Shannon/Data/Interactive_Walking_HD/",
+    'subj_ids' : ['01','02','03','04','05','06','07','08','09','10', '11', '12', '13', '14', '15', '16', '17', '18', '19'],
+    'file_ids' : ['IWHD_run-01'],
+    'subj_id_exclude' : ['10', '15', '16', '17'],
+    'cfg_hrf' : cfg_hrf
+}
+
+cfg_dataset['filenm_lst'] = [
+    [f"sub-{subj_id}_task-{file_id}_nirs" for file_id in cfg_dataset['file_ids']]
+    for subj_id in cfg_dataset['subj_ids']
+    ]
+
+cfg_prune = {
+    'snr_thresh' : 5,
+    'sd_threshs' : [1, 60]*units.mm,
+    'amp_threshs' : [1e-5, 0.84],
+    'perc_time_clean_thresh' : 0.6,
+    'sci_threshold' : 0.6,
+    'psp_threshold' : 0.1,
+    'window_length' : 5 * units.s,
+    'flag_use_sci' : True,
+    'flag_use_psp' : False
+}
+
+cfg_imu_glm = {
+    'statesPerDataFrame' : 89,   # FOR WALKING DATA
+    'hWin' : np.arange(-3,5,1),
+    'n_components' : [3, 2],
+    'ica_reuse' : None,          # None fits the IMU ICA on every file, 'subject' once per subject, 'all' once for all files
+    'ica_random_state' : 0,
+    'ica_fit_subsample' : 1,
+    'butter_order' : 4,
+    'Fc' : 0.1,
+    'plot_flag_imu' : True
+}
+
+cfg_motion_correct = {
+    'flag_do_tddr' : True,
+    'flag_do_imu_glm' : True,
+    'cfg_imu_glm' : cfg_imu_glm,
+}
+
+cfg_bandpass = {
+    'fmin' : 0.01 * units.Hz,
+    'fmax' : 0.5 * units.Hz
+}
+
+cfg_GLM = {
+    'drift_order' : 1,
+    'distance_threshold' : 20 *units.mm,
+    'short_channel_method' : 'mean',
+    'noise_model' : "ols",
+    't_delta' : 1 *units.s ,
+    't_std' : 1 *units.s ,
+    'cfg_hrf' : cfg_hrf
+    }
+
+cfg_dqr = {
+    'mode' : 'background',
+    'n_workers' : 4
+}
+
+cfg_preprocess = {
+    'flag_prune_channels' : False,
+    'median_filt' : 3,
+    'cfg_prune' : cfg_prune,
+    'cfg_motion_correct' : cfg_motion_correct,
+    'cfg_bandpass' : cfg_bandpass,
+    'flag_do_GLM_filter' : True,
+    'cfg_GLM' : cfg_GLM,
+    'cfg_dqr' : cfg_dqr
+}
+
+cfg_ica = {
+    'flag_do_ica' : False,      # adds the ica stage between preprocess and block_average
+    'flag_ICA_use_pruned_data' : False,
+    'ica_lpf' : 1.0 * units.Hz,
+    'ica_downsample' : 1,
+    'cov_amp_thresh' : 1.1e-6,
+    'pca_var_thresh' : 0.99,
+    'flag_do_pca_filter' : True,
+    'flag_calculate_ICA_matrix' : False,
+    'flag_ERBM_vs_EBM' : False,
+    'p_ica' : 27,
+    'flag_do_ica_filter' : True,
+    'ica_spatial_mask_thresh' : 1.0,
+    'ica_tstat_thresh' : 1.0,
+    'trange_hrf' : [5, 35] * units.s,
+    'trange_hrf_stat' : [5, 20],
+    'stim_lst_hrf_ica' : ['STS'],
+}
+
+cfg_mse_conc = {
+    'mse_val_for_bad_data' : 1e7 * units.micromolar**2,
+    'mse_amp_thresh' : 1.1e-6,
+    'mse_min_thresh' : 1e0 * units.micromolar**2,
+    'blockaverage_val' : 0 * units.micromolar
+    }
+
+cfg_mse_od = {
+    'mse_val_for_bad_data' : 1e1,
+    'mse_amp_thresh' : 1.1e-6,
+    'mse_min_thresh' : 1e-6,
+    'blockaverage_val' : 0
+    }
+
+cfg_blockavg = {
+    'rec_str' : 'od_corrected',
+    'flag_prune_channels' : cfg_preprocess['flag_prune_channels'],
+    'cfg_hrf' : cfg_hrf,
+    'trange_hrf_stat' : [10, 20],
+    'flag_save_group_avg_hrf': False,
+    'flag_save_each_subj' : False,
+    'cfg_mse_conc' : cfg_mse_conc,
+    'cfg_mse_od' : cfg_mse_od
+    }
+
+cfg_sb = {
+    'mask_threshold': -2,
+    'threshold_brain': 5*units.mm,
+    'threshold_scalp': 20*units.mm,
+    'sigma_brain': 5*units.mm,
+    'sigma_scalp': 20*units.mm,
+    'lambda1': 0.01,
+    'lambda2': 0.1
+}
+
+cfg_img_recon = {
+    'probe_dir' : "/projectnb/nphfnirs/s/users/lcarlton/DATA/probes/NN22_WHHD/12NN/fw/",
+    'head_model' : 'ICBM152',
+    't_win' : (10, 20),
+    'flag_Cmeas' : True,
+    'BRAIN_ONLY' : False,
+    'DIRECT' : True,
+    'SB' : False,
+    'alpha_meas' : 1e0,
+    'alpha_spatial' : 1e-1,
+    'cfg_sb' : cfg_sb,
+    }
+
+cfg_plot = {
+    'clim' : (-1e-1, 1e-1),
+    'flag_hbx' : 'hbo_brain',
+    'view_position' : 'superior',
+    }
+
+cfg_runner = {
+    'n_workers' : 2,    # head_model runs in parallel with preprocess
+    'n_threads_per_worker' : None,  # BLAS threads per worker, None splits the cores between the workers
+    'force' : [],       # e.g. ['block_average'] to rerun it and everything after it
+    'targets' : None,   # e.g. ['block_average'] to stop there
+    'code_version' : '',    # change it to rerun all stages after an update of cedalion
+    }
+
+cfg_threads = {
+    'n_threads' : None,     # BLAS threads of this process, None uses all cores (see module_threads)
+    'stages' : {},          # e.g. {'W_build' : 16} while a stage runs, capped at the threads of its worker
+    }
+
+cache_dir = os.path.join(cfg_dataset['root_dir'], 'derivatives', 'pipeline_cache')
+
+
+# %% Stages
+##############################################################################
+# module level functions fn(cfg, **inputs). The modules are imported inside the stages so
+# a stage that is skipped does not pay for importing e.g. the image recon dependencies.
+
+def stage_preprocess( cfg ):
+    import module_load_and_preprocess as pfDAB
+
+    rec, chs_pruned_subjs = pfDAB.load_and_preprocess( cfg['cfg_dataset'], cfg['cfg_preprocess'] )
+
+    return rec, chs_pruned_subjs
+
+
+def stage_ica( cfg, rec, chs_pruned_subjs ):
+    import module_ERBM_ICA as pfDAB_ERBM
+
+    c = cfg['cfg_ica']
+    rec = pfDAB_ERBM.ERBM_run_ica( rec, cfg['cfg_dataset']['filenm_lst'], c['flag_ICA_use_pruned_data'], c['ica_lpf'], c['ica_downsample'],
+                                   c['cov_amp_thresh'], chs_pruned_subjs, c['pca_var_thresh'], c['flag_do_pca_filter'],
+                                   c['flag_calculate_ICA_matrix'], c['flag_ERBM_vs_EBM'], c['p_ica'], cfg['cfg_dataset']['root_dir'],
+                                   c['flag_do_ica_filter'], c['ica_spatial_mask_thresh'], c['ica_tstat_thresh'], c['trange_hrf'],
+                                   c['trange_hrf_stat'], c['stim_lst_hrf_ica'] )
+
+    return rec
+
+
+def stage_block_average( cfg, rec, chs_pruned_subjs ):
+    import module_group_avg as pfDAB_grp_avg
+
+    cfg_blockavg = cfg['cfg_blockavg']
+    blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr, blockaverage_subj, blockaverage_mse_subj = \
+        pfDAB_grp_avg.run_group_block_average( rec, cfg_blockavg['rec_str'], chs_pruned_subjs, cfg['cfg_dataset'], cfg_blockavg )
+
+    # if pruning channels there is no weighted average
+    groupavg_results = {'blockaverage' : blockaverage_mean if cfg_blockavg['flag_prune_channels'] else blockaverage_mean_weighted,
+                        'blockaverage_stderr' : blockaverage_stderr,
+                        'blockaverage_subj' : blockaverage_subj,
+                        'blockaverage_mse_subj' : blockaverage_mse_subj,
+                        'geo2d' : rec[0][0].geo2d,
+                        'geo3d' : rec[0][0].geo3d,
+                        'wavelength' : rec[0][0]['amp'].wavelength.values
+                        }
+
+    return groupavg_results
+
+
+def stage_head_model( cfg ):
+    import module_image_recon as pfDAB_img
+
+    Adot, head = pfDAB_img.load_Adot( cfg['probe_dir'], cfg['head_model'] )
+
+    return Adot, head
+
+
+def stage_W_build( cfg, groupavg_results, Adot, head ):
+    import module_image_recon as pfDAB_img
+
+    # D and F only depend on the sensitivity of the kept channels, so they are built once
+    # here and reused for every trial type
+    trial_type = groupavg_results['blockaverage'].trial_type[0]
+    hrf_od_mag, C_meas = _get_hrf_od_mag( groupavg_results, trial_type, cfg )
+    _, W, D, F, G = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, cfg['flag_Cmeas'], C_meas, groupavg_results['wavelength'],
+                                              cfg['BRAIN_ONLY'], cfg['DIRECT'], cfg['SB'], cfg['cfg_sb'],
+                                              cfg['alpha_spatial'], cfg['alpha_meas'], None, None, None )
+
+    return {'D' : D, 'F' : F, 'G' : G}
+
+
+def stage_reconstruction( cfg, groupavg_results, Adot, head, W_results ):
+    import module_image_recon as pfDAB_img
+
+    X_grp_lst = []
+    X_noise_lst = []
+    X_tstat_lst = []
+    for trial_type in groupavg_results['blockaverage'].trial_type:
+        print(f'Getting images for trial type = {trial_type.values}')
+        hrf_od_mag, C_meas = _get_hrf_od_mag( groupavg_results, trial_type, cfg )
+
+        X_grp, W, _, _, _ = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, cfg['flag_Cmeas'], C_meas, groupavg_results['wavelength'],
+                                                      cfg['BRAIN_ONLY'], cfg['DIRECT'], cfg['SB'], cfg['cfg_sb'],
+                                                      cfg['alpha_spatial'], cfg['alpha_meas'], W_results['D'], W_results['F'], W_results['G'] )
+        X_grp_lst.append( X_grp.assign_coords(trial_type = trial_type) )
+
+        if cfg['flag_Cmeas']:
+            X_noise, X_tstat = pfDAB_img.img_noise_tstat( X_grp, W, C_meas )
+            X_noise_lst.append( X_noise.assign_coords(trial_type = trial_type) )
+            X_tstat_lst.append( X_tstat.assign_coords(trial_type = trial_type) )
+
+    results_img_grp = {'X_grp_all_trial' : xr.concat(X_grp_lst, dim='trial_type')}
+    if cfg['flag_Cmeas']:
+        results_img_grp['X_noise_grp_all_trial'] = xr.concat(X_noise_lst, dim='trial_type')
+        results_img_grp['X_tstat_grp_all_trial'] = xr.concat(X_tstat_lst, dim='trial_type')
+
+    return results_img_grp
+
+
+def stage_plotting( cfg, results_img_grp, head ):
+    import pyvista as pv
+    import module_image_recon as pfDAB_img
+
+    plot_dir = os.path.join(cfg['root_dir'], 'derivatives', 'plots', 'image_recon')
+    if not os.path.exists(plot_dir):
+        os.makedirs(plot_dir)
+
+    file_lst = []
+    X_grp_all = results_img_grp['X_grp_all_trial']
+    for trial_type in X_grp_all.trial_type.values:
+        p0 = pv.Plotter(shape=(1,1), window_size = [600, 600], off_screen=True)
+        pfDAB_img.plot_image_recon( X_grp_all.sel(trial_type=trial_type), head, (1,1), (0,0), cfg['clim'], cfg['flag_hbx'],
+                                    cfg['view_position'], p0, f'{trial_type} {cfg["flag_hbx"]}' )
+        file_path = os.path.join(plot_dir, f'X_grp_{trial_type}_{cfg["flag_hbx"]}_{cfg["view_position"]}.png')
+        p0.screenshot( file_path )
+        p0.close()
+        file_lst.append( file_path )
+
+    return file_lst
+
+
+def _get_hrf_od_mag( groupavg_results, trial_type, cfg ):
+    # HRF magnitude in OD over t_win and, with flag_Cmeas, its variance as the measurement covariance
+    import module_measurement as pfDAB_meas
+
+    blockaverage = groupavg_results['blockaverage'].sel(trial_type=trial_type)
+    hrf_od_mag = blockaverage.sel(reltime=slice(cfg['t_win'][0], cfg['t_win'][1])).mean('reltime')
+
+    if not cfg['flag_Cmeas']:
+        return hrf_od_mag, None
+
+    C_meas = groupavg_results['blockaverage_stderr'].sel(trial_type=trial_type).sel(reltime=slice(cfg['t_win'][0], cfg['t_win'][1])).mean('reltime')
+    C_meas = C_meas.pint.dequantify()**2
+    C_meas = pfDAB_meas.stack_measurement(C_meas)
+
+    return hrf_od_mag, C_meas
+
+
+# %% Build the DAG
+##############################################################################
+
+stages = [
+    {'name' : 'preprocess', 'fn' : stage_preprocess, 'inputs' : [], 'outputs' : ['rec', 'chs_pruned_subjs'],
+     'cfg' : {'cfg_dataset' : cfg_dataset, 'cfg_preprocess' : cfg_preprocess}},
+    {'name' : 'block_average', 'fn' : stage_block_average, 'inputs' : ['rec_ica' if cfg_ica['flag_do_ica'] else 'rec', 'chs_pruned_subjs'],
+     'outputs' : ['groupavg_results'], 'cfg' : {'cfg_dataset' : cfg_dataset, 'cfg_blockavg' : cfg_blockavg}},
+    {'name' : 'head_model', 'fn' : stage_head_model, 'inputs' : [], 'outputs' : ['Adot', 'head'],
+     'cfg' : {'probe_dir' : cfg_img_recon['probe_dir'], 'head_model' : cfg_img_recon['head_model']}},
+    {'name' : 'W_build', 'fn' : stage_W_build, 'inputs' : ['groupavg_results', 'Adot', 'head'], 'outputs' : ['W_results'],
+     'cfg' : cfg_img_recon},
+    {'name' : 'reconstruction', 'fn' : stage_reconstruction, 'inputs' : ['groupavg_results', 'Adot', 'head', 'W_results'],
+     'outputs' : ['results_img_grp'], 'cfg' : cfg_img_recon},
+    {'name' : 'plotting', 'fn' : stage_plotting, 'inputs' : ['results_img_grp', 'head'], 'outputs' : ['plot_files'],
+     'cfg' : {**cfg_plot, 'root_dir' : cfg_dataset['root_dir']}},
+    ]
+
+if cfg_ica['flag_do_ica']:
+    stages.append( {'name' : 'ica', 'fn' : stage_ica, 'inputs' : ['rec', 'chs_pruned_subjs'], 'outputs' : ['rec_ica'],
+                    'cfg' : {'cfg_dataset' : cfg_dataset, 'cfg_ica' : cfg_ica}} )
+
+stage_status = pfDAB_run.get_pipeline_status( stages, cache_dir, cfg_runner )
+
+
+# %% Run the stages that are not up to date
+##############################################################################
+
+pfDAB_threads.configure( cfg_threads )
+pfDAB_inst.start_trace()
+
+status = pfDAB_run.run_pipeline( stages, cache_dir, cfg_runner )
+
+pfDAB_inst.stop_trace( os.path.join(cfg_dataset['root_dir'], 'derivatives', 'trace', f'trace_dag_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json') )
+
+
+# %% Load the results
+##############################################################################
+
+groupavg_results = pfDAB_run.load_output( cache_dir, 'groupavg_results' )
+results_img_grp = pfDAB_run.load_output( cache_dir, 'results_img_grp' )
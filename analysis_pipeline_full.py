@@ -28,6 +28,7 @@ from math import ceil
 import gzip
 import pickle
 import json
+from datetime import datetime
 
 
 # import my own functions from a different directory
@@ -40,6 +41,9 @@ import module_group_avg as pfDAB_grp_avg
 import module_ERBM_ICA as pfDAB_ERBM
 import module_image_recon as pfDAB_img
 import module_spatial_basis_funs_ced as sbf 
+import module_instrument as pfDAB_inst
+import module_threads as pfDAB_threads
+import module_measurement as pfDAB_meas
 
 
 # Turn off all warnings
@@ -98,6 +102,9 @@ cfg_imu_glm = {'statesPerDataFrame' : 89,   # FOR WALKING DATA
 		'hWin' : np.arange(-3,5,1), # window for impulse response function 
 		'statesPerDataFrame' : 89,
 		'n_components' : [3, 2],  # [gyro, accel]       # !!! note: changing this will change fig sizes - add that in?
+        'ica_reuse' : None,   # None fits the IMU ICA on every file, 'subject' once per subject, 'all' once for all files
+        'ica_random_state' : 0,   # seed of the IMU ICA
+        'ica_fit_subsample' : 1,   # fit the IMU ICA on every n-th sample
         'butter_order' : 4,   # butterworth filter order
         'Fc' : 0.1,   # cutoff freq (Hz)
         'plot_flag_imu' : True  
@@ -129,6 +136,11 @@ cfg_GLM = {
     }           
 
 
+cfg_dqr = {
+    'mode' : 'background',  # 'inline' = plot in the preprocessing loop, 'background' = plot in worker processes, 'metrics_only' = only save the DQR metrics
+    'n_workers' : 4
+}
+
 cfg_preprocess = {
     'flag_prune_channels' : False,  # FALSE = does not prune chans and does weighted averaging, TRUE = prunes channels and no weighted averaging
     'median_filt' : 3, # set to 1 if you don't want to do median filtering
@@ -136,7 +148,8 @@ cfg_preprocess = {
     'cfg_motion_correct' : cfg_motion_correct,
     'cfg_bandpass' : cfg_bandpass,
     'flag_do_GLM_filter' : True,
-    'cfg_GLM' : cfg_GLM 
+    'cfg_GLM' : cfg_GLM,
+    'cfg_dqr' : cfg_dqr
 }
 
 
@@ -170,8 +183,18 @@ cfg_blockavg = {
 
 cfg_erbmICA = {}
 
+cfg_threads = {
+    'n_threads' : None,     # BLAS threads of this process, None uses all cores (see module_threads)
+    'stages' : {},          # e.g. {'image_recon' : 8}
+    }
+
 save_path = os.path.join(cfg_dataset['root_dir'], 'derivatives', 'processed_data')
 
+pfDAB_threads.configure( cfg_threads )
+
+# record wall time, CPU time and peak RSS of every stage (see module_instrument)
+pfDAB_inst.start_trace()
+
 flag_load_preprocessed_data = True  
 flag_save_preprocessed_data = False   # SAVE or no save
 
@@ -303,7 +326,8 @@ flag_ERBM_vs_EBM = False # if True, use ERBM, otherwise use EBM
 
 
 # FIXME: I want to verify that this properly scales back the NOT pruned data to channel space
-rec = pfDAB_ERBM.ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsample, cov_amp_thresh, chs_pruned_subjs, pca_var_thresh, flag_do_pca_filter, flag_calculate_ICA_matrix, flag_ERBM_vs_EBM, p_ica, rootDir_data, flag_do_ica_filter, ica_spatial_mask_thresh, ica_tstat_thresh, trange_hrf, trange_hrf_stat, stim_lst_hrf_ica )
+with pfDAB_threads.stage('ica'):
+    rec = pfDAB_ERBM.ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsample, cov_amp_thresh, chs_pruned_subjs, pca_var_thresh, flag_do_pca_filter, flag_calculate_ICA_matrix, flag_ERBM_vs_EBM, p_ica, rootDir_data, flag_do_ica_filter, ica_spatial_mask_thresh, ica_tstat_thresh, trange_hrf, trange_hrf_stat, stim_lst_hrf_ica )
 
 
 # FIXME: should not be needed here... shouldbe handled in ICA step above
@@ -424,79 +448,80 @@ Adot, head = pfDAB_img.load_Adot( cfg_img_recon['probe_dir'], cfg_img_recon['hea
 #
 all_trial_X_grp = None
 
-for idx, trial_type in enumerate(blockaverage_all.trial_type):  #enumerate([blockaverage_all.trial_type.values[2]]):
+with pfDAB_threads.stage('image_recon'):
+    for idx, trial_type in enumerate(blockaverage_all.trial_type):  #enumerate([blockaverage_all.trial_type.values[2]]):
     
-    print(f'Getting images for trial type = {trial_type.values}')
+        print(f'Getting images for trial type = {trial_type.values}')
     
-    if 'chromo' in blockaverage_all.dims:
-        # get the group average HRF over a time window
-        hrf_conc_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
-        hrf_conc_ts = blockaverage_all.sel(trial_type=trial_type)
+        if 'chromo' in blockaverage_all.dims:
+            # get the group average HRF over a time window
+            hrf_conc_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
+            hrf_conc_ts = blockaverage_all.sel(trial_type=trial_type)
         
-        blockaverage_stderr_conc = blockaverage_stderr.sel(trial_type=trial_type) # need to convert blockaverage_stderr to od if its in conc
+            blockaverage_stderr_conc = blockaverage_stderr.sel(trial_type=trial_type) # need to convert blockaverage_stderr to od if its in conc
     
-        # convert back to OD
-        E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
-        hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
-        hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+            # convert back to OD
+            E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
+            hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+            hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
         
-        blockaverage_stderr = xr.dot(E, blockaverage_stderr_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+            blockaverage_stderr = xr.dot(E, blockaverage_stderr_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
             
-    else:
-        hrf_od_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
-        hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
+        else:
+            hrf_od_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
+            hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
     
-    if not cfg_img_recon['flag_Cmeas']:  
-        cov_str = '' # for name
-        X_grp, W, C, D = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, None, wavelength, cfg_img_recon, trial_type, save_path)
+        if not cfg_img_recon['flag_Cmeas']:  
+            cov_str = '' # for name
+            X_grp, W, C, D = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, None, wavelength, cfg_img_recon, trial_type, save_path)
     
-    else:
-        cov_str = 'cov'
+        else:
+            cov_str = 'cov'
        
-        C_meas = blockaverage_stderr.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
-        C_meas = C_meas.pint.dequantify()     # remove units
-        C_meas = C_meas**2  # get variance
-        C_meas = C_meas.stack(measurement=('channel', 'wavelength')).sortby('wavelength')  
-        X_grp, W, C, D = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, C_meas, wavelength, cfg_img_recon, trial_type, save_path)
+            C_meas = blockaverage_stderr.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
+            C_meas = C_meas.pint.dequantify()     # remove units
+            C_meas = C_meas**2  # get variance
+            C_meas = pfDAB_meas.stack_measurement(C_meas)  
+            X_grp, W, C, D = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, C_meas, wavelength, cfg_img_recon, trial_type, save_path)
     
-    print(f'Done with Image Reconstruction for trial type = {trial_type.values}')
+        print(f'Done with Image Reconstruction for trial type = {trial_type.values}')
   
-    X_grp = X_grp.assign_coords(trial_type = trial_type)
+        X_grp = X_grp.assign_coords(trial_type = trial_type)
     
-    #
-    #  Calculate the image noise and image CNR
-    #
-    if cfg_img_recon['flag_Cmeas']:
-        X_noise, X_tstat = pfDAB_img.img_noise_tstat(X_grp, W, C_meas)
+        #
+        #  Calculate the image noise and image CNR
+        #
+        if cfg_img_recon['flag_Cmeas']:
+            X_noise, X_tstat = pfDAB_img.img_noise_tstat(X_grp, W, C_meas)
         
-        if cfg_img_recon['flag_save_img_results']:
-            pfDAB_img.save_image_results(X_noise, 'X_noise', save_path, trial_type, cfg_img_recon)
-            pfDAB_img.save_image_results(X_tstat, 'X_tstat', save_path, trial_type, cfg_img_recon)
+            if cfg_img_recon['flag_save_img_results']:
+                pfDAB_img.save_image_results(X_noise, 'X_noise', save_path, trial_type, cfg_img_recon)
+                pfDAB_img.save_image_results(X_tstat, 'X_tstat', save_path, trial_type, cfg_img_recon)
         
-        X_noise = X_noise.assign_coords(trial_type = trial_type)
-        X_tstat = X_tstat.assign_coords(trial_type = trial_type)
+            X_noise = X_noise.assign_coords(trial_type = trial_type)
+            X_tstat = X_tstat.assign_coords(trial_type = trial_type)
         
-        # save results for all trial types
-        if all_trial_X_grp is None:
-            all_trial_X_grp = X_grp
-            all_trial_X_noise = X_noise  # comes from diag of covariance matrix
-            all_trial_X_tstat = X_tstat 
-        else:
-            all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
-            all_trial_X_noise = xr.concat([all_trial_X_noise, X_noise], dim='trial_type')
-            all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
+            # save results for all trial types
+            if all_trial_X_grp is None:
+                all_trial_X_grp = X_grp
+                all_trial_X_noise = X_noise  # comes from diag of covariance matrix
+                all_trial_X_tstat = X_tstat 
+            else:
+                all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
+                all_trial_X_noise = xr.concat([all_trial_X_noise, X_noise], dim='trial_type')
+                all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
             
-        results_img_grp = {'X_grp_all_trial': all_trial_X_grp,
-                   'X_noise_grp_all_trial': all_trial_X_noise,
-                   'X_tstat_grp_all_trial': all_trial_X_tstat
-                   }
+            results_img_grp = {'X_grp_all_trial': all_trial_X_grp,
+                       'X_noise_grp_all_trial': all_trial_X_noise,
+                       'X_tstat_grp_all_trial': all_trial_X_tstat
+                       }
     
-    # if flag_Cmeas is false, can't calc tstat and noise
-    else:
-        if all_trial_X_grp is None:
-            all_trial_X_grp = X_grp
+        # if flag_Cmeas is false, can't calc tstat and noise
         else:
-            all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
+            if all_trial_X_grp is None:
+                all_trial_X_grp = X_grp
+            else:
+                all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
     
 tasknm = cfg_dataset["file_ids"][0].split('_')[0] # get task name
 
@@ -529,157 +554,157 @@ D = None
 
 all_trial_X_hrf_mag = None
 
-for idx_trial, trial_type in enumerate(blockaverage_subj.trial_type):
+with pfDAB_threads.stage('image_recon'):
+    for idx_trial, trial_type in enumerate(blockaverage_subj.trial_type):
     
-    print(f'Getting images for trial type = {trial_type.values}')
-    all_subj_X_hrf_mag = None
+        print(f'Getting images for trial type = {trial_type.values}')
+        all_subj_X_hrf_mag = None
     
-    for idx_subj, curr_subj in enumerate(cfg_dataset['subj_ids']):
+        for idx_subj, curr_subj in enumerate(cfg_dataset['subj_ids']):
 
-        print(f'Starting image recon on subject {curr_subj}')
+            print(f'Starting image recon on subject {curr_subj}')
         
-        # Check if rec_str exists for current subject
-        if curr_subj in cfg_dataset['subj_id_exclude']:
-            print(f'   Subject {cfg_dataset["subj_ids"][idx_subj]} excluded from group average')
-            continue  # if subject is excluded, skip this loop
+            # Check if rec_str exists for current subject
+            if curr_subj in cfg_dataset['subj_id_exclude']:
+                print(f'   Subject {cfg_dataset["subj_ids"][idx_subj]} excluded from group average')
+                continue  # if subject is excluded, skip this loop
         
-        if 'chromo' in blockaverage_subj.dims:
-            # get the group average HRF over a time window
-            hrf_conc_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
-            hrf_conc_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
+            if 'chromo' in blockaverage_subj.dims:
+                # get the group average HRF over a time window
+                hrf_conc_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
+                hrf_conc_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
             
-            blockaverage_mse_subj_conc = blockaverage_mse_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
+                blockaverage_mse_subj_conc = blockaverage_mse_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
             
-            # convert back to OD
-            E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
-            hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # !!! assumes DPF = 1
-            hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                # convert back to OD
+                E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
+                hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # !!! assumes DPF = 1
+                hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
                 
-            blockaverage_mse_subj= xr.dot(E, blockaverage_mse_subj_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                blockaverage_mse_subj= xr.dot(E, blockaverage_mse_subj_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
 
-        else:
-            hrf_od_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
-            hrf_od_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
+            else:
+                hrf_od_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
+                hrf_od_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
 
-        #
-        #hrf_od_mag = blockaverage_subj.sel(subj=cfg_dataset['subj_ids'][idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
-        # hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
+            #
+            #hrf_od_mag = blockaverage_subj.sel(subj=cfg_dataset['subj_ids'][idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
+            # hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
     
-        # get the image
+            # get the image
         
-        C_meas = blockaverage_mse_subj.sel(subj=cfg_dataset['subj_ids'][idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
+            C_meas = blockaverage_mse_subj.sel(subj=cfg_dataset['subj_ids'][idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
     
-        C_meas = C_meas.pint.dequantify()
-        C_meas = C_meas.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
+            C_meas = C_meas.pint.dequantify()
+            C_meas = pfDAB_meas.stack_measurement(C_meas)
         
-        if cfg_img_recon['flag_Cmeas']:
-            cov_str = 'cov'
-            if C is None or D is None:
-                #X_hrf_mag_tmp, W, C, D = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, C_meas, wavelength, BRAIN_ONLY, SB, sb_cfg, alpha_spatial_list, alpha_meas_list, file_save, file_path0, trial_type) 
-                X_hrf_mag_tmp, W, C, D = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas,
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path,
-                                                                  W = None, C = None, D = None) 
+            if cfg_img_recon['flag_Cmeas']:
+                cov_str = 'cov'
+                if C is None or D is None:
+                    #X_hrf_mag_tmp, W, C, D = pfDAB_img.do_image_recon( hrf_od_mag, head, Adot, C_meas, wavelength, BRAIN_ONLY, SB, sb_cfg, alpha_spatial_list, alpha_meas_list, file_save, file_path0, trial_type) 
+                    X_hrf_mag_tmp, W, C, D = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas,
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path,
+                                                                      W = None, C = None, D = None) 
         
+                else:
+                    X_hrf_mag_tmp, W, _, _ = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas, 
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path, 
+                                                                      W = None, C = C, D = D)
             else:
-                X_hrf_mag_tmp, W, _, _ = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas, 
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path, 
-                                                                  W = None, C = C, D = D)
-        else:
-            cov_str = ''
-            if C is None or D is None:
-                X_hrf_mag_tmp, W, C, D = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None,
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path,
-                                                                  W = None, C = None, D = None) 
+                cov_str = ''
+                if C is None or D is None:
+                    X_hrf_mag_tmp, W, C, D = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None,
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path,
+                                                                      W = None, C = None, D = None) 
         
-            else:
-                X_hrf_mag_tmp, W, _, _ = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None, 
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path, 
-                                                                  W = None, C = C, D = D)
+                else:
+                    X_hrf_mag_tmp, W, _, _ = pfDAB_img.do_image_recon( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None, 
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path, 
+                                                                      W = None, C = C, D = D)
         
 
-        # get image noise
-        cov_img_tmp = W * np.sqrt(C_meas.values) # get diag of image covariance
-        cov_img_diag = np.nansum(cov_img_tmp**2, axis=1)
+            # get image noise
+            cov_img_diag = pfDAB_img.get_image_variance(W, C_meas) # get diag of image covariance
     
-        nV = X_hrf_mag_tmp.vertex.size
-        cov_img_diag = np.reshape( cov_img_diag, (2,nV) ).T
+            nV = X_hrf_mag_tmp.vertex.size
+            cov_img_diag = np.reshape( cov_img_diag, (2,nV) ).T
     
-        X_mse = X_hrf_mag_tmp.copy() 
-        X_mse.values = cov_img_diag # !!! SAVE nult trial types
+            X_mse = X_hrf_mag_tmp.copy() 
+            X_mse.values = cov_img_diag # !!! SAVE nult trial types
         
         
-        # weighted average -- same as chan space - but now is vertex space
-        if all_subj_X_hrf_mag is None:
-            all_subj_X_hrf_mag = X_hrf_mag_tmp
-            all_subj_X_hrf_mag = all_subj_X_hrf_mag.expand_dims('subj')
-            all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
+            # weighted average -- same as chan space - but now is vertex space
+            if all_subj_X_hrf_mag is None:
+                all_subj_X_hrf_mag = X_hrf_mag_tmp
+                all_subj_X_hrf_mag = all_subj_X_hrf_mag.expand_dims('subj')
+                all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
     
-            X_mse_subj = X_mse.copy()
-            X_mse_subj = X_mse_subj.expand_dims('subj')
-            X_mse_subj = X_mse_subj.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
+                X_mse_subj = X_mse.copy()
+                X_mse_subj = X_mse_subj.expand_dims('subj')
+                X_mse_subj = X_mse_subj.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
             
-            X_hrf_mag_weighted = X_hrf_mag_tmp / X_mse
-            X_mse_inv_weighted = 1 / X_mse
-            X_mse_inv_weighted_max = 1 / X_mse
-        elif cfg_dataset['subj_ids'][idx_subj] not in cfg_dataset['subj_id_exclude']:
-            X_hrf_mag_subj_tmp = X_hrf_mag_tmp.expand_dims('subj') # !!! will need to expand dims to get back trial type -- can do in function 
-            X_hrf_mag_subj_tmp = X_hrf_mag_subj_tmp.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
+                X_hrf_mag_weighted = X_hrf_mag_tmp / X_mse
+                X_mse_inv_weighted = 1 / X_mse
+                X_mse_inv_weighted_max = 1 / X_mse
+            elif cfg_dataset['subj_ids'][idx_subj] not in cfg_dataset['subj_id_exclude']:
+                X_hrf_mag_subj_tmp = X_hrf_mag_tmp.expand_dims('subj') # !!! will need to expand dims to get back trial type -- can do in function 
+                X_hrf_mag_subj_tmp = X_hrf_mag_subj_tmp.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
     
-            X_mse_subj_tmp = X_mse.copy().expand_dims('subj')
-            X_mse_subj_tmp = X_mse_subj_tmp.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
+                X_mse_subj_tmp = X_mse.copy().expand_dims('subj')
+                X_mse_subj_tmp = X_mse_subj_tmp.assign_coords(subj=[cfg_dataset['subj_ids'][idx_subj]])
     
-            all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_subj_tmp], dim='subj')
-            X_mse_subj = xr.concat([X_mse_subj, X_mse_subj_tmp], dim='subj')
+                all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_subj_tmp], dim='subj')
+                X_mse_subj = xr.concat([X_mse_subj, X_mse_subj_tmp], dim='subj')
     
-            X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
-            X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse
-            X_mse_inv_weighted_max = np.maximum(X_mse_inv_weighted_max, 1 / X_mse)
-        else:
-            print(f"   Subject {cfg_dataset['subj_ids'][idx_subj]} excluded from group average")
+                X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
+                X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse
+                X_mse_inv_weighted_max = np.maximum(X_mse_inv_weighted_max, 1 / X_mse)
+            else:
+                print(f"   Subject {cfg_dataset['subj_ids'][idx_subj]} excluded from group average")
             
     
-    # END OF SUBJECT LOOP
+        # END OF SUBJECT LOOP
     
-    # get the average
-    X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
-    X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
+        # get the average
+        X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
+        X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
     
-    X_mse_mean_within_subject = 1 / X_mse_inv_weighted
+        X_mse_mean_within_subject = 1 / X_mse_inv_weighted
     
-    X_mse_subj_tmp = X_mse_subj.copy()
-    X_mse_subj_tmp = xr.where(X_mse_subj_tmp < 1e-6, 1e-6, X_mse_subj_tmp)
-    X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects / (X_mse_subj**-1).mean('subj')
+        X_mse_subj_tmp = X_mse_subj.copy()
+        X_mse_subj_tmp = xr.where(X_mse_subj_tmp < 1e-6, 1e-6, X_mse_subj_tmp)
+        X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects / (X_mse_subj**-1).mean('subj')
     
-    X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
+        X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
     
-    X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
+        X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
     
-    X_weight_sum = X_mse_inv_weighted / X_mse_inv_weighted_max  # tstat = weighted group avg / noise # !!! not saving?
+        X_weight_sum = X_mse_inv_weighted / X_mse_inv_weighted_max  # tstat = weighted group avg / noise # !!! not saving?
     
-    # Assign trial type coord
-    X_hrf_mag_mean = X_hrf_mag_mean.assign_coords(trial_type = trial_type)
-    X_hrf_mag_mean_weighted = X_hrf_mag_mean_weighted.assign_coords(trial_type = trial_type)
-    X_stderr_weighted = X_stderr_weighted.assign_coords(trial_type = trial_type)
-    X_tstat = X_tstat.assign_coords(trial_type = trial_type)
+        # Assign trial type coord
+        X_hrf_mag_mean = X_hrf_mag_mean.assign_coords(trial_type = trial_type)
+        X_hrf_mag_mean_weighted = X_hrf_mag_mean_weighted.assign_coords(trial_type = trial_type)
+        X_stderr_weighted = X_stderr_weighted.assign_coords(trial_type = trial_type)
+        X_tstat = X_tstat.assign_coords(trial_type = trial_type)
 
-    if all_trial_X_hrf_mag is None:
+        if all_trial_X_hrf_mag is None:
         
-        all_trial_X_hrf_mag = X_hrf_mag_mean
-        all_trial_X_hrf_mag_weighted = X_hrf_mag_mean_weighted
-        all_trial_X_stderr = X_stderr_weighted # noise
-        all_trial_X_tstat = X_tstat # tstat
-    else:
+            all_trial_X_hrf_mag = X_hrf_mag_mean
+            all_trial_X_hrf_mag_weighted = X_hrf_mag_mean_weighted
+            all_trial_X_stderr = X_stderr_weighted # noise
+            all_trial_X_tstat = X_tstat # tstat
+        else:
     
-        all_trial_X_hrf_mag = xr.concat([all_trial_X_hrf_mag, X_hrf_mag_mean], dim='trial_type')
-        all_trial_X_hrf_mag_weighted = xr.concat([all_trial_X_hrf_mag_weighted, X_hrf_mag_mean_weighted], dim='trial_type')
-        all_trial_X_stderr = xr.concat([all_trial_X_stderr, X_stderr_weighted], dim='trial_type')
-        all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
+            all_trial_X_hrf_mag = xr.concat([all_trial_X_hrf_mag, X_hrf_mag_mean], dim='trial_type')
+            all_trial_X_hrf_mag_weighted = xr.concat([all_trial_X_hrf_mag_weighted, X_hrf_mag_mean_weighted], dim='trial_type')
+            all_trial_X_stderr = xr.concat([all_trial_X_stderr, X_stderr_weighted], dim='trial_type')
+            all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
 
 # END OF TRIAL TYPE LOOP
 
@@ -992,6 +1017,12 @@ else:
 
 
 
+# %% Write the instrumentation trace
+##############################################################################
+# open in chrome://tracing, https://ui.perfetto.dev or https://www.speedscope.app
+
+pfDAB_inst.stop_trace( os.path.join(cfg_dataset['root_dir'], 'derivatives', 'trace', f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json") )
+
 # %%
 
 '''
@@ -1071,7 +1102,7 @@ X_foo[np.isin(X_foo['parcel'].values, np.unique(Xo_parcel_2['parcel'].values) ),
 
 
 
-od_ts = hrf_od_ts.stack(measurement=('channel', 'wavelength')).sortby('wavelength').T
+od_ts = pfDAB_meas.stack_measurement(hrf_od_ts).T
 X_grp_ts = W @ od_ts.values
 
 split = len(X_grp_ts)//2
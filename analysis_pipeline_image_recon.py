@@ -20,6 +20,7 @@ from math import ceil
 import gzip
 import pickle
 import json
+from datetime import datetime
 
 
 # import my own functions from a different directory
@@ -28,6 +29,9 @@ import sys
 sys.path.append('/projectnb/nphfnirs/ns/Shannon/Code/cedalion-dab-funcs2/modules')
 import module_image_recon as img_recon 
 import module_spatial_basis_funs_ced as sbf 
+import module_instrument as pfDAB_inst
+import module_threads as pfDAB_threads
+import module_measurement as pfDAB_meas
 
 
 # Turn off all warnings
@@ -81,8 +85,18 @@ cfg_img_recon = {
 
 mse_min_thresh = 1e-3 
 
+cfg_threads = {
+    'n_threads' : None,     # BLAS threads of this process, None uses all cores (see module_threads)
+    'stages' : {},          # e.g. {'image_recon' : 8}
+    }
+
 save_path = os.path.join(cfg_dataset['root_dir'], 'derivatives', 'processed_data')
 
+pfDAB_threads.configure( cfg_threads )
+
+# record wall time, CPU time and peak RSS of every stage (see module_instrument)
+pfDAB_inst.start_trace()
+
 
 #%% Load Saved data
 
@@ -122,91 +136,92 @@ blockaverage_all = blockaverage_mean.copy()
 wavelength = blockaverage_all.wavelength.values   
 Adot, head = img_recon.load_Adot( cfg_img_recon['probe_dir'], cfg_img_recon['head_model'])
 
-if cfg_img_recon['img_recon_on_group']:
+with pfDAB_threads.stage('image_recon'):
+    if cfg_img_recon['img_recon_on_group']:
     
-    all_trial_X_grp = None
+        all_trial_X_grp = None
     
-    for idx, trial_type in enumerate(blockaverage_all.trial_type):  #enumerate([blockaverage_all.trial_type.values[2]]):
+        for idx, trial_type in enumerate(blockaverage_all.trial_type):  #enumerate([blockaverage_all.trial_type.values[2]]):
         
-        print(f'Getting images for trial type = {trial_type.values}')
+            print(f'Getting images for trial type = {trial_type.values}')
         
-        if 'chromo' in blockaverage_all.dims:
-            # get the group average HRF over a time window
-            hrf_conc_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
-            hrf_conc_ts = blockaverage_all.sel(trial_type=trial_type)
+            if 'chromo' in blockaverage_all.dims:
+                # get the group average HRF over a time window
+                hrf_conc_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
+                hrf_conc_ts = blockaverage_all.sel(trial_type=trial_type)
             
-            blockaverage_stderr_conc = blockaverage_stderr.sel(trial_type=trial_type) # need to convert blockaverage_stderr to od if its in conc
+                blockaverage_stderr_conc = blockaverage_stderr.sel(trial_type=trial_type) # need to convert blockaverage_stderr to od if its in conc
         
-            # convert back to OD
-            E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
-            hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
-            hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                # convert back to OD
+                E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
+                hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
             
-            blockaverage_stderr = xr.dot(E, blockaverage_stderr_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                blockaverage_stderr = xr.dot(E, blockaverage_stderr_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
                 
-        else:
-            hrf_od_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
-            hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
+            else:
+                hrf_od_mag = blockaverage_all.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
+                hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
         
-        if not cfg_img_recon['flag_Cmeas']:  
-            cov_str = '' # for name
-            X_grp, W, C, D = img_recon.do_image_recon_DB( hrf_od_mag, head, Adot, None, wavelength, cfg_img_recon, trial_type, save_path)
+            if not cfg_img_recon['flag_Cmeas']:  
+                cov_str = '' # for name
+                X_grp, W, C, D = img_recon.do_image_recon_DB( hrf_od_mag, head, Adot, None, wavelength, cfg_img_recon, trial_type, save_path)
         
-        else:
-            cov_str = 'cov'
+            else:
+                cov_str = 'cov'
            
-            C_meas = blockaverage_stderr.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
-            C_meas = C_meas.pint.dequantify()     # remove units
-            C_meas = C_meas**2  # get variance
-            C_meas = C_meas.stack(measurement=('channel', 'wavelength')).sortby('wavelength')  
-            X_grp, W, C, D = img_recon.do_image_recon_DB( hrf_od_mag, head, Adot, C_meas, wavelength, cfg_img_recon, trial_type, save_path)
+                C_meas = blockaverage_stderr.sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
+                C_meas = C_meas.pint.dequantify()     # remove units
+                C_meas = C_meas**2  # get variance
+                C_meas = pfDAB_meas.stack_measurement(C_meas)  
+                X_grp, W, C, D = img_recon.do_image_recon_DB( hrf_od_mag, head, Adot, C_meas, wavelength, cfg_img_recon, trial_type, save_path)
         
-        print(f'Done with Image Reconstruction for trial type = {trial_type.values}')
+            print(f'Done with Image Reconstruction for trial type = {trial_type.values}')
       
-        X_grp = X_grp.assign_coords(trial_type = trial_type)
+            X_grp = X_grp.assign_coords(trial_type = trial_type)
         
-        #
-        #  Calculate the image noise and image CNR
-        #
-        if cfg_img_recon['flag_Cmeas']:
-            X_noise, X_tstat = img_recon.img_noise_tstat(X_grp, W, C_meas)
+            #
+            #  Calculate the image noise and image CNR
+            #
+            if cfg_img_recon['flag_Cmeas']:
+                X_noise, X_tstat = img_recon.img_noise_tstat(X_grp, W, C_meas)
             
-            if cfg_img_recon['flag_save_img_results']:
-                img_recon.save_image_results(X_noise, 'X_noise', save_path, trial_type, cfg_img_recon)
-                img_recon.save_image_results(X_tstat, 'X_tstat', save_path, trial_type, cfg_img_recon)
+                if cfg_img_recon['flag_save_img_results']:
+                    img_recon.save_image_results(X_noise, 'X_noise', save_path, trial_type, cfg_img_recon)
+                    img_recon.save_image_results(X_tstat, 'X_tstat', save_path, trial_type, cfg_img_recon)
             
-            X_noise = X_noise.assign_coords(trial_type = trial_type)
-            X_tstat = X_tstat.assign_coords(trial_type = trial_type)
+                X_noise = X_noise.assign_coords(trial_type = trial_type)
+                X_tstat = X_tstat.assign_coords(trial_type = trial_type)
             
-            # save results for all trial types
-            if all_trial_X_grp is None:
-                all_trial_X_grp = X_grp
-                all_trial_X_noise = X_noise  # comes from diag of covariance matrix
-                all_trial_X_tstat = X_tstat 
-            else:
-                all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
-                all_trial_X_noise = xr.concat([all_trial_X_noise, X_noise], dim='trial_type')
-                all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
+                # save results for all trial types
+                if all_trial_X_grp is None:
+                    all_trial_X_grp = X_grp
+                    all_trial_X_noise = X_noise  # comes from diag of covariance matrix
+                    all_trial_X_tstat = X_tstat 
+                else:
+                    all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
+                    all_trial_X_noise = xr.concat([all_trial_X_noise, X_noise], dim='trial_type')
+                    all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
                 
-            results_img_grp = {'X_grp_all_trial': all_trial_X_grp,
-                       'X_noise_grp_all_trial': all_trial_X_noise,
-                       'X_tstat_grp_all_trial': all_trial_X_tstat
-                       }
+                results_img_grp = {'X_grp_all_trial': all_trial_X_grp,
+                           'X_noise_grp_all_trial': all_trial_X_noise,
+                           'X_tstat_grp_all_trial': all_trial_X_tstat
+                           }
         
-        # if flag_Cmeas is false, can't calc tstat and noise
-        else:
-            if all_trial_X_grp is None:
-                all_trial_X_grp = X_grp
+            # if flag_Cmeas is false, can't calc tstat and noise
             else:
-                all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
+                if all_trial_X_grp is None:
+                    all_trial_X_grp = X_grp
+                else:
+                    all_trial_X_grp = xr.concat([all_trial_X_grp, X_grp], dim='trial_type')
         
-    tasknm = cfg_dataset["file_ids"][0].split('_')[0] # get task name
+        tasknm = cfg_dataset["file_ids"][0].split('_')[0] # get task name
     
-    filepath = os.path.join(cfg_dataset['root_dir'], f'X_{tasknm}_alltrials_{cov_str}_alpha_spatial_{cfg_img_recon["alpha_spatial_list"][-1]:.0e}_alpha_meas_{cfg_img_recon["alpha_meas_list"][-1]:.0e}.pkl.gz')
-    print(f'   Saving to X_{tasknm}_alltrials_{cov_str}_alpha_spatial_{cfg_img_recon["alpha_spatial_list"][-1]:.0e}_alpha_meas_{cfg_img_recon["alpha_meas_list"][-1]:.0e}.pkl.gz')
-    file = gzip.GzipFile(filepath, 'wb')
-    file.write(pickle.dumps(results_img_grp))
-    file.close()    
+        filepath = os.path.join(cfg_dataset['root_dir'], f'X_{tasknm}_alltrials_{cov_str}_alpha_spatial_{cfg_img_recon["alpha_spatial_list"][-1]:.0e}_alpha_meas_{cfg_img_recon["alpha_meas_list"][-1]:.0e}.pkl.gz')
+        print(f'   Saving to X_{tasknm}_alltrials_{cov_str}_alpha_spatial_{cfg_img_recon["alpha_spatial_list"][-1]:.0e}_alpha_meas_{cfg_img_recon["alpha_meas_list"][-1]:.0e}.pkl.gz')
+        file = gzip.GzipFile(filepath, 'wb')
+        file.write(pickle.dumps(results_img_grp))
+        file.close()    
 
 
 # %% LC:
@@ -238,120 +253,112 @@ ind_subj_blockavg = groupavg_results['blockaverage_subj']  # !!! assuming these
 #ind_subj_mse = all_results['ind_subj_mse']
 ind_subj_mse = groupavg_results['blockaverage_mse_subj']
 
-F = None
-D = None
-G = None
-# import pdb
-# pdb.set_trace()
-all_trial_X_hrf_mag = None
+# the HRF magnitude and its MSE of all subjects and trial types, C_meas is at least mse_min_thresh
+t_win = slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])
+od_hrf_mag_all = ind_subj_blockavg.sel(reltime=t_win).mean('reltime').transpose('subj', 'trial_type', 'wavelength', 'channel')
+C_meas_all = pfDAB_meas.stack_measurement(ind_subj_mse.sel(reltime=t_win).mean('reltime').pint.dequantify())
+C_meas_all = xr.where(C_meas_all < mse_min_thresh, mse_min_thresh, C_meas_all).transpose('subj', 'trial_type', 'measurement')
 
-for trial_type in ind_subj_blockavg.trial_type:
-    
-    print(f'Getting images for trial type = {trial_type.values}')
-    all_subj_X_hrf_mag = None
-    
-    for subj in ind_subj_blockavg.subj:
-        print(f'Calculating subject = {subj.values}')
+# same layout as the images of do_image_recon, the indirect ones are (chromo, vertex)
+img_dims = ('vertex', 'chromo') if cfg_img_recon['DIRECT'] else ('chromo', 'vertex')
 
-        od_hrf = ind_subj_blockavg.sel(subj=subj, trial_type=trial_type) 
-        # od_hrf = od_hrf.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
+all_trial_X_hrf_mag = None
 
-        od_mse = ind_subj_mse.sel(subj=subj, trial_type=trial_type).drop_vars(['subj', 'trial_type'])
-        
-        od_hrf_mag = od_hrf.sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
-        od_mse_mag = od_mse.sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
-        
-        C_meas = od_mse_mag.pint.dequantify()
-        C_meas = C_meas.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
-        C_meas = xr.where(C_meas < mse_min_thresh, mse_min_thresh, C_meas)
+with pfDAB_threads.stage('image_recon'):
+    # all images at once, the subjects and trial types with the same C_meas share W
+    X_hrf_mag_all, recon = img_recon.do_image_recon_batch(od_hrf_mag_all, head = head, Adot = Adot, C_meas = C_meas_all, 
+                                                wavelength = [760,850], BRAIN_ONLY = cfg_img_recon['BRAIN_ONLY'], DIRECT = cfg_img_recon['DIRECT'], SB = cfg_img_recon['SB'], 
+                                                cfg_sbf = cfg_img_recon['cfg_sb'], alpha_spatial = cfg_img_recon['alpha_spatial'], alpha_meas = cfg_img_recon['alpha_meas'],
+                                                C_meas_flag = cfg_img_recon['flag_Cmeas'])
 
-            
-        # pdb.set_trace()
+    for trial_type in ind_subj_blockavg.trial_type:
+    
+        print(f'Getting images for trial type = {trial_type.values}')
+        all_subj_X_hrf_mag = None
+    
+        for subj in ind_subj_blockavg.subj:
+            print(f'Calculating subject = {subj.values}')
 
-        X_hrf_mag, W, D, F, G = img_recon.do_image_recon(od_hrf_mag, head = head, Adot = Adot, C_meas_flag = cfg_img_recon['flag_Cmeas'], C_meas = C_meas, 
-                                                    wavelength = [760,850], BRAIN_ONLY = cfg_img_recon['BRAIN_ONLY'], DIRECT = cfg_img_recon['DIRECT'], SB = cfg_img_recon['SB'], 
-                                                    cfg_sbf = cfg_img_recon['cfg_sb'], alpha_spatial = cfg_img_recon['alpha_spatial'], alpha_meas = cfg_img_recon['alpha_meas'],
-                                                    F = F, D = D, G = G)
+            X_hrf_mag = X_hrf_mag_all.sel(subj=subj, trial_type=trial_type).drop_vars(['subj', 'trial_type']).transpose(*img_dims)
+            i_group = int(recon['group'].sel(subj=subj, trial_type=trial_type))
 
+            # the noise uses C_meas with the pruned channels set to bad values
+            X_mse = img_recon.get_image_noise(recon['C_meas'][i_group], X_hrf_mag, recon['W'][i_group], DIRECT = cfg_img_recon['DIRECT'], SB= cfg_img_recon['SB'], G=recon['G'][i_group])
         
-        
-        # pdb.set_trace()
-        X_mse = img_recon.get_image_noise(C_meas, X_hrf_mag, W, DIRECT = cfg_img_recon['DIRECT'], SB= cfg_img_recon['SB'], G=G)
-        
-        # X_mse_o = X_mse.copy()
+            # X_mse_o = X_mse.copy()
 
-        # weighted average -- same as chan space - but now is vertex space
-        if all_subj_X_hrf_mag is None:
+            # weighted average -- same as chan space - but now is vertex space
+            if all_subj_X_hrf_mag is None:
             
-            all_subj_X_hrf_mag = X_hrf_mag
-            all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(subj=subj)
-            all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(trial_type=trial_type)
+                all_subj_X_hrf_mag = X_hrf_mag
+                all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(subj=subj)
+                all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(trial_type=trial_type)
 
-            all_subj_X_mse = X_mse
-            all_subj_X_mse = all_subj_X_mse.assign_coords(subj=subj)
-            all_subj_X_mse = all_subj_X_mse.assign_coords(trial_type=trial_type)
+                all_subj_X_mse = X_mse
+                all_subj_X_mse = all_subj_X_mse.assign_coords(subj=subj)
+                all_subj_X_mse = all_subj_X_mse.assign_coords(trial_type=trial_type)
 
-            X_hrf_mag_weighted = X_hrf_mag / X_mse
-            X_mse_inv_weighted = 1 / X_mse   # X_mse = mse for 1 subject across all vertices , inverse is wt
+                X_hrf_mag_weighted = X_hrf_mag / X_mse
+                X_mse_inv_weighted = 1 / X_mse   # X_mse = mse for 1 subject across all vertices , inverse is wt
             
-        else:
+            else:
 
-            X_hrf_mag_tmp = X_hrf_mag.assign_coords(subj=subj)
-            X_hrf_mag_tmp = X_hrf_mag_tmp.assign_coords(trial_type=trial_type)
+                X_hrf_mag_tmp = X_hrf_mag.assign_coords(subj=subj)
+                X_hrf_mag_tmp = X_hrf_mag_tmp.assign_coords(trial_type=trial_type)
 
-            X_mse_tmp = X_mse.assign_coords(subj=subj)
-            X_mse_tmp = X_mse_tmp.assign_coords(trial_type=trial_type)
+                X_mse_tmp = X_mse.assign_coords(subj=subj)
+                X_mse_tmp = X_mse_tmp.assign_coords(trial_type=trial_type)
 
-            all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_tmp], dim='subj')
-            all_subj_X_mse = xr.concat([all_subj_X_mse, X_mse_tmp], dim='subj')
+                all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_tmp], dim='subj')
+                all_subj_X_mse = xr.concat([all_subj_X_mse, X_mse_tmp], dim='subj')
 
-            X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
-            X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse       # summing weight over all subjects -- viz X_mse_inv_weighted will tell us which regions of brain we are most conf in
-        # END OF SUBJECT LOOP
+                X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
+                X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse       # summing weight over all subjects -- viz X_mse_inv_weighted will tell us which regions of brain we are most conf in
+            # END OF SUBJECT LOOP
 
-    # get the average
-    X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
-    X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
+        # get the average
+        X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
+        X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
     
-    X_mse_mean_within_subject = 1 / X_mse_inv_weighted
-    X_mse_mean_within_subject = X_mse_mean_within_subject.assign_coords({'trial_type': trial_type})
+        X_mse_mean_within_subject = 1 / X_mse_inv_weighted
+        X_mse_mean_within_subject = X_mse_mean_within_subject.assign_coords({'trial_type': trial_type})
     
-    X_mse_subj_tmp = all_subj_X_mse # PLOT THIS
+        X_mse_subj_tmp = all_subj_X_mse # PLOT THIS
     
-    # temp = all_subj_X_mse.copy()
-    # temp[: ~M] = np.nan
-    # temp = np.log10(temp.sel(vertex=all_subj_X_mse.is_brain.values).stack(val=('vertex', 'chromo', 'subj')))
-    # temp[np.isneginf(temp)] = np.nan
+        # temp = all_subj_X_mse.copy()
+        # temp[: ~M] = np.nan
+        # temp = np.log10(temp.sel(vertex=all_subj_X_mse.is_brain.values).stack(val=('vertex', 'chromo', 'subj')))
+        # temp[np.isneginf(temp)] = np.nan
     
-    # plt.hist(temp, bins=100)
-    # plt.axvline(np.log10(mse_min_thresh), color='k')
+        # plt.hist(temp, bins=100)
+        # plt.axvline(np.log10(mse_min_thresh), color='k')
     
-    # X_mse_subj_tmp = xr.where(X_mse_subj_tmp < mse_min_thresh, mse_min_thresh, X_mse_subj_tmp)
-    X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects * X_mse_mean_within_subject # / (all_subj_X_mse**-1).mean('subj')
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects.pint.dequantify()
+        # X_mse_subj_tmp = xr.where(X_mse_subj_tmp < mse_min_thresh, mse_min_thresh, X_mse_subj_tmp)
+        X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects * X_mse_mean_within_subject # / (all_subj_X_mse**-1).mean('subj')
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects.pint.dequantify()
     
-    X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
+        X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
     
-    X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
+        X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
     
-    if all_trial_X_hrf_mag is None:
+        if all_trial_X_hrf_mag is None:
         
-        all_trial_X_hrf_mag = X_hrf_mag_mean
-        all_trial_X_hrf_mag_weighted = X_hrf_mag_mean_weighted
-        all_trial_X_stderr = X_stderr_weighted
-        all_trial_X_tstat = X_tstat
-        all_trial_X_mse_between = X_mse_weighted_between_subjects
-        all_trial_X_mse_within = X_mse_mean_within_subject
-    else:
-
-        all_trial_X_hrf_mag = xr.concat([all_trial_X_hrf_mag, X_hrf_mag_mean], dim='trial_type')
-        all_trial_X_hrf_mag_weighted = xr.concat([all_trial_X_hrf_mag_weighted, X_hrf_mag_mean_weighted], dim='trial_type')
-        all_trial_X_stderr = xr.concat([all_trial_X_stderr, X_stderr_weighted], dim='trial_type')
-        all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
-        all_trial_X_mse_between = xr.concat([all_trial_X_mse_between, X_mse_weighted_between_subjects], dim='trial_type')
-        all_trial_X_mse_within = xr.concat([all_trial_X_mse_within, X_mse_mean_within_subject], dim='trial_type')
+            all_trial_X_hrf_mag = X_hrf_mag_mean
+            all_trial_X_hrf_mag_weighted = X_hrf_mag_mean_weighted
+            all_trial_X_stderr = X_stderr_weighted
+            all_trial_X_tstat = X_tstat
+            all_trial_X_mse_between = X_mse_weighted_between_subjects
+            all_trial_X_mse_within = X_mse_mean_within_subject
+        else:
+
+            all_trial_X_hrf_mag = xr.concat([all_trial_X_hrf_mag, X_hrf_mag_mean], dim='trial_type')
+            all_trial_X_hrf_mag_weighted = xr.concat([all_trial_X_hrf_mag_weighted, X_hrf_mag_mean_weighted], dim='trial_type')
+            all_trial_X_stderr = xr.concat([all_trial_X_stderr, X_stderr_weighted], dim='trial_type')
+            all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
+            all_trial_X_mse_between = xr.concat([all_trial_X_mse_between, X_mse_weighted_between_subjects], dim='trial_type')
+            all_trial_X_mse_within = xr.concat([all_trial_X_mse_within, X_mse_mean_within_subject], dim='trial_type')
 
 # END OF TRIAL TYPE LOOP
 results = {'X_hrf_mag': all_trial_X_hrf_mag,
@@ -494,150 +501,150 @@ D = None
 
 all_trial_X_hrf_mag = None
 
-for idx_trial, trial_type in enumerate(blockaverage_subj.trial_type):
+with pfDAB_threads.stage('image_recon'):
+    for idx_trial, trial_type in enumerate(blockaverage_subj.trial_type):
     
-    print(f'Getting images for trial type = {trial_type.values}')
-    all_subj_X_hrf_mag = None
+        print(f'Getting images for trial type = {trial_type.values}')
+        all_subj_X_hrf_mag = None
     
-    for idx_subj, curr_subj in enumerate(subj_ids_new):
+        for idx_subj, curr_subj in enumerate(subj_ids_new):
 
-        print(f'Starting image recon on subject {curr_subj}')
+            print(f'Starting image recon on subject {curr_subj}')
         
-        if 'chromo' in blockaverage_subj.dims:
-            # get the group average HRF over a time window
-            hrf_conc_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
-            hrf_conc_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
+            if 'chromo' in blockaverage_subj.dims:
+                # get the group average HRF over a time window
+                hrf_conc_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0],cfg_img_recon['t_win'][1])).mean('reltime')
+                hrf_conc_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
             
-            blockaverage_mse_subj_conc = blockaverage_mse_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
+                blockaverage_mse_subj_conc = blockaverage_mse_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
             
-            # convert back to OD
-            E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
-            hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # !!! assumes DPF = 1
-            hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                # convert back to OD
+                E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon['spectrum'], wavelength)
+                hrf_od_mag = xr.dot(E, hrf_conc_mag * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # !!! assumes DPF = 1
+                hrf_od_ts = xr.dot(E, hrf_conc_ts * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
                 
-            blockaverage_mse_subj= xr.dot(E, blockaverage_mse_subj_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+                blockaverage_mse_subj= xr.dot(E, blockaverage_mse_subj_conc * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
 
-        else:
-            hrf_od_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
-            hrf_od_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
+            else:
+                hrf_od_mag = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime')
+                hrf_od_ts = blockaverage_subj.sel(subj= curr_subj).sel(trial_type=trial_type)
 
-        #
-        #hrf_od_mag = blockaverage_subj.sel(subj=cfg_dataset['subj_ids'][idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
-        # hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
+            #
+            #hrf_od_mag = blockaverage_subj.sel(subj=cfg_dataset['subj_ids'][idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
+            # hrf_od_ts = blockaverage_all.sel(trial_type=trial_type)
     
-        # get the image
+            # get the image
         
-        C_meas = blockaverage_mse_subj.sel(subj=subj_ids_new[idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
+            C_meas = blockaverage_mse_subj.sel(subj=subj_ids_new[idx_subj]).sel(trial_type=trial_type).sel(reltime=slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])).mean('reltime') 
     
-        C_meas = C_meas.pint.dequantify()
-        C_meas = C_meas.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
+            C_meas = C_meas.pint.dequantify()
+            C_meas = pfDAB_meas.stack_measurement(C_meas)
         
-        if cfg_img_recon['flag_Cmeas']:
-            cov_str = 'cov'
-            if C is None or D is None:
-                #X_hrf_mag_tmp, W, C, D = img_recon.do_image_recon( hrf_od_mag, head, Adot, C_meas, wavelength, BRAIN_ONLY, SB, sb_cfg, alpha_spatial_list, alpha_meas_list, file_save, file_path0, trial_type) 
-                X_hrf_mag_tmp, W, C, D = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas,
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path,
-                                                                  W = None, C = None, D = None) 
+            if cfg_img_recon['flag_Cmeas']:
+                cov_str = 'cov'
+                if C is None or D is None:
+                    #X_hrf_mag_tmp, W, C, D = img_recon.do_image_recon( hrf_od_mag, head, Adot, C_meas, wavelength, BRAIN_ONLY, SB, sb_cfg, alpha_spatial_list, alpha_meas_list, file_save, file_path0, trial_type) 
+                    X_hrf_mag_tmp, W, C, D = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas,
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path,
+                                                                      W = None, C = None, D = None) 
         
+                else:
+                    X_hrf_mag_tmp, W, _, _ = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas, 
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path, 
+                                                                      W = None, C = C, D = D)
             else:
-                X_hrf_mag_tmp, W, _, _ = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = C_meas, 
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path, 
-                                                                  W = None, C = C, D = D)
-        else:
-            cov_str = ''
-            if C is None or D is None:
-                X_hrf_mag_tmp, W, C, D = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None,
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path,
-                                                                  W = None, C = None, D = None) 
+                cov_str = ''
+                if C is None or D is None:
+                    X_hrf_mag_tmp, W, C, D = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None,
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path,
+                                                                      W = None, C = None, D = None) 
         
-            else:
-                X_hrf_mag_tmp, W, _, _ = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None, 
-                                                                  wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
-                                                                  trial_type_img = trial_type, save_path = save_path, 
-                                                                  W = None, C = C, D = D)
+                else:
+                    X_hrf_mag_tmp, W, _, _ = img_recon.do_image_recon_DB( hrf_od = hrf_od_mag, head = head, Adot = Adot, C_meas = None, 
+                                                                      wavelength = wavelength, cfg_img_recon = cfg_img_recon, 
+                                                                      trial_type_img = trial_type, save_path = save_path, 
+                                                                      W = None, C = C, D = D)
         
 
-        # get image noise
-        cov_img_tmp = W * np.sqrt(C_meas.values) # get diag of image covariance
-        cov_img_diag = np.nansum(cov_img_tmp**2, axis=1)
+            # get image noise
+            cov_img_diag = img_recon.get_image_variance(W, C_meas) # get diag of image covariance
     
-        nV = X_hrf_mag_tmp.vertex.size
-        cov_img_diag = np.reshape( cov_img_diag, (2,nV) ).T
+            nV = X_hrf_mag_tmp.vertex.size
+            cov_img_diag = np.reshape( cov_img_diag, (2,nV) ).T
     
-        X_mse = X_hrf_mag_tmp.copy() 
-        X_mse.values = cov_img_diag # !!! SAVE nult trial types
+            X_mse = X_hrf_mag_tmp.copy() 
+            X_mse.values = cov_img_diag # !!! SAVE nult trial types
         
         
-        # weighted average -- same as chan space - but now is vertex space
-        if all_subj_X_hrf_mag is None:
-            all_subj_X_hrf_mag = X_hrf_mag_tmp
-            all_subj_X_hrf_mag = all_subj_X_hrf_mag.expand_dims('subj')
-            all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(subj=subj_ids_new[idx_subj])
+            # weighted average -- same as chan space - but now is vertex space
+            if all_subj_X_hrf_mag is None:
+                all_subj_X_hrf_mag = X_hrf_mag_tmp
+                all_subj_X_hrf_mag = all_subj_X_hrf_mag.expand_dims('subj')
+                all_subj_X_hrf_mag = all_subj_X_hrf_mag.assign_coords(subj=subj_ids_new[idx_subj])
     
-            X_mse_subj = X_mse.copy()
-            X_mse_subj = X_mse_subj.expand_dims('subj')
-            X_mse_subj = X_mse_subj.assign_coords(subj=subj_ids_new[idx_subj])
+                X_mse_subj = X_mse.copy()
+                X_mse_subj = X_mse_subj.expand_dims('subj')
+                X_mse_subj = X_mse_subj.assign_coords(subj=subj_ids_new[idx_subj])
             
-            X_hrf_mag_weighted = X_hrf_mag_tmp / X_mse
-            X_mse_inv_weighted = 1 / X_mse
-            X_mse_inv_weighted_max = 1 / X_mse
-        else:
-            X_hrf_mag_subj_tmp = X_hrf_mag_tmp.expand_dims('subj') # !!! will need to expand dims to get back trial type -- can do in function 
-            X_hrf_mag_subj_tmp = X_hrf_mag_subj_tmp.assign_coords(subj=subj_ids_new[idx_subj])
+                X_hrf_mag_weighted = X_hrf_mag_tmp / X_mse
+                X_mse_inv_weighted = 1 / X_mse
+                X_mse_inv_weighted_max = 1 / X_mse
+            else:
+                X_hrf_mag_subj_tmp = X_hrf_mag_tmp.expand_dims('subj') # !!! will need to expand dims to get back trial type -- can do in function 
+                X_hrf_mag_subj_tmp = X_hrf_mag_subj_tmp.assign_coords(subj=subj_ids_new[idx_subj])
     
-            X_mse_subj_tmp = X_mse.copy().expand_dims('subj')
-            X_mse_subj_tmp = X_mse_subj_tmp.assign_coords(subj=[subj_ids_new[idx_subj]])
+                X_mse_subj_tmp = X_mse.copy().expand_dims('subj')
+                X_mse_subj_tmp = X_mse_subj_tmp.assign_coords(subj=[subj_ids_new[idx_subj]])
     
-            all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_subj_tmp], dim='subj')
-            X_mse_subj = xr.concat([X_mse_subj, X_mse_subj_tmp], dim='subj')
+                all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_subj_tmp], dim='subj')
+                X_mse_subj = xr.concat([X_mse_subj, X_mse_subj_tmp], dim='subj')
     
-            X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
-            X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse
-            X_mse_inv_weighted_max = np.maximum(X_mse_inv_weighted_max, 1 / X_mse)
+                X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
+                X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse
+                X_mse_inv_weighted_max = np.maximum(X_mse_inv_weighted_max, 1 / X_mse)
         
     
-    # END OF SUBJECT LOOP
+        # END OF SUBJECT LOOP
     
-    # get the average
-    X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
-    X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
+        # get the average
+        X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
+        X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
     
-    X_mse_mean_within_subject = 1 / X_mse_inv_weighted
+        X_mse_mean_within_subject = 1 / X_mse_inv_weighted
     
-    X_mse_subj_tmp = X_mse_subj.copy()
-    X_mse_subj_tmp = xr.where(X_mse_subj_tmp < 1e-6, 1e-6, X_mse_subj_tmp)
-    X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
-    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects / (X_mse_subj**-1).mean('subj')
+        X_mse_subj_tmp = X_mse_subj.copy()
+        X_mse_subj_tmp = xr.where(X_mse_subj_tmp < 1e-6, 1e-6, X_mse_subj_tmp)
+        X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
+        X_mse_weighted_between_subjects = X_mse_weighted_between_subjects / (X_mse_subj**-1).mean('subj')
     
-    X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
+        X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
     
-    X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
+        X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
     
-    X_weight_sum = X_mse_inv_weighted / X_mse_inv_weighted_max  # tstat = weighted group avg / noise # !!! not saving?
+        X_weight_sum = X_mse_inv_weighted / X_mse_inv_weighted_max  # tstat = weighted group avg / noise # !!! not saving?
     
-    # Assign trial type coord
-    X_hrf_mag_mean = X_hrf_mag_mean.assign_coords(trial_type = trial_type)
-    X_hrf_mag_mean_weighted = X_hrf_mag_mean_weighted.assign_coords(trial_type = trial_type)
-    X_stderr_weighted = X_stderr_weighted.assign_coords(trial_type = trial_type)
-    X_tstat = X_tstat.assign_coords(trial_type = trial_type)
+        # Assign trial type coord
+        X_hrf_mag_mean = X_hrf_mag_mean.assign_coords(trial_type = trial_type)
+        X_hrf_mag_mean_weighted = X_hrf_mag_mean_weighted.assign_coords(trial_type = trial_type)
+        X_stderr_weighted = X_stderr_weighted.assign_coords(trial_type = trial_type)
+        X_tstat = X_tstat.assign_coords(trial_type = trial_type)
 
-    if all_trial_X_hrf_mag is None:
+        if all_trial_X_hrf_mag is None:
         
-        all_trial_X_hrf_mag = X_hrf_mag_mean
-        all_trial_X_hrf_mag_weighted = X_hrf_mag_mean_weighted
-        all_trial_X_stderr = X_stderr_weighted # noise
-        all_trial_X_tstat = X_tstat # tstat
-    else:
+            all_trial_X_hrf_mag = X_hrf_mag_mean
+            all_trial_X_hrf_mag_weighted = X_hrf_mag_mean_weighted
+            all_trial_X_stderr = X_stderr_weighted # noise
+            all_trial_X_tstat = X_tstat # tstat
+        else:
     
-        all_trial_X_hrf_mag = xr.concat([all_trial_X_hrf_mag, X_hrf_mag_mean], dim='trial_type')
-        all_trial_X_hrf_mag_weighted = xr.concat([all_trial_X_hrf_mag_weighted, X_hrf_mag_mean_weighted], dim='trial_type')
-        all_trial_X_stderr = xr.concat([all_trial_X_stderr, X_stderr_weighted], dim='trial_type')
-        all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
+            all_trial_X_hrf_mag = xr.concat([all_trial_X_hrf_mag, X_hrf_mag_mean], dim='trial_type')
+            all_trial_X_hrf_mag_weighted = xr.concat([all_trial_X_hrf_mag_weighted, X_hrf_mag_mean_weighted], dim='trial_type')
+            all_trial_X_stderr = xr.concat([all_trial_X_stderr, X_stderr_weighted], dim='trial_type')
+            all_trial_X_tstat = xr.concat([all_trial_X_tstat, X_tstat], dim='trial_type')
 
 # END OF TRIAL TYPE LOOP
 
@@ -950,6 +957,12 @@ else:
 
 
 
+# %% Write the instrumentation trace
+##############################################################################
+# open in chrome://tracing, https://ui.perfetto.dev or https://www.speedscope.app
+
+pfDAB_inst.stop_trace( os.path.join(cfg_dataset['root_dir'], 'derivatives', 'trace', f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json") )
+
 # %%
 
 '''
@@ -1029,7 +1042,7 @@ X_foo[np.isin(X_foo['parcel'].values, np.unique(Xo_parcel_2['parcel'].values) ),
 
 
 
-od_ts = hrf_od_ts.stack(measurement=('channel', 'wavelength')).sortby('wavelength').T
+od_ts = pfDAB_meas.stack_measurement(hrf_od_ts).T
 X_grp_ts = W @ od_ts.values
 
 split = len(X_grp_ts)//2
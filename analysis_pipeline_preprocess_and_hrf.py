@@ -20,6 +20,7 @@ from math import ceil
 import gzip
 import pickle
 import json
+from datetime import datetime
 
 
 # import my own functions from a different directory
@@ -32,6 +33,8 @@ import module_group_avg as pfDAB_grp_avg
 import module_ERBM_ICA as pfDAB_ERBM
 import module_image_recon as pfDAB_img
 import module_spatial_basis_funs_ced as sbf 
+import module_instrument as pfDAB_inst
+import module_threads as pfDAB_threads
 
 
 # Turn off all warnings
@@ -121,6 +124,11 @@ cfg_GLM = {
     }           
 
 
+cfg_dqr = {
+    'mode' : 'background',  # 'inline' = plot in the preprocessing loop, 'background' = plot in worker processes, 'metrics_only' = only save the DQR metrics
+    'n_workers' : 4
+}
+
 cfg_preprocess = {
     'flag_prune_channels' : False,  # FALSE = does not prune chans and does weighted averaging, TRUE = prunes channels and no weighted averaging
     'median_filt' : 1, # set to 1 if you don't want to do median filtering
@@ -128,7 +136,8 @@ cfg_preprocess = {
     'cfg_motion_correct' : cfg_motion_correct,
     'cfg_bandpass' : cfg_bandpass,
     'flag_do_GLM_filter' : True,
-    'cfg_GLM' : cfg_GLM 
+    'cfg_GLM' : cfg_GLM,
+    'cfg_dqr' : cfg_dqr
 }
 
 
@@ -162,8 +171,18 @@ cfg_blockavg = {
 
 cfg_erbmICA = {}
 
+cfg_threads = {
+    'n_threads' : None,     # BLAS threads of this process, None uses all cores (see module_threads)
+    'stages' : {},          # e.g. {'ica' : 8}
+    }
+
 save_path = os.path.join(cfg_dataset['root_dir'], 'derivatives', 'processed_data')
 
+pfDAB_threads.configure( cfg_threads )
+
+# record wall time, CPU time and peak RSS of every stage (see module_instrument)
+pfDAB_inst.start_trace()
+
 flag_load_preprocessed_data = True  
 flag_save_preprocessed_data = False   # SAVE or no save
 
@@ -295,7 +314,8 @@ flag_ERBM_vs_EBM = False # if True, use ERBM, otherwise use EBM
 
 
 # FIXME: I want to verify that this properly scales back the NOT pruned data to channel space
-rec = pfDAB_ERBM.ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsample, cov_amp_thresh, chs_pruned_subjs, pca_var_thresh, flag_do_pca_filter, flag_calculate_ICA_matrix, flag_ERBM_vs_EBM, p_ica, rootDir_data, flag_do_ica_filter, ica_spatial_mask_thresh, ica_tstat_thresh, trange_hrf, trange_hrf_stat, stim_lst_hrf_ica )
+with pfDAB_threads.stage('ica'):
+    rec = pfDAB_ERBM.ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsample, cov_amp_thresh, chs_pruned_subjs, pca_var_thresh, flag_do_pca_filter, flag_calculate_ICA_matrix, flag_ERBM_vs_EBM, p_ica, rootDir_data, flag_do_ica_filter, ica_spatial_mask_thresh, ica_tstat_thresh, trange_hrf, trange_hrf_stat, stim_lst_hrf_ica )
 
 
 # FIXME: should not be needed here... shouldbe handled in ICA step above
@@ -365,3 +385,8 @@ else: # LOAD data
 blockaverage_all = blockaverage_mean.copy()
 
 
+# %% Write the instrumentation trace
+##############################################################################
+# open in chrome://tracing, https://ui.perfetto.dev or https://www.speedscope.app
+
+pfDAB_inst.stop_trace( os.path.join(cfg_dataset['root_dir'], 'derivatives', 'trace', f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json") )
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run the subject level steps of the pipeline (preprocessing, ICA, block average and subject
+image recon) for a subset of the subjects and merge the shards into the group averages
+(see modules/module_shard.py).
+
+On an SGE cluster run one shard per array task and the merge once all tasks are done
+
+    qsub -t 1-8 -b y python analysis_pipeline_shard.py --n-shards 8
+    qsub -hold_jid <job_id> -b y python analysis_pipeline_shard.py --merge
+
+or choose the subjects explicitly
+
+    python analysis_pipeline_shard.py --subj 01 02 03
+
+Without options (e.g. when run cell by cell) all subjects are processed in this process.
+"""
+
+# %% Imports
+##############################################################################
+
+import os
+import sys
+import gzip
+import json
+import pickle
+from datetime import datetime
+
+import numpy as np
+from cedalion import units
+
+sys.path.append('/projectnb/nphfnirs/ns/Shannon/Code/cedalion-dab-funcs2/modules')
+import module_load_and_preprocess as pfDAB
+import module_ERBM_ICA as pfDAB_ERBM
+import module_shard as pfDAB_shard
+import module_instrument as pfDAB_inst
+import module_threads as pfDAB_threads
+
+# Turn off all warnings
+import warnings
+warnings.filterwarnings('ignore')
+
+
+# %% Analysis parameters
+##############################################################################
+
+cfg_hrf = {
+    'stim_lst' : ['ST', 'DT'],
+    't_pre' : 5 *units.s,
+    't_post' : 33 *units.s
+    }
+
+cfg_dataset = {
+    'root_dir' : "/projectnb/nphfnirs/ns/Shannon/Data/Interactive_Walking_HD/",
+    'subj_ids' : ['01','02','03','04','05','06','07','08','09','10', '11', '12', '13', '14', '15', '16', '17', '18', '19'],
+    'file_ids' : ['IWHD_run-01'],
+    'subj_id_exclude' : ['10', '15', '16', '17'],
+    'cfg_hrf' : cfg_hrf
+}
+
+cfg_dataset['filenm_lst'] = [
+    [f"sub-{subj_id}_task-{file_id}_nirs" for file_id in cfg_dataset['file_ids']]
+    for subj_id in cfg_dataset['subj_ids']
+    ]
+
+cfg_prune = {
+    'snr_thresh' : 5,
+    'sd_threshs' : [1, 60]*units.mm,
+    'amp_threshs' : [1e-5, 0.84],
+    'perc_time_clean_thresh' : 0.6,
+    'sci_threshold' : 0.6,
+    'psp_threshold' : 0.1,
+    'window_length' : 5 * units.s,
+    'flag_use_sci' : True,
+    'flag_use_psp' : False
+}
+
+cfg_imu_glm = {
+    'statesPerDataFrame' : 89,   # FOR WALKING DATA
+    'hWin' : np.arange(-3,5,1),
+    'n_components' : [3, 2],
+    'ica_reuse' : None,          # None fits the IMU ICA on every file, 'subject' once per subject, 'all' once for all files
+    'ica_random_state' : 0,
+    'ica_fit_subsample' : 1,
+    'butter_order' : 4,
+    'Fc' : 0.1,
+    'plot_flag_imu' : True
+}
+
+cfg_motion_correct = {
+    'flag_do_tddr' : True,
+    'flag_do_imu_glm' : True,
+    'cfg_imu_glm' : cfg_imu_glm,
+}
+
+cfg_bandpass = {
+    'fmin' : 0.01 * units.Hz,
+    'fmax' : 0.5 * units.Hz
+}
+
+cfg_GLM = {
+    'drift_order' : 1,
+    'distance_threshold' : 20 *units.mm,
+    'short_channel_method' : 'mean',
+    'noise_model' : "ols",
+    't_delta' : 1 *units.s ,
+    't_std' : 1 *units.s ,
+    'cfg_hrf' : cfg_hrf
+    }
+
+cfg_dqr = {
+    'mode' : 'background',
+    'n_workers' : 4
+}
+
+cfg_preprocess = {
+    'flag_prune_channels' : False,
+    'median_filt' : 3,
+    'cfg_prune' : cfg_prune,
+    'cfg_motion_correct' : cfg_motion_correct,
+    'cfg_bandpass' : cfg_bandpass,
+    'flag_do_GLM_filter' : True,
+    'cfg_GLM' : cfg_GLM,
+    'cfg_dqr' : cfg_dqr
+}
+
+cfg_ica = {
+    'flag_do_ica' : False,
+    'flag_ICA_use_pruned_data' : False,
+    'ica_lpf' : 1.0 * units.Hz,
+    'ica_downsample' : 1,
+    'cov_amp_thresh' : 1.1e-6,
+    'pca_var_thresh' : 0.99,
+    'flag_do_pca_filter' : True,
+    'flag_calculate_ICA_matrix' : False,
+    'flag_ERBM_vs_EBM' : False,
+    'p_ica' : 27,
+    'flag_do_ica_filter' : True,
+    'ica_spatial_mask_thresh' : 1.0,
+    'ica_tstat_thresh' : 1.0,
+    'trange_hrf' : [5, 35] * units.s,
+    'trange_hrf_stat' : [5, 20],
+    'stim_lst_hrf_ica' : ['STS'],
+}
+
+cfg_mse_conc = {
+    'mse_val_for_bad_data' : 1e7 * units.micromolar**2,
+    'mse_amp_thresh' : 1.1e-6,
+    'mse_min_thresh' : 1e0 * units.micromolar**2,
+    'blockaverage_val' : 0 * units.micromolar
+    }
+
+cfg_mse_od = {
+    'mse_val_for_bad_data' : 1e1,
+    'mse_amp_thresh' : 1.1e-6,
+    'mse_min_thresh' : 1e-6,
+    'blockaverage_val' : 0
+    }
+
+cfg_blockavg = {
+    'rec_str' : 'od_corrected',
+    'flag_prune_channels' : cfg_preprocess['flag_prune_channels'],
+    'cfg_hrf' : cfg_hrf,
+    'trange_hrf_stat' : [10, 20],
+    'flag_save_group_avg_hrf': True,
+    'flag_save_each_subj' : False,
+    'cfg_mse_conc' : cfg_mse_conc,
+    'cfg_mse_od' : cfg_mse_od
+    }
+
+cfg_sb = {
+    'mask_threshold': -2,
+    'threshold_brain': 5*units.mm,
+    'threshold_scalp': 20*units.mm,
+    'sigma_brain': 5*units.mm,
+    'sigma_scalp': 20*units.mm,
+    'lambda1': 0.01,
+    'lambda2': 0.1
+}
+
+cfg_img_recon = {
+    'flag_do_img_recon' : True,
+    'probe_dir' : "/projectnb/nphfnirs/s/users/lcarlton/DATA/probes/NN22_WHHD/12NN/fw/",
+    'head_model' : 'ICBM152',
+    't_win' : (10, 20),
+    'flag_Cmeas' : True,
+    'BRAIN_ONLY' : False,
+    'DIRECT' : True,
+    'SB' : False,
+    'alpha_meas' : 1e0,
+    'alpha_spatial' : 1e-1,
+    'mse_min_thresh' : 1e-3,    # minimum of C_meas (OD**2), as in analysis_pipeline_image_recon
+    'spectrum' : 'prahl',
+    'cfg_sb' : cfg_sb,
+    }
+
+cfg_threads = {
+    'n_threads' : None,     # BLAS threads of this process, None uses all cores. With several shards on one node
+                            # use the cores of the node divided by the shards (see module_threads)
+    'stages' : {},          # e.g. {'ica' : 4, 'image_recon' : 8}
+    }
+
+save_path = os.path.join(cfg_dataset['root_dir'], 'derivatives', 'processed_data')
+shard_dir = pfDAB_shard.get_shard_dir( cfg_dataset['root_dir'] )
+
+shard_args = pfDAB_shard.parse_shard_args()
+
+pfDAB_threads.configure( cfg_threads )
+
+# record wall time, CPU time and peak RSS of every stage (see module_instrument)
+pfDAB_inst.start_trace()
+
+
+# %% Shard: the subject level steps
+##############################################################################
+
+if not shard_args['flag_merge']:
+
+    subj_ids_shard = pfDAB_shard.get_shard_subj_ids( cfg_dataset, shard_args )
+    cfg_dataset_shard = pfDAB_shard.get_shard_cfg_dataset( cfg_dataset, subj_ids_shard )
+    print(f'Processing subjects {subj_ids_shard}')
+
+    rec, chs_pruned_subjs = pfDAB.load_and_preprocess( cfg_dataset_shard, cfg_preprocess )
+
+    if cfg_ica['flag_do_ica']:
+        c = cfg_ica
+        with pfDAB_threads.stage('ica'):
+            rec = pfDAB_ERBM.ERBM_run_ica( rec, cfg_dataset_shard['filenm_lst'], c['flag_ICA_use_pruned_data'], c['ica_lpf'], c['ica_downsample'],
+                                         c['cov_amp_thresh'], chs_pruned_subjs, c['pca_var_thresh'], c['flag_do_pca_filter'],
+                                         c['flag_calculate_ICA_matrix'], c['flag_ERBM_vs_EBM'], c['p_ica'], cfg_dataset['root_dir'],
+                                         c['flag_do_ica_filter'], c['ica_spatial_mask_thresh'], c['ica_tstat_thresh'], c['trange_hrf'],
+                                         c['trange_hrf_stat'], c['stim_lst_hrf_ica'] )
+
+    pfDAB_shard.write_shard_preprocessed( rec, chs_pruned_subjs, cfg_dataset_shard, shard_dir )
+
+    pfDAB_shard.run_shard_block_average( rec, chs_pruned_subjs, cfg_dataset_shard, cfg_blockavg, shard_dir )
+
+    if cfg_img_recon['flag_do_img_recon']:
+        import module_image_recon as pfDAB_img
+
+        Adot, head = pfDAB_img.load_Adot( cfg_img_recon['probe_dir'], cfg_img_recon['head_model'] )
+        wavelength = rec[0][0]['amp'].wavelength.values
+
+        with pfDAB_threads.stage('image_recon'):
+            pfDAB_shard.run_shard_image_recon( cfg_dataset_shard, cfg_img_recon, Adot, head, wavelength, shard_dir )
+
+    trace_str = f"shard_{'_'.join(subj_ids_shard)}"
+
+
+# %% Merge: the group averages
+##############################################################################
+
+if shard_args['flag_merge']:
+
+    tasknm = cfg_dataset["file_ids"][0].split('_')[0]
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    if 'conc' in cfg_blockavg['rec_str']:
+        save_str = '_CONC'
+    else:
+        save_str = '_OD'
+
+    blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr, blockaverage_subj, blockaverage_mse_subj = \
+        pfDAB_shard.merge_block_averages( shard_dir, cfg_dataset, cfg_blockavg )
+
+    groupavg_results = {'blockaverage': blockaverage_mean if cfg_preprocess['flag_prune_channels'] else blockaverage_mean_weighted,
+                        'blockaverage_stderr': blockaverage_stderr,
+                        'blockaverage_subj': blockaverage_subj,
+                        'blockaverage_mse_subj': blockaverage_mse_subj,
+                        }
+
+    if cfg_blockavg['flag_save_group_avg_hrf']:
+        file_path_pkl = os.path.join(save_path, 'blockaverage_' + tasknm + '_' + save_str + '.pkl.gz')
+        with gzip.open(file_path_pkl, 'wb') as f:
+            pickle.dump(groupavg_results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print('Saved group average HRF to ' + file_path_pkl)
+
+    if cfg_img_recon['flag_do_img_recon']:
+        results_img_s = pfDAB_shard.merge_images( shard_dir, cfg_dataset )
+
+        cov_str = 'cov' if cfg_img_recon['flag_Cmeas'] else ''
+        filepath = os.path.join(save_path, f'Xs_{tasknm}_direct_alltrial_{cov_str}_alpha_spatial_{cfg_img_recon["alpha_spatial"]:.0e}_alpha_meas_{cfg_img_recon["alpha_meas"]:.0e}.pkl.gz')
+        with gzip.open(filepath, 'wb') as f:
+            pickle.dump(results_img_s, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print(f'   Saving to {filepath}')
+
+    # SAVE cfg params to json file
+    dict_cfg_save = {"cfg_hrf": cfg_hrf, "cfg_dataset" : cfg_dataset, "cfg_preprocess" : cfg_preprocess, "cfg_blockavg" : cfg_blockavg, "cfg_img_recon" : cfg_img_recon}
+    with open(os.path.join(save_path, 'cfg_params_' + tasknm + '_shard_merge.json'), "w", encoding="utf-8") as f:
+        json.dump(dict_cfg_save, f, indent=4, default = str)
+
+    trace_str = 'merge'
+
+
+# %% Write the instrumentation trace
+##############################################################################
+
+pfDAB_inst.stop_trace( os.path.join(cfg_dataset['root_dir'], 'derivatives', 'trace', f'trace_{trace_str}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json') )
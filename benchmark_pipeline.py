@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the pipeline stages on synthetic data and write a JSON report.
+
+Runs fully offline. Compare the report with the one of another commit with
+    pfDAB_bench.compare_reports('benchmarks/base.json', 'benchmarks/new.json')
+"""
+
+# %% Imports
+##############################################################################
+
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules'))
+import module_benchmark as pfDAB_bench
+
+
+# %% Benchmark parameters
+##############################################################################
+
+cfg_synth = {
+    'n_sources' : 16,
+    'n_detectors' : 24,
+    'fs' : 10.,            # Hz
+    'duration' : 600.,     # s
+    'flag_imu' : True,
+    }
+
+cfg_benchmark = {
+    'stages' : pfDAB_bench.stage_lst,    # or a subset, e.g. ['preprocess', 'calc_dFC']
+    'n_repeat' : 3,
+    'n_subjects' : 3,
+    'cfg_synth' : cfg_synth,
+    'head_subdivisions' : 4,
+    'n_clusters' : 10,
+    'seed' : 0,
+    }
+
+report_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'benchmark_report.json')
+if len(sys.argv) > 1:
+    report_path = sys.argv[1]
+
+
+# %% Run
+##############################################################################
+
+flag_thread_benchmark = True    # also find the best worker x BLAS thread split of this node
+
+report = pfDAB_bench.run_benchmarks(cfg_benchmark)
+if flag_thread_benchmark:
+    report['thread_split'] = pfDAB_bench.run_thread_benchmark(cfg_benchmark)
+pfDAB_bench.write_report(report, report_path)
+
+for stage, result in report['stages'].items():
+    if 'error' in result:
+        print(f"{stage:<26} failed: {result['error']}")
+    else:
+        print(f"{stage:<26} {result['t_median']:8.3f} s   {result['peak_mem_mb']:8.1f} MB")
+
+if flag_thread_benchmark:
+    for split, result in report['thread_split']['splits'].items():
+        print(f"{split:<26} {result['t_wall']:8.3f} s   {result['jobs_per_s']:8.2f} recons/s")
+    print(f"best split (workers x threads): {report['thread_split']['best']}")
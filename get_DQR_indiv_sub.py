@@ -27,6 +27,8 @@ import sys
 sys.path.append('/projectnb/nphfnirs/ns/Shannon/Code/cedalion-dab-funcs2/modules')
 import module_plot_DQR as dqr
 import module_load_and_preprocess as preproc
+import module_quality as qual
+import module_threads as pfDAB_threads
 
 #%%
 
@@ -69,6 +71,12 @@ cfg_preprocess = {
     'flag_do_GLM_filter' : True, # CHANGE
 }
 
+cfg_threads = {
+    'n_threads' : None,     # BLAS threads of this process, None uses all cores (see module_threads)
+    }
+
+pfDAB_threads.configure( cfg_threads )
+
 #%% Load in data
 
 subDir = os.path.join(root_dir, f'sub-{subj}', 'nirs')
@@ -112,14 +120,13 @@ else:
 rec["od_corrected"] = rec["od"]    # need to reassign to new rec_str to work w/ code
 
 # Calculate GVTD on pruned data
-amp_masked = preproc.prune_mask_ts(rec['amp'], pruned_chans)  # use chs_pruned to get gvtd w/out pruned data (could also zscore in gvtd func)
-rec.aux_ts["gvtd"], _ = quality.gvtd(amp_masked) 
+rec.aux_ts["gvtd"] = qual.gvtd_od(rec['od'], pruned_chans)  # pruned channels are excluded from the gvtd
 
 
-lambda0 = amp_masked.wavelength[0].wavelength.values
-lambda1 = amp_masked.wavelength[1].wavelength.values
-snr0, _ = quality.snr(amp_masked.sel(wavelength=lambda0), cfg_preprocess['cfg_prune']['snr_thresh'])
-snr1, _ = quality.snr(amp_masked.sel(wavelength=lambda1), cfg_preprocess['cfg_prune']['snr_thresh'])
+snr, _ = quality.snr(rec['amp'], cfg_preprocess['cfg_prune']['snr_thresh'])
+snr = snr.where(~snr.channel.isin(pruned_chans))
+snr0 = snr.isel(wavelength=0)
+snr1 = snr.isel(wavelength=1)
 
 
 dqr.plotDQR( rec, chs_pruned, cfg_preprocess, run_nm, root_dir, stim_lst )
@@ -17,6 +17,10 @@ from sklearn.decomposition import PCA
 from cedalion.sigdecomp.ERBM import ERBM
 from cedalion.sigdecomp.ICA_EBM import ICA_EBM as EBM
 from scipy import stats
+from datetime import datetime
+
+import module_instrument as pfDAB_inst
+import module_measurement as pfDAB_meas
 
 
 
@@ -51,13 +55,13 @@ def ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsa
             # filter foo with ica_lpf and then downsample and stack it
             foo = cedalion.sigproc.frequency.freq_filter(foo, 0 * units.Hz, ica_lpf )
             foo = foo[:,:,::ica_downsample]
-            TS = foo.stack(measurement = ['channel', 'wavelength']).sortby('wavelength')
+            TS = pfDAB_meas.stack_measurement(foo)
 
             if flag_ICA_use_pruned_data:
                 S_pca_thresh, W_pca, num_components = ERBM_pca_step( TS, pca_var_thresh, flag_ICA_use_pruned_data )
             else:
                 amp = rec[subj_idx][file_idx]['amp'].mean('time') 
-                amp = amp.stack(measurement=['channel', 'wavelength']).sortby('wavelength').transpose()
+                amp = pfDAB_meas.stack_measurement(amp).transpose()
                 idx_amp = np.where(amp < cov_amp_thresh)[0] # list of channels with too low signal
                 idx_sat = np.where(chs_pruned_subjs[subj_idx][file_idx] == 0.0)[0] # list of saturated channels
                 n_chs = int(len(amp)//2)
@@ -94,12 +98,7 @@ def ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsa
 
                 new_xr = xr.zeros_like(TS)
                 new_xr.values = new_ts
-                new_xr = new_xr.unstack("measurement")
-
-                detector_coord = new_xr["detector"].data[:, 0]
-                new_xr = new_xr.assign_coords(detector=("channel", detector_coord))
-                source_coord = new_xr["source"].data[:, 0]
-                new_xr = new_xr.assign_coords(source=("channel", source_coord))
+                new_xr = pfDAB_meas.unstack_measurement(new_xr)   # source and detector come back along channel
 
                 new_xr = new_xr.transpose("channel", "wavelength", "time")
                 new_xr.time.attrs['units'] = 'second'
@@ -121,18 +120,13 @@ def ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsa
 
             if flag_calculate_ICA_matrix:
                 # ICA-ERBM on PCs
-                import time
-                from datetime import datetime
-                start_time = time.time()
-                if flag_ERBM_vs_EBM:
-                    print(f'   start calculating ICA ERBM matrix at {datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S")}')
-                    W_ica = ERBM(S_pca_thresh.T, p_ica )
-                else:
-                    print(f'   start calculating ICA EBM matrix at {datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S")}')
-                    W_ica = EBM(S_pca_thresh.T )
-                end_time = time.time()
-                execution_time = end_time - start_time
-                print( f"   ICA execution time: {execution_time/60:0.1f} minutes")
+                print(f'   start calculating ICA {"ERBM" if flag_ERBM_vs_EBM else "EBM"} matrix at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+                with pfDAB_inst.stage('ica', file=filenm, method='ERBM' if flag_ERBM_vs_EBM else 'EBM') as ica_stage:
+                    if flag_ERBM_vs_EBM:
+                        W_ica = ERBM(S_pca_thresh.T, p_ica )
+                    else:
+                        W_ica = EBM(S_pca_thresh.T )
+                print( f"   ICA execution time: {ica_stage['wall_s']/60:0.1f} minutes")
             
                 # Save W_ica to a file
                 file_path = os.path.join(rootDir_data, 'derivatives', 'ica', filenm )
@@ -212,6 +206,7 @@ def ERBM_run_ica( rec, filenm_lst, flag_ICA_use_pruned_data, ica_lpf, ica_downsa
 
 
 
+@pfDAB_inst.instrument('ica_pca')
 def ERBM_pca_step( TS, var_thresh = 0.99, flag_ICA_use_pruned_data = True ):
 
     ts_zscore = stats.zscore(TS.values, axis=0)
@@ -256,6 +251,7 @@ def ERBM_pca_step( TS, var_thresh = 0.99, flag_ICA_use_pruned_data = True ):
 
 
 
+@pfDAB_inst.instrument('ica_filter')
 def ERBM_ica_step( TS, stim, W_pca, W_ica, S_ica, trange_hrf, trange_hrf_stat, ica_spatial_mask_thresh, ica_tstat_thresh, stim_lst_hrf, flag_ICA_use_pruned_data = True  ):
 
     ts_mean = TS.mean('time') # needed for projecting back to channel space from PCA space
@@ -380,12 +376,7 @@ def ERBM_ica_step( TS, stim, W_pca, W_ica, S_ica, trange_hrf, trange_hrf_stat, i
 
     new_xr = xr.zeros_like(TS)
     new_xr.values = new_ts
-    new_xr = new_xr.unstack("measurement")
-
-    detector_coord = new_xr["detector"].data[:, 0]
-    new_xr = new_xr.assign_coords(detector=("channel", detector_coord))
-    source_coord = new_xr["source"].data[:, 0]
-    new_xr = new_xr.assign_coords(source=("channel", source_coord))
+    new_xr = pfDAB_meas.unstack_measurement(new_xr)   # source and detector come back along channel
 
     new_xr = new_xr.transpose("channel", "wavelength", "time")
     new_xr.time.attrs['units'] = 'second'
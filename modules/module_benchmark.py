@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory benchmarks of the pipeline stages on synthetic data.
+
+Every stage is benchmarked in isolation. A setup function prepares fresh inputs for each
+repetition (a deep copy of the synthetic recordings, so stages that modify rec in place
+start from the same state), then only the stage call itself is timed. The peak memory is
+measured in one extra repetition with tracemalloc, which tracks the numpy allocations,
+so that the tracing overhead does not end up in the timings.
+
+The results are written as a JSON report with sorted keys so that reports of different
+commits can be diffed directly or with compare_reports().
+"""
+
+import os
+import gc
+import copy
+import json
+import time
+import platform
+import tempfile
+import datetime
+import subprocess
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+import xarray as xr
+
+import cedalion
+from cedalion import units
+
+import module_synthetic_data as pfDAB_synth
+import module_threads as pfDAB_threads
+
+
+stage_lst = ['preprocess', 'pruneChannels', 'filterWalking', 'run_group_block_average', 'block_average_conc', 'do_image_recon', 'calc_dFC']
+
+cfg_benchmark_default = {
+    'stages' : stage_lst,
+    'n_repeat' : 3,
+    'n_subjects' : 3,           # recordings used by run_group_block_average
+    'cfg_synth' : {},           # overrides for module_synthetic_data.cfg_synth_default
+    'head_subdivisions' : 4,    # icosphere subdivisions of the synthetic brain and scalp
+    'n_clusters' : 10,          # time courses passed to calc_dFC
+    'seed' : 0,
+    }
+
+# the do_image_recon args of the worker processes of run_thread_benchmark
+_thread_job_args = None
+
+
+def run_benchmarks(cfg_benchmark = None):
+    '''
+    Run the benchmarks of the stages in cfg_benchmark['stages'] and return the report dict.
+
+    Stages that fail (e.g. because an optional dependency of the stage's module is not
+    installed) are reported with their error and do not stop the other stages.
+    '''
+    cfg_benchmark = {**cfg_benchmark_default, **(cfg_benchmark or {})}
+
+    for stage in cfg_benchmark['stages']:
+        if stage not in stage_lst:
+            raise ValueError(f"Unknown benchmark stage '{stage}'. Use some of {stage_lst}.")
+
+    print('Making the synthetic data')
+    data = get_benchmark_data(cfg_benchmark)
+
+    report = {
+        'meta' : get_report_meta(cfg_benchmark, data),
+        'stages' : {}
+        }
+
+    for stage in cfg_benchmark['stages']:
+        print(f'Benchmarking {stage}')
+        try:
+            setup_fn, stage_fn = _get_stage(stage, data, cfg_benchmark)
+            report['stages'][stage] = time_stage(setup_fn, stage_fn, cfg_benchmark['n_repeat'])
+        except Exception as e:
+            print(f'Error: benchmark of {stage} failed: {e}')
+            report['stages'][stage] = {'error' : f'{type(e).__name__}: {e}'}
+
+    return report
+
+
+def time_stage(setup_fn, stage_fn, n_repeat = 3):
+    '''
+    Time stage_fn(*setup_fn()) n_repeat times and measure its peak memory once.
+    Returns a dict with the wall times in s and the traced peak memory in MB.
+    '''
+    t_lst = []
+    for i_repeat in range(n_repeat):
+        args = setup_fn()
+        gc.collect()
+        t_start = time.perf_counter()
+        stage_fn(*args)
+        t_lst.append(time.perf_counter() - t_start)
+
+    args = setup_fn()
+    gc.collect()
+    tracemalloc.start()
+    stage_fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        'n_repeat' : n_repeat,
+        't_min' : float(np.min(t_lst)),
+        't_median' : float(np.median(t_lst)),
+        't_mean' : float(np.mean(t_lst)),
+        't_all' : [float(t) for t in t_lst],
+        'peak_mem_mb' : peak / 1024**2,
+        }
+
+    return result
+
+
+def get_benchmark_data(cfg_benchmark):
+    '''
+    Make the synthetic recordings, head and Adot used by the stages.
+    '''
+    seed = cfg_benchmark['seed']
+
+    rec_lst = [pfDAB_synth.make_synthetic_rec(cfg_benchmark['cfg_synth'], seed = seed + i_subj) for i_subj in range(cfg_benchmark['n_subjects'])]
+
+    head = pfDAB_synth.make_synthetic_head(cfg_benchmark['head_subdivisions'])
+    Adot = pfDAB_synth.make_synthetic_Adot(rec_lst[0], head, seed = seed)
+
+    rng = np.random.default_rng(seed)
+    t = rec_lst[0]['amp'].time.values
+    clusters = np.cumsum(rng.normal(0, 1, (cfg_benchmark['n_clusters'], len(t))), axis=1)
+
+    data = {
+        'rec_lst' : rec_lst,
+        'head' : head,
+        'Adot' : Adot,
+        'clusters' : clusters,
+        't' : t,
+        'root_dir' : tempfile.mkdtemp(prefix='benchmark_'),
+        }
+
+    return data
+
+
+def get_report_meta(cfg_benchmark, data):
+    '''
+    Describe the data, the environment and the commit the benchmarks were run on.
+    '''
+    rec = data['rec_lst'][0]
+
+    meta = {
+        'date' : datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit' : _get_git_commit(),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'numpy' : np.__version__,
+        'xarray' : xr.__version__,
+        'cedalion' : getattr(cedalion, '__version__', 'unknown'),
+        'cfg_benchmark' : cfg_benchmark,
+        'n_chs' : rec['amp'].sizes['channel'],
+        'n_t' : rec['amp'].sizes['time'],
+        'n_vertices' : data['Adot'].sizes['vertex'],
+        'n_cores' : pfDAB_threads.get_n_cores(),
+        'threads' : pfDAB_threads.get_thread_info(),
+        }
+
+    return meta
+
+
+def run_thread_benchmark(cfg_benchmark = None, data = None, n_cores = None, n_jobs = None):
+    '''
+    Find the best split of the n_cores cores into worker processes x BLAS threads per worker.
+
+    For every n_workers that divides n_cores, n_jobs image recons (the do_image_recon stage)
+    are run in n_workers processes with n_cores // n_workers BLAS threads each (see
+    module_threads.init_worker). Returns a dict with the wall time and the throughput of every
+    split and the best split, to be used as cfg_runner['n_workers'] and
+    cfg_runner['n_threads_per_worker'].
+    '''
+    cfg_benchmark = {**cfg_benchmark_default, **(cfg_benchmark or {})}
+    if n_cores is None:
+        n_cores = pfDAB_threads.get_n_cores()
+    if n_jobs is None:
+        n_jobs = max(n_cores, 2)
+    if data is None:
+        print('Making the synthetic data')
+        data = get_benchmark_data({**cfg_benchmark, 'n_subjects' : 1})
+
+    setup_fn, _ = _get_stage('do_image_recon', data, cfg_benchmark)
+    job_args = setup_fn()
+
+    # fork keeps the Adot of the parent, the other start methods pickle it once per worker
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+    result = {'n_cores' : n_cores, 'n_jobs' : n_jobs, 'splits' : {}}
+    for n_workers in [n for n in range(1, n_cores + 1) if n_cores % n == 0]:
+        n_threads = n_cores // n_workers
+        print(f'Benchmarking {n_workers} workers x {n_threads} threads')
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers = n_workers, mp_context = mp_context,
+                                                    initializer = _init_thread_worker, initargs = (n_threads, job_args)) as executor:
+            # start the workers (and load the BLAS) before the timing
+            list(executor.map(_run_thread_job, [False] * n_workers))
+
+            t_start = time.perf_counter()
+            list(executor.map(_run_thread_job, [True] * n_jobs))
+            t_wall = time.perf_counter() - t_start
+
+        result['splits'][f'{n_workers}x{n_threads}'] = {
+            'n_workers' : n_workers,
+            'n_threads_per_worker' : n_threads,
+            't_wall' : t_wall,
+            'jobs_per_s' : n_jobs / t_wall,
+            }
+
+    result['best'] = max(result['splits'], key = lambda split: result['splits'][split]['jobs_per_s'])
+
+    return result
+
+
+def _init_thread_worker(n_threads, job_args):
+    global _thread_job_args
+    pfDAB_threads.init_worker(n_threads)
+    _thread_job_args = job_args
+
+
+def _run_thread_job(flag_run):
+    import module_image_recon as pfDAB_img
+
+    if flag_run:
+        pfDAB_img.do_image_recon(_thread_job_args[0].copy(), *_thread_job_args[1:])
+
+    return
+
+
+def write_report(report, file_path):
+    '''
+    Write the benchmark report as JSON.
+    '''
+    dir_path = os.path.dirname(file_path)
+    if dir_path != '' and not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, sort_keys=True, default=str)
+
+    print(f'Benchmark report written to {file_path}')
+
+    return
+
+
+def compare_reports(file_path_base, file_path_new):
+    '''
+    Print the median time and peak memory of every stage of two reports side by side.
+    Returns a dict with the ratios new/base of the stages that ran in both reports.
+    '''
+    with open(file_path_base) as f:
+        report_base = json.load(f)
+    with open(file_path_new) as f:
+        report_new = json.load(f)
+
+    print(f"{'stage':<26}{'t base (s)':>12}{'t new (s)':>12}{'ratio':>8}{'mem base (MB)':>15}{'mem new (MB)':>14}{'ratio':>8}")
+
+    ratios = {}
+    for stage in report_base['stages']:
+        base = report_base['stages'][stage]
+        new = report_new['stages'].get(stage, {'error' : 'not run'})
+        if 'error' in base or 'error' in new:
+            print(f"{stage:<26}  skipped: {base.get('error', '')} {new.get('error', '')}")
+            continue
+
+        ratios[stage] = {
+            't_median' : new['t_median'] / base['t_median'],
+            'peak_mem_mb' : new['peak_mem_mb'] / base['peak_mem_mb'] if base['peak_mem_mb'] > 0 else np.nan,
+            }
+        print(f"{stage:<26}{base['t_median']:>12.3f}{new['t_median']:>12.3f}{ratios[stage]['t_median']:>8.2f}"
+              f"{base['peak_mem_mb']:>15.1f}{new['peak_mem_mb']:>14.1f}{ratios[stage]['peak_mem_mb']:>8.2f}")
+
+    return ratios
+
+
+#%% stages
+
+def _get_stage(stage, data, cfg_benchmark):
+    # returns (setup_fn, stage_fn). The modules are imported here so that a missing
+    # optional dependency only affects its own stage
+    if stage == 'preprocess':
+        import module_load_and_preprocess as pfDAB
+
+        setup_fn = lambda: (copy.deepcopy(data['rec_lst'][0]), 3)
+        stage_fn = pfDAB.preprocess
+
+    elif stage == 'pruneChannels':
+        import module_load_and_preprocess as pfDAB
+
+        setup_fn = lambda: (copy.deepcopy(data['rec_lst'][0]), _get_cfg_prune())
+        stage_fn = pfDAB.pruneChannels
+
+    elif stage == 'filterWalking':
+        import module_imu_glm_filter as pfDAB_imu
+
+        cfg_imu_glm = {
+            'hWin' : np.arange(-3, 5, 1),
+            'statesPerDataFrame' : {**pfDAB_synth.cfg_synth_default, **cfg_benchmark['cfg_synth']}['statesPerDataFrame'],
+            'n_components' : [3, 2],
+            'butter_order' : 4,
+            'Fc' : 0.1,
+            'plot_flag_imu' : False
+            }
+        setup_fn = lambda: (copy.deepcopy(data['rec_lst'][0]), 'od', cfg_imu_glm)
+        stage_fn = pfDAB_imu.filterWalking
+
+    elif stage == 'run_group_block_average':
+        import matplotlib
+        matplotlib.use('Agg')
+        import module_group_avg as pfDAB_grp_avg
+
+        cfg_dataset, cfg_blockavg = _get_cfg_group_avg(data)
+        chs_pruned_subjs = [[xr.DataArray(np.full(rec['amp'].sizes['channel'], 0.4), dims=['channel'], coords={'channel': rec['amp'].channel})] for rec in data['rec_lst']]
+
+        setup_fn = lambda: ([[copy.deepcopy(rec)] for rec in data['rec_lst']], 'od', chs_pruned_subjs, cfg_dataset, cfg_blockavg)
+        stage_fn = pfDAB_grp_avg.run_group_block_average
+
+    elif stage == 'block_average_conc':
+        import module_group_avg as pfDAB_grp_avg
+
+        # the subject block averages and their combination in concentration, i.e. with pint units
+        # (see module_units), without the plotting of run_group_block_average
+        cfg_dataset, cfg_blockavg = _get_cfg_group_avg(data)
+        cfg_mse = cfg_blockavg['cfg_mse_conc']
+        rec_lst = [copy.deepcopy(rec) for rec in data['rec_lst']]
+        for rec in rec_lst:
+            dpf = xr.DataArray([1, 1], dims='wavelength', coords={'wavelength': rec['amp'].wavelength})
+            rec['conc'] = cedalion.nirs.od2conc(rec['od'], rec.geo3d, dpf, spectrum='prahl').pint.to('micromolar')
+        chs_pruned_subjs = [xr.DataArray(np.full(rec['amp'].sizes['channel'], 0.4), dims=['channel'], coords={'channel': rec['amp'].channel}) for rec in rec_lst]
+
+        def stage_fn(rec_lst, chs_pruned_subjs):
+            subj_results = [pfDAB_grp_avg.get_subj_block_average([rec], 'conc', [chs_pruned], subj_id, [filenm_lst[0]], cfg_blockavg, cfg_mse)
+                            for rec, chs_pruned, subj_id, filenm_lst in zip(rec_lst, chs_pruned_subjs, cfg_dataset['subj_ids'], cfg_dataset['filenm_lst'])]
+            return pfDAB_grp_avg.combine_subj_block_averages(subj_results, cfg_dataset['subj_ids'], cfg_mse)
+
+        setup_fn = lambda: (rec_lst, chs_pruned_subjs)
+
+    elif stage == 'do_image_recon':
+        import module_image_recon as pfDAB_img
+
+        # a block average like (wavelength, channel) OD image
+        od = data['rec_lst'][0]['od'].mean('time').pint.dequantify().transpose('wavelength', 'channel')
+        wavelength = od.wavelength.values
+
+        setup_fn = lambda: (od.copy(), data['head'], data['Adot'], False, None, wavelength, False, True,
+                            False, None, 1e-3, 1e-2, None, None, None)
+        stage_fn = pfDAB_img.do_image_recon
+
+    elif stage == 'calc_dFC':
+        import module_functional_connectivity as pfDAB_fc
+
+        setup_fn = lambda: (data['clusters'], data['t'], 20)
+        stage_fn = pfDAB_fc.calc_dFC
+
+    return setup_fn, stage_fn
+
+
+def _get_cfg_prune():
+    cfg_prune = {
+        'snr_thresh' : 5,
+        'sd_threshs' : [1, 60]*units.mm,
+        'amp_threshs' : [1e-5, 0.84],
+        'perc_time_clean_thresh' : 0.6,
+        'sci_threshold' : 0.6,
+        'psp_threshold' : 0.1,
+        'window_length' : 5 * units.s,
+        'flag_use_sci' : True,
+        'flag_use_psp' : False
+        }
+    return cfg_prune
+
+
+def _get_cfg_group_avg(data):
+    n_subjects = len(data['rec_lst'])
+    subj_ids = [f'{i_subj+1:02d}' for i_subj in range(n_subjects)]
+
+    cfg_hrf = {
+        'stim_lst' : ['ST', 'DT'],
+        't_pre' : 5 * units.s,
+        't_post' : 20 * units.s
+        }
+
+    cfg_dataset = {
+        'root_dir' : data['root_dir'],
+        'subj_ids' : subj_ids,
+        'file_ids' : ['bench_run-01'],
+        'subj_id_exclude' : [],
+        'cfg_hrf' : cfg_hrf,
+        'filenm_lst' : [[f'sub-{subj_id}_task-bench_run-01_nirs'] for subj_id in subj_ids]
+        }
+
+    cfg_blockavg = {
+        'rec_str' : 'od',
+        'cfg_hrf' : cfg_hrf,
+        'trange_hrf_stat' : [5, 10],
+        'flag_save_each_subj' : False,
+        'cfg_mse_od' : {
+            'mse_val_for_bad_data' : 1e1,
+            'mse_amp_thresh' : 1.1e-6,
+            'mse_min_thresh' : 1e-6,
+            'blockaverage_val' : 0
+            },
+        'cfg_mse_conc' : {
+            'mse_val_for_bad_data' : 1e7 * units.micromolar**2,
+            'mse_amp_thresh' : 1.1e-6,
+            'mse_min_thresh' : 1e0 * units.micromolar**2,
+            'blockaverage_val' : 0 * units.micromolar
+            }
+        }
+
+    dir_dqr = os.path.join(data['root_dir'], 'derivatives', 'plots', 'DQR')
+    if not os.path.exists(dir_dqr):
+        os.makedirs(dir_dqr)
+
+    return cfg_dataset, cfg_blockavg
+
+
+def _get_git_commit():
+    try:
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
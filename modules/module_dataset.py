@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Container of the preprocessed recordings of a dataset, keyed by (subject, run).
+
+load_and_preprocess fills a dataset dict
+
+    dataset = {
+        'subj_ids' : ['538', '547'],            # subjects not in subj_id_exclude, in cfg_dataset order
+        'file_ids' : ['STS_run-01', 'STS_run-02'],
+        'subj_id_exclude' : ['549'],
+        'runs' : {subj_id : {file_id : run}},
+        }
+
+where every run is a dict with the recording and its QC summaries
+
+    run = {'rec', 'filenm', 'chs_pruned', 'slope_base', 'slope_corrected', 'gvtd_corrected', 'snr0', 'snr1'}
+
+Runs are added with add_run in any order (e.g. by parallel or cached loaders) and are always
+returned in the order of cfg_dataset. get_subj_lists gives the [subj_idx][file_idx] lists of
+the subjects not excluded that the group average, ICA and DQR functions take.
+"""
+
+
+run_keys = ['rec', 'filenm', 'chs_pruned', 'slope_base', 'slope_corrected', 'gvtd_corrected', 'snr0', 'snr1']
+
+
+def new_dataset( cfg_dataset ):
+    '''
+    Empty dataset of the subjects and files of cfg_dataset.
+    '''
+    subj_id_exclude = list(cfg_dataset.get('subj_id_exclude', []))
+
+    dataset = {
+        'subj_ids' : [s for s in cfg_dataset['subj_ids'] if s not in subj_id_exclude],
+        'file_ids' : list(cfg_dataset['file_ids']),
+        'subj_id_exclude' : subj_id_exclude,
+        'runs' : {},
+        }
+
+    return dataset
+
+
+def is_excluded( dataset, subj_id ):
+    '''
+    True if subj_id is in subj_id_exclude.
+    '''
+    return subj_id in dataset['subj_id_exclude']
+
+
+def add_run( dataset, subj_id, file_id, run ):
+    '''
+    Add (or replace) the run file_id of subject subj_id. run is a dict with the run_keys.
+    '''
+    if is_excluded( dataset, subj_id ):
+        raise ValueError(f'Subject {subj_id} is in subj_id_exclude')
+    if subj_id not in dataset['subj_ids']:
+        raise ValueError(f"Subject {subj_id} is not in the dataset subjects {dataset['subj_ids']}")
+    if file_id not in dataset['file_ids']:
+        raise ValueError(f"File {file_id} is not in the dataset files {dataset['file_ids']}")
+
+    missing = [key for key in run_keys if key not in run]
+    if len(missing) > 0:
+        raise ValueError(f'The run of subject {subj_id} file {file_id} has no {missing}')
+
+    dataset['runs'].setdefault(subj_id, {})[file_id] = run
+
+    return
+
+
+def get_run( dataset, subj_id, file_id ):
+    '''
+    The run file_id of subject subj_id, None if it has not been added.
+    '''
+    return dataset['runs'].get(subj_id, {}).get(file_id)
+
+
+def get_subj_runs( dataset, subj_id ):
+    '''
+    The runs of subject subj_id that have been added, in the order of file_ids.
+    '''
+    subj_runs = dataset['runs'].get(subj_id, {})
+    return [subj_runs[file_id] for file_id in dataset['file_ids'] if file_id in subj_runs]
+
+
+def iter_subjects( dataset ):
+    '''
+    Yield (subj_id, runs) of the subjects that have runs, in the order of subj_ids.
+    '''
+    for subj_id in dataset['subj_ids']:
+        subj_runs = get_subj_runs( dataset, subj_id )
+        if len(subj_runs) > 0:
+            yield subj_id, subj_runs
+
+
+def get_missing_runs( dataset ):
+    '''
+    The (subj_id, file_id) of the subjects not excluded that have not been added.
+    '''
+    return [(subj_id, file_id) for subj_id in dataset['subj_ids'] for file_id in dataset['file_ids']
+            if get_run( dataset, subj_id, file_id ) is None]
+
+
+def get_subj_lists( dataset, key ):
+    '''
+    The [subj_idx][file_idx] list of run[key] over the subjects that have runs, e.g.
+    get_subj_lists(dataset, 'rec') is the rec list of the pipelines.
+    '''
+    return [[run[key] for run in subj_runs] for _, subj_runs in iter_subjects( dataset )]
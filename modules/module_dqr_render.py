@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of the data quality report (DQR) figures outside of the preprocessing loop.
+
+The DQR plotting functions are split into a part that computes a compact metric bundle
+(a dict with SNR, variance, chs_pruned, GVTD, slopes, ...) and a part that renders that
+bundle to a PNG. This module decides what happens with the bundles:
+
+    'inline'       - render immediately in the current process (previous behaviour)
+    'background'   - render in a pool of worker processes using the Agg backend so that
+                     preprocessing does not block on figure I/O
+    'metrics_only' - do not render, only write the bundles to
+                     derivatives/plots/DQR/metrics so they can be rendered later with
+                     render_saved_metrics()
+
+Every bundle must have the keys 'type', 'filenm' and 'filepath'.
+"""
+
+import os
+import gzip
+import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+import module_threads as pfDAB_threads
+
+
+def start_renderer( cfg_dqr = None ):
+    '''
+    Create a DQR renderer from cfg_dqr = {'mode': 'inline' | 'background' | 'metrics_only', 'n_workers': int}.
+    If cfg_dqr is None the figures are rendered inline.
+    '''
+    if cfg_dqr is None:
+        cfg_dqr = {}
+
+    mode = cfg_dqr.get('mode', 'inline')
+    if mode not in ['inline', 'background', 'metrics_only']:
+        raise ValueError(f"Unknown DQR mode '{mode}'. Use 'inline', 'background' or 'metrics_only'.")
+
+    renderer = {'mode': mode, 'pool': None, 'futures': []}
+
+    if mode == 'background':
+        # fork is used when available so the (unguarded) pipeline scripts are not re-imported by the workers
+        if 'fork' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('fork')
+        else:
+            mp_context = multiprocessing.get_context()
+        renderer['pool'] = ProcessPoolExecutor( max_workers = cfg_dqr.get('n_workers', 2), mp_context = mp_context, initializer = _init_worker )
+
+    return renderer
+
+
+def submit( renderer, render_fn, dqr_metrics ):
+    '''
+    Hand a metric bundle to the renderer. render_fn is the module level function that
+    draws and saves the figure from the bundle, e.g. module_plot_DQR.plotDQR_metrics.
+    '''
+    if renderer is None or renderer['mode'] == 'inline':
+        render_fn( dqr_metrics )
+    elif renderer['mode'] == 'background':
+        renderer['futures'].append( (dqr_metrics['filenm'], dqr_metrics['type'], renderer['pool'].submit(render_fn, dqr_metrics)) )
+    else:
+        save_metrics( render_fn, dqr_metrics )
+
+    return
+
+
+def finish( renderer ):
+    '''
+    Wait for all the background figures to be written and shut down the worker pool.
+    Failed figures are reported but do not stop the pipeline.
+    '''
+    if renderer is None or renderer['pool'] is None:
+        return
+
+    for filenm, dqr_type, future in renderer['futures']:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error: DQR figure '{dqr_type}' for {filenm} failed: {e}")
+
+    renderer['pool'].shutdown()
+    renderer['pool'] = None
+    renderer['futures'] = []
+
+    return
+
+
+def save_metrics( render_fn, dqr_metrics ):
+    '''
+    Write a metric bundle together with its render function to derivatives/plots/DQR/metrics.
+    '''
+    der_dir = os.path.join(dqr_metrics['filepath'], 'derivatives', 'plots', 'DQR', 'metrics')
+    if not os.path.exists(der_dir):
+        os.makedirs(der_dir)
+
+    file_path = os.path.join(der_dir, dqr_metrics['filenm'] + '_' + dqr_metrics['type'] + '.pkl.gz')
+    with gzip.open(file_path, 'wb') as f:
+        pickle.dump( (render_fn, dqr_metrics), f, protocol=pickle.HIGHEST_PROTOCOL )
+
+    return
+
+
+def render_saved_metrics( filepath, cfg_dqr = None ):
+    '''
+    Render all the metric bundles that were saved in 'metrics_only' mode.
+    cfg_dqr can be used to render them in the background.
+    '''
+    der_dir = os.path.join(filepath, 'derivatives', 'plots', 'DQR', 'metrics')
+    if not os.path.exists(der_dir):
+        print(f"No saved DQR metrics found in {der_dir}")
+        return
+
+    cfg_dqr = dict(cfg_dqr or {})
+    if cfg_dqr.get('mode', 'inline') == 'metrics_only':
+        cfg_dqr['mode'] = 'inline'
+    renderer = start_renderer( cfg_dqr )
+
+    for file_nm in sorted(os.listdir(der_dir)):
+        if not file_nm.endswith('.pkl.gz'):
+            continue
+        with gzip.open(os.path.join(der_dir, file_nm), 'rb') as f:
+            render_fn, dqr_metrics = pickle.load(f)
+        submit( renderer, render_fn, dqr_metrics )
+
+    finish( renderer )
+
+    return
+
+
+def _init_worker():
+    # the workers only write files, never open windows, and need no BLAS threads
+    pfDAB_threads.init_worker(1)
+    matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as p
+    p.switch_backend('Agg')
@@ -18,8 +18,13 @@ import matplotlib.pyplot as p
 
 import pdb
 
+import module_instrument as pfDAB_inst
+import module_units as pfDAB_units
+import module_measurement as pfDAB_meas
 
 
+
+@pfDAB_inst.instrument('group_average')
 def run_group_block_average( rec, rec_str, chs_pruned_subjs, cfg_dataset, cfg_blockavg ):
     
     subj_ids_new = [s for s in cfg_dataset['subj_ids'] if s not in cfg_dataset['subj_id_exclude']]
@@ -30,197 +35,220 @@ def run_group_block_average( rec, rec_str, chs_pruned_subjs, cfg_dataset, cfg_bl
     ]
     
     # choose correct mse values based on if blockaveraging od or conc
-    if 'chromo' in rec[0][0][rec_str].dims:
-        cfg_mse = cfg_blockavg['cfg_mse_conc']
-    else:
-        cfg_mse = cfg_blockavg['cfg_mse_od']
-        
-    
-    mse_val_for_bad_data = cfg_mse['mse_val_for_bad_data']
-    mse_amp_thresh = cfg_mse['mse_amp_thresh']
-    mse_min_thresh = cfg_mse['mse_min_thresh']
-    blockaverage_val = cfg_mse['blockaverage_val']
+    cfg_mse = get_cfg_mse( rec[0][0], rec_str, cfg_blockavg )
 
-    subj_ids = cfg_dataset['subj_ids']
     n_subjects = len(rec)
-    n_files_per_subject = len(rec[0])
 
     print(f"Running group block average for trial_type = '{rec_str}'")
 
-    # loop over subjects and files
-    blockaverage_subj = None
+    # loop over subjects
+    subj_results = []
+    subj_ids_done = []
     for subj_idx in range( n_subjects ):
-        for file_idx in range( n_files_per_subject ):
+        print(f'Running {subj_idx+1} of {n_subjects} subjects not excluded : {new_filenm_lst[subj_idx][0]} ')
 
-            #filenm = cfg_dataset['filenm_lst'][subj_idx][file_idx]
-            #print( f"   Running {subj_idx+1} of {n_subjects} subjects : {filenm}" )
-            filenm = new_filenm_lst[subj_idx][file_idx]
-            print(f'Running {subj_idx+1} of {n_subjects} subjects not excluded : {filenm} ')
-            
-            # Check if rec_str exists for current subject
-            if rec_str not in rec[subj_idx][file_idx].timeseries:
-                print(f"{rec_str} does not exist for subject {subj_idx+1} : {filenm}. Skipping this subject/file.")
-                continue  # if rec_str does not exist, skip 
-            else:
-                ts = rec[subj_idx][file_idx][rec_str].copy()
-            
-            # select the stim for the given file
-            stim = rec[subj_idx][file_idx].stim.copy()
-                
-            # get the epochs
-            # check if ts has dimenstion chromo
-            if 'chromo' in ts.dims:
-                ts = ts.transpose('chromo', 'channel', 'time')
-            else:
-                ts = ts.transpose('wavelength', 'channel', 'time')
-            ts = ts.assign_coords(samples=('time', np.arange(len(ts.time))))
-            ts['time'] = ts.time.pint.quantify(units.s)     
+        subj_result = get_subj_block_average( rec[subj_idx], rec_str, chs_pruned_subjs[subj_idx], subj_ids_new[subj_idx], new_filenm_lst[subj_idx], cfg_blockavg, cfg_mse )
+        if subj_result is None:
+            continue
+        subj_results.append( subj_result )
+        subj_ids_done.append( subj_ids_new[subj_idx] )
+
+    blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted, blockaverage_subj, blockaverage_mse_subj, mse_mean_within_subject, mse_weighted_between_subjects = \
+        combine_subj_block_averages( subj_results, subj_ids_done, cfg_mse )
+
+    #%
+    # Plot scalp plot of mean, tstat,rsme + Plot mse hist
+    for idxt, trial_type in enumerate(blockaverage_mean_weighted.trial_type.values):         
+        plot_mean_stderr(rec, rec_str, trial_type, cfg_dataset, cfg_blockavg, blockaverage_mean_weighted, 
+                         blockaverage_stderr_weighted, mse_mean_within_subject, mse_weighted_between_subjects)
+        plot_mse_hist(rec, rec_str, trial_type, cfg_dataset, blockaverage_mse_subj, cfg_mse['mse_val_for_bad_data'], cfg_mse['mse_min_thresh'])  # !!! not sure if these r working correctly tbh
+    
+
+    return blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted, blockaverage_subj, blockaverage_mse_subj
+
+
+def get_cfg_mse( rec_file, rec_str, cfg_blockavg ):
+    '''
+    Return cfg_mse_conc if rec_str is a concentration time series and cfg_mse_od otherwise.
+    '''
+    if 'chromo' in rec_file[rec_str].dims:
+        return cfg_blockavg['cfg_mse_conc']
+    else:
+        return cfg_blockavg['cfg_mse_od']
+
+
+def get_subj_block_average( rec_subj, rec_str, chs_pruned_subj, subj_id, filenm_lst_subj, cfg_blockavg, cfg_mse ):
+    '''
+    Block average the files of one subject and get the MSE of the block average that is
+    used to weight the subject in the group average.
+
+    Returns a dict with
+        'blockaverage'          - the block average (trial_type, wavelength/chromo, channel, reltime)
+        'blockaverage_weighted' - the block average with the bad channels set to blockaverage_val
+        'mse_t'                 - the MSE of the block average with mse_min_thresh applied, the weights
+        'mse_t_o'               - the MSE of the block average without mse_min_thresh
+    or None if rec_str does not exist for any of the files.
+    The results of several subjects (e.g. from different shards) are combined with
+    combine_subj_block_averages.
+    '''
+    mse_amp_thresh = cfg_mse['mse_amp_thresh']
+
+    n_files_per_subject = len(rec_subj)
+
+    # the epochs and MSE are computed without units, see module_units
+    epochs_all = None
+    units_lst = []
+    flag_bad_chs = None
+    for file_idx in range( n_files_per_subject ):
+
+        filenm = filenm_lst_subj[file_idx]
+
+        # Check if rec_str exists for current subject
+        if rec_str not in rec_subj[file_idx].timeseries:
+            print(f"{rec_str} does not exist for subject {subj_id} : {filenm}. Skipping this subject/file.")
+            continue  # if rec_str does not exist, skip 
+        else:
+            ts, ts_units = pfDAB_units.strip_units( rec_subj[file_idx][rec_str] )
+            units_lst.append(ts_units)
+        
+        # bad channels of this file: amp < mse_amp_thresh and saturated channels (set to 0 in chs_pruned in preprocess func).
+        # The MSE is over the epochs of all files, so a channel bad in any of the files is bad
+        amp = rec_subj[file_idx]['amp'].mean('time').min('wavelength') # take the minimum across wavelengths
+        flag_bad_file = np.asarray(amp < mse_amp_thresh) | np.asarray(chs_pruned_subj[file_idx] == 0.0)
+        flag_bad_chs = flag_bad_file if flag_bad_chs is None else flag_bad_chs | flag_bad_file
+
+        # select the stim for the given file
+        stim = rec_subj[file_idx].stim.copy()
             
-            #
-            # block average
-            #
+        # get the epochs
+        # check if ts has dimenstion chromo
+        if 'chromo' in ts.dims:
+            ts = ts.transpose('chromo', 'channel', 'time')
+        else:
+            ts = ts.transpose('wavelength', 'channel', 'time')
+        ts = ts.assign_coords(samples=('time', np.arange(len(ts.time))))
+        ts['time'] = ts.time.pint.quantify(units.s)     
+        
+        #
+        # block average
+        #
+        with pfDAB_inst.stage('epoching', subj=subj_id, file=filenm):
             epochs_tmp = ts.cd.to_epochs(
                                         stim,  # stimulus dataframe
                                         set(stim[stim.trial_type.isin(cfg_blockavg['cfg_hrf']['stim_lst'])].trial_type), # select events
                                         before = cfg_blockavg['cfg_hrf']['t_pre'],  # seconds before stimulus
                                         after = cfg_blockavg['cfg_hrf']['t_post'],  # seconds after stimulus
                                     )
-            
-            # concatenate the different epochs from each file for each subject
-            if cfg_blockavg['flag_save_each_subj']:
-                epochs_tmp = epochs_tmp.assign_coords(trial_type=('epoch', [x + '-' + subj_ids_new[subj_idx] for x in epochs_tmp.trial_type.values]))
+        
+        # concatenate the different epochs from each file for each subject
+        if cfg_blockavg['flag_save_each_subj']:
+            epochs_tmp = epochs_tmp.assign_coords(trial_type=('epoch', [x + '-' + subj_id for x in epochs_tmp.trial_type.values]))
 
-            if file_idx == 0:
-                epochs_all = epochs_tmp
-            else:
-                epochs_all = xr.concat([epochs_all, epochs_tmp], dim='epoch')
+        if epochs_all is None:
+            epochs_all = epochs_tmp
+        else:
+            epochs_all = xr.concat([epochs_all, epochs_tmp], dim='epoch')
 
 
-            # DONE LOOP OVER FILES
+        # DONE LOOP OVER FILES
 
-        # Block Average
-        baseline = epochs_all.sel(reltime=(epochs_all.reltime < 0)).mean('reltime')
-        epochs = epochs_all - baseline
-        blockaverage = epochs.groupby('trial_type').mean('epoch') # mean across all epochs
+    if epochs_all is None:
+        return None
 
+    ts_units = pfDAB_units.get_common_units(units_lst)
+    mse_units = ts_units**2 if ts_units is not None else None
+    mse_val_for_bad_data = pfDAB_units.get_magnitude(cfg_mse['mse_val_for_bad_data'], mse_units)
+    mse_min_thresh = pfDAB_units.get_magnitude(cfg_mse['mse_min_thresh'], mse_units)
+    blockaverage_val = pfDAB_units.get_magnitude(cfg_mse['blockaverage_val'], ts_units)
 
-        # get MSE for weighting across subjects
-        
+    # Block Average
+    baseline = epochs_all.sel(reltime=(epochs_all.reltime < 0)).mean('reltime')
+    epochs = epochs_all - baseline
+    blockaverage = epochs.groupby('trial_type').mean('epoch') # mean across all epochs
 
-        blockaverage_weighted = blockaverage.copy()
-        n_epochs = epochs.shape[0]
-        n_chs = epochs.shape[2]
 
-        mse_t_lst = []
-        mse_t_o_lst = []
-        for idxt, trial_type in enumerate(blockaverage.trial_type.values): 
+    # get MSE for weighting across subjects
     
-            foo = epochs.where(epochs.trial_type == trial_type, drop=True) - blockaverage_weighted.sel(trial_type=trial_type) # zero mean data
-    
-            if 'chromo' in ts.dims:
-                foo_t = foo.stack(measurement=['channel','chromo']).sortby('chromo')
-            else:
-                foo_t = foo.stack(measurement=['channel','wavelength']).sortby('wavelength')
-            foo_t = foo_t.transpose('measurement', 'reltime', 'epoch')
-            mse_t = (foo_t**2).sum('epoch') / (n_epochs - 1)**2 # this is squared to get variance of the mean, aka MSE of the mean
-    
-    
-            # list of channel elements in mse corresponding to channels with amp < mse_amp_thresh
-            amp = rec[subj_idx][file_idx]['amp'].mean('time').min('wavelength') # take the minimum across wavelengths
-            idx_amp = np.where(amp < mse_amp_thresh)[0]
-            mse_t[idx_amp,:] = mse_val_for_bad_data
-            mse_t[idx_amp + n_chs,:] = mse_val_for_bad_data       # !!! make all this stuff a function? - bc repeating this
-            # Update bad data with predetermined value
-            bad_vals = blockaverage_weighted.isel(channel=idx_amp)
-            blockaverage_weighted.loc[dict(trial_type=trial_type, channel=bad_vals.channel.data)] = blockaverage_val
-            
-            
-            # look at saturated channels
-            idx_sat = np.where(chs_pruned_subjs[subj_idx][file_idx] == 0.0)[0]   # sat chans set to 0 in chs_pruned in preprocess func
-            mse_t[idx_sat,:] = mse_val_for_bad_data
-            mse_t[idx_sat + n_chs,:] = mse_val_for_bad_data
-            # Update bad data with predetermined value
-            bad_vals = blockaverage_weighted.isel(channel=idx_sat)
-            blockaverage_weighted.loc[dict(trial_type=trial_type, channel= bad_vals.channel.data)] = blockaverage_val
-            
+
+    n_epochs = epochs.shape[0]
+    meas_dim = 'chromo' if 'chromo' in ts.dims else 'wavelength'
+
+    # MSE of the mean of all trial types at once, epochs minus the block average of their trial type
+    foo = epochs.groupby('trial_type') - blockaverage # zero mean data
+    mse_t = (foo**2).groupby('trial_type').sum('epoch') / (n_epochs - 1)**2 # this is squared to get variance of the mean, aka MSE of the mean
+
+    # bad channels of all files, the same for all trial types
+    flag_bad_chs = xr.DataArray(flag_bad_chs, dims='channel')
+    mse_t = xr.where(flag_bad_chs, mse_val_for_bad_data, mse_t)
+
+    # where mse_t is 0, set it to mse_val_for_bad_data
+    # I am trying to handle those rare cases where the mse is 0 for some subjects and then it corrupts 1/mse
+    # FIXME: why does this happen sometimes?
+    flag_zero = (mse_t == 0).any('reltime')
+    mse_t = xr.where(flag_zero, mse_val_for_bad_data, mse_t).transpose('trial_type', meas_dim, 'channel', 'reltime')
+
+    # Update bad data with predetermined value
+    flag_bad_ba = flag_bad_chs | flag_zero.any(meas_dim)
+    blockaverage_weighted = xr.where(flag_bad_ba, blockaverage_val, blockaverage).transpose(*blockaverage.dims)
+    # FIXME: do I set blockaverage_weighted too?
+
+    mse_t = mse_t.assign_coords(source=('channel', blockaverage['source'].data), detector=('channel', blockaverage['detector'].data))
+
+    mse_t_o = mse_t.copy()
+    # making channels with very small variance across epochs "have less variance" 
+    mse_t = xr.where(mse_t < mse_min_thresh, mse_min_thresh, mse_t) # where true, yeild min_thres, otherwise yield orig val in mse_t
     
-            # where mse_t is 0, set it to mse_val_for_bad_data
-            # I am trying to handle those rare cases where the mse is 0 for some subjects and then it corrupts 1/mse
-            # FIXME: why does this happen sometimes?
-            idx_bad = np.where(mse_t == 0)[0]
-            idx_bad1 = idx_bad[idx_bad<n_chs]
-            idx_bad2 = idx_bad[idx_bad>=n_chs] - n_chs
-            mse_t[idx_bad] = mse_val_for_bad_data
-            # Update bad data with predetermined value
-            bad_vals = blockaverage_weighted.isel(channel=idx_bad1)
-            blockaverage_weighted.loc[dict(trial_type=trial_type, channel=bad_vals.channel.data)] = blockaverage_val
-            bad_vals = blockaverage_weighted.isel(channel=idx_bad2)
-            blockaverage_weighted.loc[dict(trial_type=trial_type, channel=bad_vals.channel.data)] = blockaverage_val
-            
-            
-            # FIXME: do I set blockaverage_weighted too?
-        
-            # set the minimum value of mse_t
-            if 'chromo' in ts.dims:
-                mse_t = mse_t.unstack('measurement').transpose('chromo','channel','reltime')
-            else:
-                mse_t = mse_t.unstack('measurement').transpose('wavelength','channel','reltime')
-                
-            mse_t = mse_t.expand_dims('trial_type')
-            source_coord = blockaverage['source']
-            mse_t = mse_t.assign_coords(source=('channel',source_coord.data))
-            detector_coord = blockaverage['detector']
-            mse_t = mse_t.assign_coords(detector=('channel',detector_coord.data))
-            
-            mse_t_o = mse_t.copy()
-            # making channels with very small variance across epochs "have less variance" 
-            mse_t = xr.where(mse_t < mse_min_thresh, mse_min_thresh, mse_t) # where true, yeild min_thres, otherwise yield orig val in mse_t
-            
-            mse_t = mse_t.assign_coords(trial_type = [trial_type]) # assign coords to match curr trial type
-            mse_t_o = mse_t_o.assign_coords(trial_type = [trial_type]) 
-            
-            mse_t_lst.append(mse_t) # append mse_t for curr trial type to list
-            mse_t_o_lst.append(mse_t_o)
-            
-            # DONE LOOP OVER TRIAL TYPES
-        
-        mse_t_tmp = xr.concat(mse_t_lst, dim='trial_type') # concat the 2 trial types
-        mse_t = mse_t_tmp # reassign the newly appended mse_t with both trial types to mse_t 
-        mse_t_o_tmp = xr.concat(mse_t_o_lst, dim='trial_type') 
-        mse_t_o = mse_t_o_tmp 
+    subj_result = {
+        'blockaverage' : pfDAB_units.attach_units(blockaverage, ts_units),
+        'blockaverage_weighted' : pfDAB_units.attach_units(blockaverage_weighted, ts_units),
+        'mse_t' : pfDAB_units.attach_units(mse_t, mse_units),
+        'mse_t_o' : pfDAB_units.attach_units(mse_t_o, mse_units),
+        }
+
+    return subj_result
+
+
+def combine_subj_block_averages( subj_results, subj_ids, cfg_mse ):
+    '''
+    Combine the block averages of get_subj_block_average into the unweighted and the MSE
+    weighted group average. subj_results and subj_ids are in the same order, the results are
+    the same whether the subjects were processed in one process or in shards.
+
+    Returns blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted,
+    blockaverage_subj, blockaverage_mse_subj, mse_mean_within_subject, mse_weighted_between_subjects
+    '''
+    # combine without units, see module_units
+    subj_results = [{key : pfDAB_units.strip_units(val) for key, val in subj_result.items()} for subj_result in subj_results]
+    ts_units = pfDAB_units.get_common_units([subj_result['blockaverage'][1] for subj_result in subj_results])
+    mse_units = ts_units**2 if ts_units is not None else None
+    mse_min_thresh = pfDAB_units.get_magnitude(cfg_mse['mse_min_thresh'], mse_units)
+
+    # gather the blockaverage across subjects
+    blockaverage_subj = None
+    for subj_id, subj_result in zip(subj_ids, subj_results):
+        blockaverage_subj_tmp = subj_result['blockaverage'][0].expand_dims('subj')
+        blockaverage_subj_tmp = blockaverage_subj_tmp.assign_coords(subj=[subj_id])
 
+        blockaverage_mse_subj_tmp = subj_result['mse_t_o'][0].expand_dims('subj') # mse of blockaverage for each sub
+        blockaverage_mse_subj_tmp = blockaverage_mse_subj_tmp.assign_coords(subj=[subj_id])
 
-        # gather the blockaverage across subjects
+        mse_t = subj_result['mse_t'][0]
         if blockaverage_subj is None: 
-            blockaverage_subj = blockaverage
-            # add a subject dimension and coordinate
-            blockaverage_subj = blockaverage_subj.expand_dims('subj')
-            blockaverage_subj = blockaverage_subj.assign_coords(subj=[subj_ids_new[subj_idx]])
-
-            blockaverage_mse_subj = mse_t_o.expand_dims('subj') # mse of blockaverage for each sub
-            blockaverage_mse_subj = blockaverage_mse_subj.assign_coords(subj=[subj_ids_new[subj_idx]])
+            blockaverage_subj = blockaverage_subj_tmp
+            blockaverage_mse_subj = blockaverage_mse_subj_tmp
             
-            blockaverage_mean_weighted = blockaverage_weighted / mse_t
+            blockaverage_mean_weighted = subj_result['blockaverage_weighted'][0] / mse_t
 
             blockaverage_mse_inv_mean_weighted = 1 / mse_t
             
         else:   
-            blockaverage_subj_tmp = blockaverage
-            blockaverage_subj_tmp = blockaverage_subj_tmp.expand_dims('subj')
-            blockaverage_subj_tmp = blockaverage_subj_tmp.assign_coords(subj=[subj_ids_new[subj_idx]])
             blockaverage_subj = xr.concat([blockaverage_subj, blockaverage_subj_tmp], dim='subj')
-
-            blockaverage_mse_subj_tmp = mse_t_o.expand_dims('subj')
-            
-            blockaverage_mse_subj_tmp = blockaverage_mse_subj_tmp.assign_coords(subj=[subj_ids_new[subj_idx]])
             blockaverage_mse_subj = xr.concat([blockaverage_mse_subj, blockaverage_mse_subj_tmp], dim='subj') # !!! this does not have trial types
 
-
-            blockaverage_mean_weighted += blockaverage_weighted / mse_t
+            blockaverage_mean_weighted += subj_result['blockaverage_weighted'][0] / mse_t
 
             blockaverage_mse_inv_mean_weighted = blockaverage_mse_inv_mean_weighted + 1/mse_t 
 
-        
         # DONE LOOP OVER SUBJECTS
 
     # get the unweighted average
@@ -244,19 +272,20 @@ def run_group_block_average( rec, rec_str, chs_pruned_subjs, cfg_dataset, cfg_bl
     blockaverage_stderr_weighted = np.sqrt( mse_mean_within_subject + mse_weighted_between_subjects )
     blockaverage_stderr_weighted = blockaverage_stderr_weighted.assign_coords(trial_type=blockaverage_mean_weighted.trial_type)
 
-    #%
-    # Plot scalp plot of mean, tstat,rsme + Plot mse hist
-    for idxt, trial_type in enumerate(blockaverage_mean_weighted.trial_type.values):         
-        plot_mean_stderr(rec, rec_str, trial_type, cfg_dataset, cfg_blockavg, blockaverage_mean_weighted, 
-                         blockaverage_stderr_weighted, mse_mean_within_subject, mse_weighted_between_subjects)
-        plot_mse_hist(rec, rec_str, trial_type, cfg_dataset, blockaverage_mse_subj, mse_val_for_bad_data, mse_min_thresh)  # !!! not sure if these r working correctly tbh
-    
+    blockaverage_mean = pfDAB_units.attach_units(blockaverage_mean, ts_units)
+    blockaverage_mean_weighted = pfDAB_units.attach_units(blockaverage_mean_weighted, ts_units)
+    blockaverage_stderr_weighted = pfDAB_units.attach_units(blockaverage_stderr_weighted, ts_units)
+    blockaverage_subj = pfDAB_units.attach_units(blockaverage_subj, ts_units)
+    blockaverage_mse_subj = pfDAB_units.attach_units(blockaverage_mse_subj, mse_units)
+    mse_mean_within_subject = pfDAB_units.attach_units(mse_mean_within_subject, mse_units)
+    mse_weighted_between_subjects = pfDAB_units.attach_units(mse_weighted_between_subjects, mse_units)
 
-    return blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted, blockaverage_subj, blockaverage_mse_subj
+    return blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted, blockaverage_subj, blockaverage_mse_subj, mse_mean_within_subject, mse_weighted_between_subjects
 
 
 #%% Plotting func
     
+@pfDAB_inst.instrument('plotting')
 def plot_mean_stderr(rec, rec_str, trial_type, cfg_dataset, cfg_blockavg, blockaverage_mean_weighted, blockaverage_stderr_weighted, mse_mean_within_subject, mse_weighted_between_subjects):
     # scalp_plot the mean, stderr and t-stat
     #######################################################
@@ -387,6 +416,7 @@ def plot_mean_stderr(rec, rec_str, trial_type, cfg_dataset, cfg_blockavg, blocka
         p.close()
 
 
+@pfDAB_inst.instrument('plotting')
 def plot_mse_hist(rec, rec_str, trial_type, cfg_dataset, blockaverage_mse_subj, mse_val_for_bad_data, mse_min_thresh):
     # plot the MSE histogram
     ########################################################
@@ -401,9 +431,9 @@ def plot_mse_hist(rec, rec_str, trial_type, cfg_dataset, blockaverage_mse_subj,
     foo = blockaverage_mse_subj_t.mean('reltime')
     
     if 'chromo' in rec[0][0][rec_str].dims:
-        foo = foo.stack(measurement=['channel','chromo']).sortby('chromo')
+        foo = pfDAB_meas.stack_measurement(foo, 'chromo')
     else:
-        foo = foo.stack(measurement=['channel','wavelength']).sortby('wavelength')
+        foo = pfDAB_meas.stack_measurement(foo)
     for i in range(n_subjects):
         ax1.semilogy(foo[i,:], linewidth=0.5,alpha=0.5)
     ax1.set_title('variance in the mean for all subjects')
@@ -559,8 +589,9 @@ def y_mean_to_conc( y_mean_tmp, geo3d, wavelength, source, cov_mean_weighted, cf
     idx_cov2 = idx_cov[idx_cov>=n_chs] - n_chs
     idx_cov = np.union1d(idx_cov1, idx_cov2)
 
-    foo_conc_tmp = foo_conc.copy()
-    foo_conc_tmp[:,:,idx_cov,:] = np.nan * np.ones(foo_conc[:,:,idx_cov,:].shape) * units.micromolar
+    foo_conc_tmp, conc_units = pfDAB_units.strip_units(foo_conc.copy())
+    foo_conc_tmp[:,:,idx_cov,:] = np.nan
+    foo_conc_tmp = pfDAB_units.attach_units(foo_conc_tmp, conc_units)
 
     return foo_conc, foo_conc_tmp
 
@@ -11,61 +11,96 @@ import os.path
 import pickle
 from cedalion.imagereco.solver import pseudo_inverse_stacked
 import cedalion.xrutils as xrutils
+import scipy.linalg
 
 import matplotlib.pyplot as p
 import pyvista as pv
 from matplotlib.colors import ListedColormap
 
 import gzip
+import weakref
 
 import sys
 
 import module_spatial_basis_funs_ced as sbf 
 import pdb
 
+import module_instrument as pfDAB_inst
+import module_measurement as pfDAB_meas
+
 #%% DATA LOADING
 
 def load_head_model(head_model='ICBM152', with_parcels=True):
     
+    if head_model == 'ICBM152':
+        PARCEL_DIR = datasets.get_icbm152_parcel_file() if with_parcels else None
+    elif head_model == 'colin27':
+        PARCEL_DIR = datasets.get_colin27_parcel_file() if with_parcels else None
+
+    head = get_head_model(head_model, with_parcels=with_parcels)
+    
+    return head, PARCEL_DIR
+
+
+# processed head models are cached here, see get_head_model
+head_model_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cedalion_dab_funcs', 'head_models')
+
+def get_head_model(head_model='ICBM152', with_parcels=True, smoothing=0.5, fill_holes=True, cache_dir=None):
+    ''' TwoSurfaceHeadModel built from the segmentation of head_model ('ICBM152' or 'colin27').
+
+    Building the head model reads the segmentation masks and surfaces and smooths and fills the
+    surfaces, which gives the same result every time. The processed head model (meshes, landmarks,
+    segmentation masks, transforms and parcel labels) is therefore pickled to
+    <cache_dir>/<head_model>_smoothing-<smoothing>_fill_holes-<fill_holes>_parcels-<with_parcels>.pkl.gz
+    the first time and read from there afterwards. Delete the file to rebuild it.
+    cache_dir defaults to head_model_cache_dir.
+    '''
+    if cache_dir is None:
+        cache_dir = head_model_cache_dir
+    file_path = os.path.join(cache_dir, f'{head_model}_smoothing-{smoothing}_fill_holes-{int(fill_holes)}_parcels-{int(with_parcels)}.pkl.gz')
+
+    if os.path.exists(file_path):
+        with gzip.open(file_path, 'rb') as f:
+            return pickle.load(f)
+
     if head_model == 'ICBM152':
         SEG_DATADIR, mask_files, landmarks_file = datasets.get_icbm152_segmentation()
-        if with_parcels:
-            PARCEL_DIR = datasets.get_icbm152_parcel_file()
-        else :
-            PARCEL_DIR = None
-            
+        PARCEL_DIR = datasets.get_icbm152_parcel_file() if with_parcels else None
     elif head_model == 'colin27':
         SEG_DATADIR, mask_files, landmarks_file = datasets.get_colin27_segmentation()()
-        if with_parcels:
-            PARCEL_DIR = datasets.get_colin27_parcel_file()
-        else :
-            PARCEL_DIR = None
-            
-    masks, t_ijk2ras = io.read_segmentation_masks(SEG_DATADIR, mask_files)
+        PARCEL_DIR = datasets.get_colin27_parcel_file() if with_parcels else None
+    else:
+        raise ValueError(f"Unknown head model '{head_model}', use 'ICBM152' or 'colin27'")
 
-    
     head = fw.TwoSurfaceHeadModel.from_surfaces(
         segmentation_dir=SEG_DATADIR,
         mask_files = mask_files,
         brain_surface_file= os.path.join(SEG_DATADIR, "mask_brain.obj"),
         scalp_surface_file= os.path.join(SEG_DATADIR, "mask_scalp.obj"),
         landmarks_ras_file=landmarks_file,
-        smoothing=0.5,
-        fill_holes=True,
+        smoothing=smoothing,
+        fill_holes=fill_holes,
         parcel_file=PARCEL_DIR
     ) 
     head.scalp.units = units.mm
-    # head.scalp.vertices = head.scalp.vertices * units.mm
     head.brain.units = units.mm
-    # head.brain.vertices = head.brain.vertices * units.mm
-    
-    return head, PARCEL_DIR
+
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with gzip.open(file_path + '.tmp', 'wb', compresslevel=1) as f:
+            pickle.dump(head, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file_path + '.tmp', file_path)
+        print(f'Saved the head model to {file_path}')
+    except OSError as e:
+        print(f'Could not cache the head model in {cache_dir} ({e})')
+
+    return head
 
 
 def load_probe(probe_path, snirf_name ='fullhead_56x144_System2_4NN.snirf', head_model='ICBM152'):
         
-    with open(os.path.join(probe_path, 'fw',  head_model, 'Adot_wParcels.pkl'), 'rb') as f:
-        Adot = pickle.load(f)
+    Adot = read_Adot(os.path.join(probe_path, 'fw',  head_model, 'Adot_wParcels.pkl'))
         
     recordings = io.read_snirf(probe_path + snirf_name)
     rec = recordings[0]
@@ -76,37 +111,190 @@ def load_probe(probe_path, snirf_name ='fullhead_56x144_System2_4NN.snirf', head
     return Adot, meas_list, geo3d, amp
 
 
+def read_Adot(file_path, flag_mmap=True):
+    ''' Read the sensitivity profile Adot_wParcels.pkl.
+
+    With flag_mmap the data is memory mapped from the .npy file next to the pickle (written by
+    save_Adot_mmap on the first call, or again when the pickle is newer), so Adot is paged in as
+    it is used and processes reading the same file share the pages. The memory mapped Adot is
+    read only.
+    '''
+    if not flag_mmap:
+        with open(file_path, 'rb') as f:
+            return pickle.load(f)
+
+    file_path_npy, file_path_coords = _get_Adot_mmap_paths(file_path)
+    flag_current = os.path.exists(file_path_npy) and os.path.exists(file_path_coords) and \
+                   (not os.path.exists(file_path) or os.path.getmtime(file_path_coords) >= os.path.getmtime(file_path))
+
+    if not flag_current:
+        with open(file_path, 'rb') as f:
+            Adot = pickle.load(f)
+        try:
+            save_Adot_mmap(Adot, file_path)
+        except OSError as e:
+            print(f'Could not write the memory mapped Adot next to {file_path} ({e}), using the pickle')
+            return Adot
+        print(f'Wrote the memory mapped Adot to {file_path_npy}')
+
+    with open(file_path_coords, 'rb') as f:
+        meta = pickle.load(f)
+
+    Adot = xr.DataArray(np.load(file_path_npy, mmap_mode='r'), dims=meta['dims'], coords=meta['coords'],
+                        attrs=meta['attrs'], name=meta['name'])
+    if meta['flag_quantified']:
+        Adot = Adot.pint.quantify()
+
+    return Adot
+
+
+def save_Adot_mmap(Adot, file_path):
+    ''' Write Adot as a .npy file that can be memory mapped and its dims, coords (parcel, is_brain, ...)
+    and attrs as <name>_coords.pkl, next to file_path (the Adot_wParcels.pkl path).
+    '''
+    file_path_npy, file_path_coords = _get_Adot_mmap_paths(file_path)
+
+    flag_quantified = Adot.pint.units is not None
+    Adot = Adot.pint.dequantify()   # the units go to attrs
+    meta = {'dims' : Adot.dims,
+            'coords' : {name : (coord.dims, coord.values, coord.attrs) for name, coord in Adot.coords.items()},
+            'attrs' : Adot.attrs,
+            'name' : Adot.name,
+            'flag_quantified' : flag_quantified}
+
+    # data first, the coords file marks a complete write
+    with open(file_path_npy + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(Adot.values))
+    os.replace(file_path_npy + '.tmp', file_path_npy)
+    with open(file_path_coords + '.tmp', 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_path_coords + '.tmp', file_path_coords)
+
+    return
+
+
+def _get_Adot_mmap_paths(file_path):
+    file_base = os.path.splitext(file_path)[0]
+    return file_base + '.npy', file_base + '_coords.pkl'
+
 
 #%% MATRIX CALCULATIONS
 
 def get_Adot_scaled(Adot, wavelengths, BRAIN_ONLY=False):
     
-    if BRAIN_ONLY:
-        Adot = Adot[:, Adot.is_brain.values, :] 
+    return get_Adot_stacked(get_sensitivity_operator(Adot, wavelengths), BRAIN_ONLY=BRAIN_ONLY)
+
 
-    nchannel = Adot.shape[0]
-    nvertices = Adot.shape[1]
-    E = nirs.get_extinction_coefficients('prahl', Adot.wavelength)
+# stacked sensitivity operators, keyed by id(Adot) and the wavelengths and dropped when Adot is garbage collected
+_sensitivity_operator_cache = {}
+
+def get_sensitivity_operator(Adot, wavelengths):
+    ''' Extinction scaled, stacked sensitivity matrix of Adot, built once per Adot and cached for
+    as long as Adot exists. Pruned and BRAIN_ONLY versions are taken from it with get_Adot_stacked.
+
+    The matrix is twice the size of Adot. For a memory mapped Adot (read_Adot) it is written once
+    as <Adot>_operator_<wavelengths>.npy next to the Adot .npy and memory mapped too, so processes
+    using the same Adot share its pages instead of each holding a private copy. Otherwise it is
+    kept in the memory of the process.
+
+    Outputs:
+        operator : dict with
+            'A' : read only (2*nchannel, 2*nvertices) array, rows are the channels within wavelength
+                  and columns the vertices within chromo, i.e. [[E_HbO(wl1) Adot(wl1), E_HbR(wl1) Adot(wl1)],
+                                                                [E_HbO(wl2) Adot(wl2), E_HbR(wl2) Adot(wl2)]]
+            'nchannel', 'nvertices', 'parcel', 'is_brain'
+    '''
+    key = (id(Adot), tuple(np.asarray(wavelengths).tolist()))
+    if key in _sensitivity_operator_cache:
+        return _sensitivity_operator_cache[key]
+
+    nchannel = Adot.sizes['channel']
+    nvertices = Adot.sizes['vertex']
+
+    file_path_npy = _get_Adot_mmap_file(Adot)
+    A = None
+    if file_path_npy is not None:
+        file_path_op = os.path.splitext(file_path_npy)[0] + '_operator_' + '-'.join(str(wl) for wl in key[1]) + '.npy'
+        if not (os.path.exists(file_path_op) and os.path.getmtime(file_path_op) >= os.path.getmtime(file_path_npy)):
+            try:
+                with open(file_path_op + '.tmp', 'wb') as f:
+                    np.save(f, _get_operator_matrix(Adot, wavelengths))
+                os.replace(file_path_op + '.tmp', file_path_op)
+            except OSError as e:
+                print(f'Could not write the memory mapped sensitivity operator {file_path_op} ({e}), keeping it in memory')
+                file_path_op = None
+        if file_path_op is not None:
+            A = np.load(file_path_op, mmap_mode='r')
+
+    if A is None:
+        A = _get_operator_matrix(Adot, wavelengths)
+        A.flags.writeable = False   # shared by all reconstructions with this Adot
+
+    operator = {'A' : A,
+                'nchannel' : nchannel,
+                'nvertices' : nvertices,
+                'parcel' : Adot.coords['parcel'].values if 'parcel' in Adot.coords else None,
+                'is_brain' : Adot.coords['is_brain'].values}
+    _sensitivity_operator_cache[key] = operator
+    weakref.finalize(Adot, _sensitivity_operator_cache.pop, key, None)
+
+    return operator
+
+
+def _get_operator_matrix(Adot, wavelengths):
+    # (wavelength, channel, chromo, vertex) -> (wavelength*channel, chromo*vertex), one allocation
+    E = nirs.get_extinction_coefficients('prahl', Adot.wavelength).pint.dequantify()
+    E = E.sel(wavelength=list(wavelengths), chromo=['HbO', 'HbR']).transpose('wavelength', 'chromo').values
+    Adot_vals = Adot.sel(wavelength=list(wavelengths)).pint.dequantify().transpose('wavelength', 'channel', 'vertex').values
+
+    nchannel = Adot_vals.shape[1]
+    nvertices = Adot_vals.shape[2]
+    return (E[:, np.newaxis, :, np.newaxis] * Adot_vals[:, :, np.newaxis, :]).reshape(2 * nchannel, 2 * nvertices)
+
+
+def _get_Adot_mmap_file(Adot):
+    # the .npy file of an Adot from read_Adot, None if Adot is not (all of) a memory mapped file
+    data = Adot.data.magnitude if hasattr(Adot.data, 'magnitude') else Adot.data
+    if not isinstance(data, np.memmap) or data.filename is None or not os.path.exists(data.filename):
+        return None
+    data_file = np.load(data.filename, mmap_mode='r')
+    if data.shape != data_file.shape or data.strides != data_file.strides or data.offset != data_file.offset:
+        return None
+    return data.filename
+
+
+def get_Adot_stacked(operator, pruning_mask=None, BRAIN_ONLY=False):
+    ''' Stacked sensitivity matrix of the channels in pruning_mask (all if None) and the brain
+    vertices if BRAIN_ONLY, taken from a get_sensitivity_operator without rescaling Adot.
+    Without pruning and BRAIN_ONLY the cached matrix itself is returned (read only, not copied).
+    A pruned or BRAIN_ONLY matrix is a copy of the selected rows / columns (numpy can not
+    take them as a view), i.e. as large as the subset.
+    '''
+    A = operator['A']
+    rows = None if pruning_mask is None else np.tile(np.asarray(pruning_mask, dtype=bool), 2)
+    cols = np.tile(operator['is_brain'], 2) if BRAIN_ONLY else None
 
-    A = np.zeros((2 * nchannel, 2 * nvertices))
-    wl1 = wavelengths[0]
-    wl2 = wavelengths[1]
-    A[:nchannel, :nvertices] = E.sel(chromo="HbO", wavelength=wl1).values * Adot.sel(wavelength=wl1) # noqa: E501
-    A[:nchannel, nvertices:] = E.sel(chromo="HbR", wavelength=wl1).values * Adot.sel(wavelength=wl1) # noqa: E501
-    A[nchannel:, :nvertices] = E.sel(chromo="HbO", wavelength=wl2).values * Adot.sel(wavelength=wl2) # noqa: E501
-    A[nchannel:, nvertices:] = E.sel(chromo="HbR", wavelength=wl2).values * Adot.sel(wavelength=wl2) # noqa: E501
+    if rows is not None and cols is not None:
+        A = A[np.ix_(rows, cols)]
+    elif rows is not None:
+        A = A[rows]
+    elif cols is not None:
+        A = A[:, cols]
 
     A = xr.DataArray(A, dims=("flat_channel", "flat_vertex"))
-    A = A.assign_coords({"parcel" : ("flat_vertex", np.concatenate((Adot.coords['parcel'].values, Adot.coords['parcel'].values))),
-                         "is_brain" : ("flat_vertex", np.concatenate((Adot.coords['is_brain'].values, Adot.coords['is_brain'].values)))})
+    is_brain = operator['is_brain'][operator['is_brain']] if BRAIN_ONLY else operator['is_brain']
+    if operator['parcel'] is not None:
+        parcel = operator['parcel'][operator['is_brain']] if BRAIN_ONLY else operator['parcel']
+        A = A.assign_coords({"parcel" : ("flat_vertex", np.tile(parcel, 2))})
+    A = A.assign_coords({"is_brain" : ("flat_vertex", np.tile(is_brain, 2))})
     
     return A
 
+@pfDAB_inst.instrument('W_build')
 def calculate_W(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY = False, DIRECT=True, C_meas_flag=False, C_meas=None, D=None, F=None):
     
     
     if DIRECT:
-        C_meas = np.diag(C_meas)
         W_xr, D, F = _calculate_W_direct(A, alpha_meas=alpha_meas, alpha_spatial=alpha_spatial, 
                                         BRAIN_ONLY=BRAIN_ONLY, 
                                         C_meas_flag=C_meas_flag, C_meas=C_meas, D=D, F=F)
@@ -153,10 +341,8 @@ def _calculate_W_direct(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY=False,
             
         lambda_meas = alpha_meas * max(np.diag(F))
         
-        if C_meas_flag:                                                               
-            W = D @ np.linalg.inv(F  + lambda_meas * C_meas )
-        else:
-            W = D @ np.linalg.inv(F  + lambda_meas * np.eye(A.shape[0]) )
+        # W = D inv(F + lambda_meas C_meas), C_meas is the identity without C_meas_flag
+        W = _solve_W(D, F, lambda_meas, C_meas if C_meas_flag else None)
         
         W_xr = xr.DataArray(W, dims=("flat_vertex", "flat_channel"))
         D_xr = xr.DataArray(D, dims=("flat_vertex", "flat_channel"))
@@ -178,6 +364,50 @@ def _calculate_W_direct(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY=False,
 def _calculate_W_indirect(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY=False, 
                        C_meas_flag=False, C_meas=None, D=None, F=None):
     
+    if BRAIN_ONLY:
+        return _calculate_W_indirect_loop(A, alpha_meas=alpha_meas, alpha_spatial=alpha_spatial, BRAIN_ONLY=BRAIN_ONLY,
+                                          C_meas_flag=C_meas_flag, C_meas=C_meas, D=D, F=F)
+
+    # all wavelengths at once, stacked along the leading axis
+    A_coords = A.coords
+    wavelength = A.wavelength
+    A = A.transpose('wavelength', 'channel', 'vertex').pint.dequantify().values
+
+    if D is None and F is None:
+        B = np.sum((A ** 2), axis=1)                                # (wavelength, vertex)
+        lambda_spatial = alpha_spatial * B.max(axis=1, keepdims=True)
+        Linv = 1/np.sqrt(B + lambda_spatial)
+
+        A_hat = A * Linv[:, np.newaxis, :]
+        F = A_hat @ A_hat.transpose(0, 2, 1)                        # (wavelength, channel, channel)
+        D = Linv[:, :, np.newaxis]**2 * A.transpose(0, 2, 1)        # (wavelength, vertex, channel)
+    else:
+        D = D.transpose('wavelength', 'flat_vertex', 'flat_channel').values
+        F = F.transpose('wavelength', 'flat_channel1', 'flat_channel2').values
+
+    lambda_meas = alpha_meas * np.diagonal(F, axis1=1, axis2=2).max(axis=1)
+
+    M = np.array(F, dtype=float)
+    for i_wav, wl in enumerate(wavelength.values):
+        _add_C_meas(M[i_wav], get_C_meas_wl(C_meas, wl, wavelength.values) if C_meas_flag else None, lambda_meas[i_wav])
+    # W = D inv(M), M is symmetric
+    W = np.linalg.solve(M, D.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+    coords = {'wavelength' : wavelength}
+    if 'parcel' in A_coords:
+        coords['parcel'] = ('flat_vertex', A_coords['parcel'].values)
+    if 'is_brain' in A_coords:
+        coords['is_brain'] = ('flat_vertex', A_coords['is_brain'].values)
+
+    W_xr = xr.DataArray(W, dims=('wavelength', 'flat_vertex', 'flat_channel'), coords=coords)
+    D_xr = xr.DataArray(D, dims=('wavelength', 'flat_vertex', 'flat_channel'), coords=coords)
+    F_xr = xr.DataArray(F, dims=('wavelength', 'flat_channel1', 'flat_channel2'), coords={'wavelength' : wavelength})
+
+    return W_xr, D_xr, F_xr
+
+def _calculate_W_indirect_loop(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY=False, 
+                       C_meas_flag=False, C_meas=None, D=None, F=None):
+    
     
     W = []
     D_lst = []
@@ -185,8 +415,7 @@ def _calculate_W_indirect(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY=Fals
     for wavelength in A.wavelength:
         
         if C_meas_flag:
-            C_meas_wl = C_meas.sel(wavelength=wavelength)
-            C_meas_wl = np.diag(C_meas_wl)
+            C_meas_wl = get_C_meas_wl(C_meas, wavelength.item(), A.wavelength.values)
         else:
             C_meas_wl = None
             
@@ -215,7 +444,135 @@ def _calculate_W_indirect(A, alpha_meas=0.1, alpha_spatial=0.01, BRAIN_ONLY=Fals
 
     return W_xr, D, F
 
+
+#%% measurement covariance
+#
+# C_meas is the variance of every measurement (stacked as channel within wavelength, see
+# do_image_recon), a dense (n_measurement, n_measurement) covariance, or a structured covariance
+# from get_C_meas_cov. The structured one is never expanded to a dense matrix other than inside
+# F + lambda_meas C_meas, which has the size of F anyway.
+
+def get_C_meas_cov(C_diag, blocks=None, U=None):
+    ''' Structured measurement covariance
+    
+        C = blockdiag(blocks) + U U.T     if blocks are given
+        C = diag(C_diag) + U U.T          otherwise
+
+    Inputs:
+        C_diag : variance of every measurement, DataArray over measurement stacked as in do_image_recon
+        blocks : None or one (nchannel, nchannel) covariance per wavelength, in the stacking order
+        U : None or (n_measurement, rank) low rank factor, e.g. the loadings of short channel / systemic noise
+
+    Outputs:
+        C_meas : dict with 'diag' (C_diag or the diagonal of the blocks), 'blocks' and 'U'
+    '''
+    n_meas = C_diag.shape[0]
+    C_diag = C_diag.copy()
+
+    if blocks is not None:
+        blocks = [np.asarray(block, dtype=float) for block in blocks]
+        if sum(block.shape[0] for block in blocks) != n_meas or any(block.shape[0] != block.shape[1] for block in blocks):
+            raise ValueError(f'The blocks of C_meas must be square and cover the {n_meas} measurements')
+        C_diag.values = np.concatenate([np.diag(block) for block in blocks])
+
+    if U is not None:
+        U = np.asarray(U, dtype=float)
+        if U.ndim != 2 or U.shape[0] != n_meas:
+            raise ValueError(f'U of C_meas must be ({n_meas}, rank), not {U.shape}')
+
+    return {'diag' : C_diag, 'blocks' : blocks, 'U' : U}
+
+
+def get_C_meas_wl(C_meas, wavelength, wavelengths=None):
+    ''' The part of C_meas of one wavelength, for the indirect reconstruction. A dense C_meas has
+    no wavelength coords, its blocks are taken in the (sorted) order of wavelengths.
+    '''
+    if not isinstance(C_meas, dict):
+        if len(C_meas.shape) == 1:
+            return C_meas.sel(wavelength=wavelength)
+
+        if wavelengths is None:
+            raise ValueError('The wavelengths are needed to split a dense C_meas')
+        C_vals = C_meas.values if isinstance(C_meas, xr.DataArray) else np.asarray(C_meas)
+        wavelengths = np.unique(wavelengths)
+        n_chs = C_vals.shape[0] // len(wavelengths)
+        i_wl = list(wavelengths).index(wavelength)
+        return C_vals[i_wl * n_chs:(i_wl + 1) * n_chs, i_wl * n_chs:(i_wl + 1) * n_chs]
+
+    flag_wl = C_meas['diag'].wavelength.values == wavelength
+    i_wl = list(np.unique(C_meas['diag'].wavelength.values)).index(wavelength)
+
+    return {'diag' : C_meas['diag'].sel(wavelength=wavelength),
+            'blocks' : None if C_meas['blocks'] is None else [C_meas['blocks'][i_wl]],
+            'U' : None if C_meas['U'] is None else C_meas['U'][flag_wl]}
+
+
+def set_C_meas_bad(C_meas, idx_meas, mse_val_for_bad_data):
+    ''' Set the variance of the measurements idx_meas to mse_val_for_bad_data and remove their
+    covariances with the other measurements. Changes C_meas in place.
+    '''
+    if isinstance(C_meas, dict):
+        C_meas['diag'][idx_meas] = mse_val_for_bad_data
+        if C_meas['blocks'] is not None:
+            offset = 0
+            for block in C_meas['blocks']:
+                idx_block = idx_meas[(idx_meas >= offset) & (idx_meas < offset + block.shape[0])] - offset
+                block[idx_block, :] = 0
+                block[:, idx_block] = 0
+                block[idx_block, idx_block] = mse_val_for_bad_data
+                offset += block.shape[0]
+        if C_meas['U'] is not None:
+            C_meas['U'][idx_meas, :] = 0
+    elif len(C_meas.shape) == 2:
+        # through the ndarray, xarray indexes C_meas[idx, idx] as the outer (idx x idx) block
+        C_vals = C_meas.values if isinstance(C_meas, xr.DataArray) else C_meas
+        C_vals[idx_meas, :] = 0
+        C_vals[:, idx_meas] = 0
+        C_vals[idx_meas, idx_meas] = mse_val_for_bad_data
+    else:
+        C_meas[idx_meas] = mse_val_for_bad_data
+
+    return
+
+
+def _add_C_meas(M, C_meas, scale):
+    # M += scale * C_meas in place, without making C_meas dense
+    idx_diag = np.diag_indices(M.shape[0])
+    if C_meas is None:
+        M[idx_diag] += scale
+    elif isinstance(C_meas, dict):
+        if C_meas['blocks'] is None:
+            M[idx_diag] += scale * np.asarray(C_meas['diag'].values)
+        else:
+            offset = 0
+            for block in C_meas['blocks']:
+                M[offset:offset + block.shape[0], offset:offset + block.shape[0]] += scale * block
+                offset += block.shape[0]
+        if C_meas['U'] is not None:
+            M += scale * (C_meas['U'] @ C_meas['U'].T)
+    else:
+        C_vals = C_meas.values if isinstance(C_meas, xr.DataArray) else np.asarray(C_meas)
+        if C_vals.ndim == 2:
+            M += scale * C_vals
+        else:
+            M[idx_diag] += scale * C_vals
+
+    return M
+
+
+def _solve_W(D, F, lambda_meas, C_meas):
+    # W = D inv(F + lambda_meas C_meas), with a Cholesky solve as F + lambda_meas C_meas is positive definite
+    M = _add_C_meas(np.array(F, dtype=float), C_meas, lambda_meas)
+    try:
+        W = scipy.linalg.cho_solve(scipy.linalg.cho_factor(M), D.T).T
+    except np.linalg.LinAlgError:
+        W = D @ np.linalg.inv(M)
+
+    return W
+
+
 #%% do image recon
+@pfDAB_inst.instrument('reconstruction')
 def _get_image_brain_scalp_direct(y, W, A, SB=False, G=None):
     
     X = W.values @ y.values
@@ -257,30 +614,52 @@ def _get_image_brain_scalp_direct(y, W, A, SB=False, G=None):
     return X
 
 
+_einv_cache = {}
+
+def get_einv(wavelength, spectrum='prahl'):
+    ''' Inverse of the extinction coefficients as a plain (chromo, wavelength) array and its units '''
+    key = (tuple(np.asarray(wavelength, dtype=float)), spectrum)
+    if key not in _einv_cache:
+        E = nirs.get_extinction_coefficients(spectrum, wavelength)
+        einv = xrutils.pinv(E).transpose('chromo', 'wavelength')
+        _einv_cache[key] = (np.ascontiguousarray(einv.pint.dequantify().values), einv.pint.units, einv.chromo.values)
+    return _einv_cache[key]
+
+
+def _get_image_indirect(Y, W, SB=False, G=None):
+    ''' Per wavelength images of Y (measurement, ...) converted to concentration, without units.
+    Returns the (chromo, vertex, ...) values and their units.
+    '''
+    W_vals = W.values
+    n_wav, _, n_chs = W_vals.shape
+
+    # (wavelength, channel, n) -> (wavelength, vertex, n), one batched product
+    Y_wl = Y.reshape(n_wav, n_chs, -1)
+    X_od = W_vals @ Y_wl
+
+    if SB:
+        # kernels along the leading axis for all wavelengths and columns at once
+        n_kernels, n_cols = X_od.shape[1], X_od.shape[2]
+        X_od = sbf.go_from_kernel_space_to_image_space_indirect(X_od.transpose(1, 0, 2).reshape(n_kernels, -1), G)
+        X_od = X_od.reshape(-1, n_wav, n_cols).transpose(1, 0, 2)
+
+    # convert to concentration with the 2x2 inverse of the extinction coefficients
+    einv, einv_units, _ = get_einv(W.wavelength.values)
+    X = np.tensordot(einv, X_od, axes=(1, 0))                        # (chromo, vertex, n)
+
+    return X.reshape(X.shape[:2] + Y.shape[1:]), einv_units / units.mm
+
+
+@pfDAB_inst.instrument('reconstruction')
 def _get_image_brain_scalp_indirect(y, W, A, SB=False, G=None):
     
-     split = len(y)//2
-                  
-     W_indirect_wl0 = W.isel(wavelength=0)
-     W_indirect_wl1 = W.isel(wavelength=1)
-     
-     y_wl0 = y[:split]
-     X_wl0 = W_indirect_wl0.values @ y_wl0.values
-   
-     y_wl1 = y[split:]
-     X_wl1 = W_indirect_wl1.values @ y_wl1.values
-             
-     if SB:
-         X_wl0 = sbf.go_from_kernel_space_to_image_space_indirect(X_wl0, G)
-         X_wl1 = sbf.go_from_kernel_space_to_image_space_indirect(X_wl1, G)
-         
-         
-     X_od = np.vstack([X_wl0, X_wl1]).T
-     
-     if len(X_od.shape) == 2:
-         X_od = xr.DataArray(X_od, 
-                          dims = ('vertex', 'wavelength'),
-                          coords = {'wavelength': W.wavelength}
+     X, X_units = _get_image_indirect(y.transpose('measurement', ...).pint.dequantify().values, W, SB=SB, G=G)
+     _, _, chromo = get_einv(W.wavelength.values)
+
+     if X.ndim == 2:
+         X = xr.DataArray(X, 
+                          dims = ('chromo', 'vertex'),
+                          coords = {'chromo': chromo}
                           )
      else:
          if 'time' in y.dims:
@@ -289,24 +668,20 @@ def _get_image_brain_scalp_indirect(y, W, A, SB=False, G=None):
          elif 'reltime' in y.dims:
              t = y.reltime
              t_name = 'reltime'
-         X_od = xr.DataArray(X_od, 
-                          dims = ('vertex', 'wavelength', t_name),
-                          coords = {'wavelength': W.wavelength,
+         X = xr.DataArray(X, 
+                          dims = ('chromo', 'vertex', t_name),
+                          coords = {'chromo': chromo,
                                     t_name: t},
                           )
 
      if 'parcel' in A.coords:
-        X_od = X_od.assign_coords({"parcel" : ("vertex", A.coords['parcel'].values)})
+        X = X.assign_coords({"parcel" : ("vertex", A.coords['parcel'].values)})
                               
      if 'is_brain' in A.coords:
-        X_od = X_od.assign_coords({"is_brain": ("vertex", A.coords['is_brain'].values)}) 
-
-
-     # convert to concentration 
-     E = nirs.get_extinction_coefficients('prahl', W.wavelength)
-     einv = xrutils.pinv(E) #FIXME check units
+        X = X.assign_coords({"is_brain": ("vertex", A.coords['is_brain'].values)}) 
 
-     X = xr.dot(einv, X_od/units.mm, dims=["wavelength"])
+     # units only at the end, see _get_image_indirect
+     X = X.pint.quantify(X_units)
      
      return X
 
@@ -327,9 +702,9 @@ def do_image_recon(od, head, Adot, C_meas_flag, C_meas, wavelength, BRAIN_ONLY,
             Adot_pruned = Adot[pruning_mask.values, :, :]
         
         if len(od.dims) ==2:
-            od_mag_pruned = od[:,pruning_mask.values].stack(measurement=('channel', 'wavelength')).sortby('wavelength')    
+            od_mag_pruned = pfDAB_meas.stack_measurement(od[:,pruning_mask.values])    
         else:
-            od_mag_pruned = od[:,pruning_mask.values,:].stack(measurement=('channel', 'wavelength')).sortby('wavelength')    
+            od_mag_pruned = pfDAB_meas.stack_measurement(od[:,pruning_mask.values,:])    
 
         # od_mag = hrf_od.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
         # od_mag_pruned = od_mag.dropna('measurement')
@@ -340,7 +715,7 @@ def do_image_recon(od, head, Adot, C_meas_flag, C_meas, wavelength, BRAIN_ONLY,
         else:
             Adot_pruned = Adot
             
-        od_mag_pruned = od.stack(measurement=('channel', 'wavelength')).sortby('wavelength')    
+        od_mag_pruned = pfDAB_meas.stack_measurement(od).copy()   # the pruned channels are set to 0 below, don't change od
         n_chs = od.channel.size
         if od_mag_pruned.dims == 2:
             od_mag_pruned[:,np.where(~pruning_mask.values)[0]] = 0
@@ -350,13 +725,13 @@ def do_image_recon(od, head, Adot, C_meas_flag, C_meas, wavelength, BRAIN_ONLY,
             od_mag_pruned[np.where(~pruning_mask.values)[0]+n_chs] = 0
 
         mse_val_for_bad_data = 1e1  # FIXME: this should be passed here and to group_avg
-        # FIXME: I assume C_meas is 1D. If it is 2D then I need to do this to the columns and rows
-        C_meas[np.where(~pruning_mask.values)[0]] = mse_val_for_bad_data
-        C_meas[np.where(~pruning_mask.values)[0] + n_chs] = mse_val_for_bad_data
+        idx_pruned = np.where(~pruning_mask.values)[0]
+        set_C_meas_bad(C_meas, np.concatenate((idx_pruned, idx_pruned + n_chs)), mse_val_for_bad_data)
 
     
     if DIRECT:
-        Adot_stacked = get_Adot_scaled(Adot_pruned, wavelength)
+        Adot_stacked = get_Adot_stacked(get_sensitivity_operator(Adot, wavelength),
+                                        pruning_mask.values if C_meas is None else None, BRAIN_ONLY)
         
         if SB:
             if G is None:
@@ -394,14 +769,231 @@ def do_image_recon(od, head, Adot, C_meas_flag, C_meas, wavelength, BRAIN_ONLY,
       
             
     return X, W, D, F, G
-    
 
+
+def do_image_recon_batch(od, head, Adot, C_meas, wavelength, BRAIN_ONLY, DIRECT,
+                         SB, cfg_sbf, alpha_spatial, alpha_meas, D=None, F=None, G=None, C_meas_flag=True):
+    ''' Image reconstruction of many HRF magnitudes at once, e.g. all subjects and trial types.
+
+    The items (all dims of od other than wavelength and channel) are grouped by their pruning
+    mask (no C_meas) or by their C_meas, so every group shares one W. W is built once per
+    group and the group is reconstructed with a single matrix product. Gives the same images
+    as calling do_image_recon for every item.
+
+    Inputs:
+        od : HRF magnitudes in OD, e.g. (subj, trial_type, wavelength, channel). NaN channels are pruned
+        C_meas : None or the measurement variance of every item stacked as in do_image_recon,
+                 e.g. (subj, trial_type, measurement). Only diagonal C_meas, use do_image_recon
+                 for a get_C_meas_cov
+        C_meas_flag : as in do_image_recon. If False, C_meas only sets the pruned channels to bad
+                 values (nothing is pruned) and W, which is then the same for all groups, is built once
+        other inputs as in do_image_recon. D and F (and G) are used for all groups when given
+
+    Outputs:
+        X : image cube, e.g. (subj, trial_type, vertex, chromo)
+        recon : dict with 'group' (group index of every item) and per group lists of 'W', 'D',
+                'F', 'G' and 'C_meas' (with the pruned channels set to bad values as in do_image_recon)
+    '''
+    item_dims = [dim for dim in od.dims if dim not in ['wavelength', 'channel']]
+    if len(item_dims) == 0:
+        raise ValueError('od has no dims besides wavelength and channel, use do_image_recon')
+    if isinstance(C_meas, dict):
+        raise ValueError('do_image_recon_batch only supports a diagonal C_meas, use do_image_recon')
+
+    od_items = od.stack(item=item_dims).transpose('item', 'wavelength', 'channel').sortby('wavelength')
+    od_vals = od_items.pint.dequantify().values.copy()
+    n_items, n_wav, n_chs = od_vals.shape
+
+    # same pruning as do_image_recon, a channel is pruned if it is NaN at either wavelength
+    pruning_mask = ~np.isnan(od_vals).any(axis=1)
+
+    if C_meas is not None:
+        # don't prune, set the pruned channels to bad values in C_meas instead
+        mse_val_for_bad_data = 1e1  # FIXME: this should be passed here and to group_avg
+        C_items = C_meas.stack(item=item_dims).transpose('item', 'measurement').copy()
+        C_vals = C_items.values
+        for i_item in range(n_items):
+            idx_pruned = np.where(~pruning_mask[i_item])[0]
+            od_vals[i_item, :, idx_pruned] = 0
+            C_vals[i_item, idx_pruned] = mse_val_for_bad_data
+            C_vals[i_item, idx_pruned + n_chs] = mse_val_for_bad_data
+        C_items.values = C_vals
+        group_keys = [C_vals[i_item].tobytes() for i_item in range(n_items)]
+    else:
+        C_items = None
+        group_keys = [pruning_mask[i_item].tobytes() for i_item in range(n_items)]
+
+    # items with the same key share W
+    groups = {}
+    for i_item, key in enumerate(group_keys):
+        groups.setdefault(key, []).append(i_item)
+
+    Adot_img = Adot[:, Adot.is_brain.values, :] if BRAIN_ONLY else Adot
+    n_vertex = Adot_img.sizes['vertex']
+    operator = get_sensitivity_operator(Adot, wavelength) if DIRECT else None
+
+    X_vals = np.zeros((n_items, n_vertex, 2))
+    X_units = None
+    group_idx = np.zeros(n_items, dtype=int)
+    recon = {'W' : [], 'D' : [], 'F' : [], 'G' : [], 'C_meas' : []}
+
+    for i_group, idx_items in enumerate(groups.values()):
+        group_idx[idx_items] = i_group
+        mask = pruning_mask[idx_items[0]] if C_meas is None else np.ones(n_chs, dtype=bool)
+        Adot_pruned = Adot_img[mask, :, :] if C_meas is None else Adot_img
+        C_group = C_items.isel(item=idx_items[0]).drop_vars(item_dims + ['item'], errors='ignore') if C_meas is not None else None
+
+        # (measurement, item) with the measurements stacked as channel within wavelength
+        Y = od_vals[idx_items][:, :, mask].reshape(len(idx_items), -1).T
+
+        # with C_meas nothing is pruned so D and F are the same for all groups
+        D_group = D if (D is not None or C_meas is None or i_group == 0) else recon['D'][0]
+        F_group = F if (F is not None or C_meas is None or i_group == 0) else recon['F'][0]
+
+        # without C_meas_flag W does not depend on C_meas, so all groups share the W of the first
+        flag_W_shared = C_meas is not None and not C_meas_flag and i_group > 0
+
+        G_group = G if not flag_W_shared else recon['G'][0]
+        if SB and G_group is None:
+            M = sbf.get_sensitivity_mask(Adot_pruned, cfg_sbf['mask_threshold'], 1)
+            G_group = sbf.get_G_matrix(head, M, threshold_brain=cfg_sbf['threshold_brain'],
+                                         threshold_scalp = cfg_sbf['threshold_scalp'],
+                                         sigma_brain=cfg_sbf['sigma_brain'],
+                                         sigma_scalp=cfg_sbf['sigma_scalp'])
+
+        if DIRECT:
+            if flag_W_shared:
+                W = recon['W'][0]
+            else:
+                A = get_Adot_stacked(operator, mask if C_meas is None else None, BRAIN_ONLY)
+                if SB:
+                    A = sbf.get_H_stacked(G_group, A)
+                W, D_group, F_group = calculate_W(A, alpha_meas=alpha_meas, alpha_spatial=alpha_spatial,
+                                                  C_meas_flag=C_meas is not None and C_meas_flag, C_meas=C_group, DIRECT=DIRECT, BRAIN_ONLY=BRAIN_ONLY, D=D_group, F=F_group)
+
+            with pfDAB_inst.stage('reconstruction'):
+                X = W.values @ Y
+                if SB:
+                    X = sbf.go_from_kernel_space_to_image_space_direct(X, G_group)   # (vertex, item, chromo)
+                    X = X.transpose(1, 0, 2)
+                else:
+                    X = X.reshape(2, -1, len(idx_items)).transpose(2, 1, 0)          # (item, vertex, chromo)
+
+        else:
+            if flag_W_shared:
+                W = recon['W'][0]
+            else:
+                A = sbf.get_H(G_group, Adot_pruned) if SB else Adot_pruned
+                W, D_group, F_group = calculate_W(A, alpha_meas=alpha_meas, alpha_spatial=alpha_spatial,
+                                                  C_meas_flag=C_meas is not None and C_meas_flag, C_meas=C_group, DIRECT=DIRECT, BRAIN_ONLY=BRAIN_ONLY, D=D_group, F=F_group)
+
+            with pfDAB_inst.stage('reconstruction'):
+                X, X_units = _get_image_indirect(Y, W, SB=SB, G=G_group)   # (chromo, vertex, item)
+                X = X.transpose(2, 1, 0)
+
+        X_vals[idx_items] = X
+
+        recon['W'].append(W)
+        recon['D'].append(D_group)
+        recon['F'].append(F_group)
+        recon['G'].append(G_group)
+        recon['C_meas'].append(C_group)
+
+    item_coords = xr.Coordinates.from_pandas_multiindex(od_items.indexes['item'], 'item')
+    X = xr.DataArray(X_vals, dims=('item', 'vertex', 'chromo'), coords={'chromo': ['HbO', 'HbR']}).assign_coords(item_coords)
+    if 'parcel' in Adot_img.coords:
+        X = X.assign_coords({"parcel" : ("vertex", Adot_img.coords['parcel'].values)})
+    if 'is_brain' in Adot_img.coords:
+        X = X.assign_coords({"is_brain": ("vertex", Adot_img.coords['is_brain'].values)})
+    if X_units is not None:
+        X = X.pint.quantify(X_units)   # the indirect images carry units as in _get_image_brain_scalp_indirect
+    X = X.unstack('item').transpose(*item_dims, 'vertex', 'chromo')
+
+    group = xr.DataArray(group_idx, dims='item').assign_coords(item_coords).unstack('item')
+    recon['group'] = group
+    if C_items is not None:
+        recon['C_meas_items'] = C_items.unstack('item').transpose(*item_dims, 'measurement')
+
+    print(f'Reconstructed {n_items} images with {len(groups)} W')
+
+    return X, recon
+
+
+# W**2 of the W's in use, keyed by id(W) and dropped when W is garbage collected
+_W_squared_cache = {}
+
+def get_W_squared(W):
+    ''' W**2 with NaN set to 0, computed once per W and cached for as long as W exists, so all
+    images reconstructed with the same W share it. Don't change W in place after calling this.
+    '''
+    key = id(W)
+    if key not in _W_squared_cache:
+        W_vals = W.values if isinstance(W, xr.DataArray) else np.asarray(W)
+        _W_squared_cache[key] = np.nan_to_num(W_vals**2, nan=0.0)
+        weakref.finalize(W, _W_squared_cache.pop, key, None)
+
+    return _W_squared_cache[key]
+
+
+def get_image_variance(W, C_meas):
+    ''' Diagonal of the image covariance W C_meas W.T.
+
+    For a diagonal C_meas this is np.nansum((W * np.sqrt(C_meas))**2, axis=1) but uses the cached
+    W**2 (get_W_squared), so each call is a single matrix-vector product. A get_C_meas_cov adds
+    sum((W_b @ B) * W_b) per block B and sum((W @ U)**2) for the low rank part, a dense C_meas
+    is sum((W @ C) * W).
+
+    Inputs:
+        W : pseudo inverse, (flat_vertex, flat_channel) for DIRECT or (wavelength, flat_vertex, flat_channel)
+        C_meas : measurement variance stacked as in do_image_recon (channel within wavelength) or a get_C_meas_cov
+
+    Outputs:
+        cov_img_diag : (flat_vertex,) for DIRECT or (wavelength, flat_vertex)
+    '''
+    if not isinstance(C_meas, dict) and len(C_meas.shape) == 2:
+        if W.ndim == 3:
+            return np.stack([get_image_variance(W.sel(wavelength=wavelength), get_C_meas_wl(C_meas, wavelength, W.wavelength.values))
+                             for wavelength in W.wavelength.values])
+
+        W_vals = np.nan_to_num(np.asarray(W.values if isinstance(W, xr.DataArray) else W), nan=0.0)
+        C_vals = C_meas.values if isinstance(C_meas, xr.DataArray) else np.asarray(C_meas)
+        return np.einsum('vc,vc->v', W_vals @ np.nan_to_num(C_vals, nan=0.0), W_vals)
+
+    if not isinstance(C_meas, dict):
+        W_squared = get_W_squared(W)
+        if W_squared.ndim == 2:
+            C_vals = C_meas.values if isinstance(C_meas, xr.DataArray) else np.asarray(C_meas)
+            return W_squared @ np.nan_to_num(C_vals, nan=0.0)
+
+        C_vals = np.stack([C_meas.sel(wavelength=wavelength).values for wavelength in W.wavelength.values])
+        return np.einsum('wvc,wc->wv', W_squared, np.nan_to_num(C_vals, nan=0.0))
+
+    if W.ndim == 3:
+        return np.stack([get_image_variance(W.sel(wavelength=wavelength), get_C_meas_wl(C_meas, wavelength))
+                         for wavelength in W.wavelength.values])
+
+    W_vals = np.nan_to_num(np.asarray(W.values if isinstance(W, xr.DataArray) else W), nan=0.0)
+    if C_meas['blocks'] is None:
+        cov_img_diag = get_W_squared(W) @ np.nan_to_num(C_meas['diag'].values, nan=0.0)
+    else:
+        cov_img_diag = np.zeros(W_vals.shape[0])
+        offset = 0
+        for block in C_meas['blocks']:
+            W_b = W_vals[:, offset:offset + block.shape[0]]
+            cov_img_diag += np.einsum('vc,vc->v', W_b @ block, W_b)
+            offset += block.shape[0]
+    if C_meas['U'] is not None:
+        cov_img_diag = cov_img_diag + np.sum((W_vals @ C_meas['U'])**2, axis=1)
+
+    return cov_img_diag
+
+
+@pfDAB_inst.instrument('image_noise')
 def get_image_noise(C_meas, X, W, SB=False, DIRECT=True, G=None):
     
+    cov_img_diag = get_image_variance(W, C_meas)   # diag of W C W.T
+
     if DIRECT:
-        cov_img_tmp = W *np.sqrt(C_meas.values) # W is pseudo inverse  --- diagonal (faster than W C W.T)
-        cov_img_diag = np.nansum(cov_img_tmp**2, axis=1)
-        
         if SB:
             cov_img_diag = sbf.go_from_kernel_space_to_image_space_direct(cov_img_diag, G)
         else:
@@ -410,21 +1002,9 @@ def get_image_noise(C_meas, X, W, SB=False, DIRECT=True, G=None):
         
 
     else:
-        cov_img_lst = []
+        if SB:
+            cov_img_diag = np.vstack([sbf.go_from_kernel_space_to_image_space_indirect(cov_img_wl, G) for cov_img_wl in cov_img_diag])
 
-        for wavelength in W.wavelength:
-            W_wl = W.sel(wavelength=wavelength)
-            C_wl = C_meas.sel(wavelength=wavelength)
-            
-            cov_img_tmp = W_wl * np.sqrt(C_wl.values) # get diag of image covariance
-            cov_img_diag = np.nansum(cov_img_tmp**2, axis=1)
-            
-            if SB:
-                cov_img_diag = sbf.go_from_kernel_space_to_image_space_indirect(cov_img_diag, G)
-            
-            cov_img_lst.append(cov_img_diag)
-            
-        cov_img_diag =  np.vstack(cov_img_lst) 
         E = nirs.get_extinction_coefficients('prahl', W.wavelength)
         einv = xrutils.pinv(E)
         
@@ -449,29 +1029,11 @@ def load_Adot( path_to_dataset = None, head_model = 'ICBM152' ):
     # with open(os.path.join(path_to_dataset, 'derivatives', 'fw',  head_model, 'Adot_wParcels.pkl'), 'rb') as f:
     #     Adot = pickle.load(f)
     
-    file_path = os.path.join(path_to_dataset, head_model, 'Adot_wParcels.pkl')
-    with open(file_path, 'rb') as f:
-        Adot = pickle.load(f) 
+    # memory mapped, see read_Adot
+    Adot = read_Adot(os.path.join(path_to_dataset, head_model, 'Adot_wParcels.pkl'))
         
     #% LOAD HEAD MODEL 
-    if head_model == 'ICBM152':
-        SEG_DATADIR, mask_files, landmarks_file = datasets.get_icbm152_segmentation()
-    elif head_model == 'colin27':
-        SEG_DATADIR, mask_files, landmarks_file = datasets.get_colin27_segmentation()()
-
-    masks, t_ijk2ras = io.read_segmentation_masks(SEG_DATADIR, mask_files)
-
-    head = fw.TwoSurfaceHeadModel.from_surfaces(
-        segmentation_dir=SEG_DATADIR,
-        mask_files = mask_files,
-        brain_surface_file= os.path.join(SEG_DATADIR, "mask_brain.obj"),
-        scalp_surface_file= os.path.join(SEG_DATADIR, "mask_scalp.obj"),
-        landmarks_ras_file=landmarks_file,
-        smoothing=0.5,
-        fill_holes=True,
-    ) 
-    head.scalp.units = units.mm
-    head.brain.units = units.mm
+    head = get_head_model(head_model, with_parcels=False)
 
     return Adot, head
 
@@ -508,9 +1070,9 @@ def do_image_recon_DB( hrf_od = None, head = None, Adot = None, C_meas = None, w
         pdb.set_trace()
         # !!! fixed the assumption that hrf_od was always a time a series.... is this ok tho
         if len(hrf_od.dims) == 2: # if nto a time series
-            od_mag_pruned = hrf_od[:,pruning_mask.values].stack(measurement=('channel', 'wavelength')).sortby('wavelength')
+            od_mag_pruned = pfDAB_meas.stack_measurement(hrf_od[:,pruning_mask.values])
         else:   # it is a time series
-            od_mag_pruned = hrf_od[:,pruning_mask.values,:].stack(measurement=('channel', 'wavelength')).sortby('wavelength')   
+            od_mag_pruned = pfDAB_meas.stack_measurement(hrf_od[:,pruning_mask.values,:])   
         
         
         # od_mag = hrf_od.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
@@ -523,7 +1085,7 @@ def do_image_recon_DB( hrf_od = None, head = None, Adot = None, C_meas = None, w
         else:
             Adot_pruned = Adot
             
-        od_mag_pruned = hrf_od.stack(measurement=('channel', 'wavelength')).sortby('wavelength')    
+        od_mag_pruned = pfDAB_meas.stack_measurement(hrf_od).copy()   # the pruned channels are set to 0 below, don't change hrf_od
         n_chs = hrf_od.channel.size
         if od_mag_pruned.dims == 2:
             od_mag_pruned[:,np.where(~pruning_mask.values)[0]] = 0
@@ -533,29 +1095,18 @@ def do_image_recon_DB( hrf_od = None, head = None, Adot = None, C_meas = None, w
             od_mag_pruned[np.where(~pruning_mask.values)[0]+n_chs] = 0
 
         mse_val_for_bad_data = 1e1  # FIXME: this should be passed here nad to group_avg
-        # FIXME: I assume C_meas is 1D. If it is 2D then I need to do this to the columns and rows
-        C_meas[np.where(~pruning_mask.values)[0]] = mse_val_for_bad_data
-        C_meas[np.where(~pruning_mask.values)[0] + n_chs] = mse_val_for_bad_data
+        idx_pruned = np.where(~pruning_mask.values)[0]
+        set_C_meas_bad(C_meas, np.concatenate((idx_pruned, idx_pruned + n_chs)), mse_val_for_bad_data)
 
     #
     # create the sensitivity matrix for HbO and HbR
     #
-    ec = nirs.get_extinction_coefficients("prahl", wavelength)
-
     nchannel = Adot_pruned.shape[0]
     nvertices = Adot_pruned.shape[1]
     n_brain = sum(Adot.is_brain.values)
 
-    A = np.zeros((2 * nchannel, 2 * nvertices))
-
-    wl1, wl2 = wavelength
-    A[:nchannel, :nvertices] = ec.sel(chromo="HbO", wavelength=wl1).values * Adot_pruned.sel(wavelength=wl1) # noqa: E501
-    A[:nchannel, nvertices:] = ec.sel(chromo="HbR", wavelength=wl1).values * Adot_pruned.sel(wavelength=wl1) # noqa: E501
-    A[nchannel:, :nvertices] = ec.sel(chromo="HbO", wavelength=wl2).values * Adot_pruned.sel(wavelength=wl2) # noqa: E501
-    A[nchannel:, nvertices:] = ec.sel(chromo="HbR", wavelength=wl2).values * Adot_pruned.sel(wavelength=wl2) # noqa: E501
-
-    A = xr.DataArray(A, dims=("flat_channel", "flat_vertex"))
-    A = A.assign_coords({"parcel" : ("flat_vertex", np.concatenate((Adot_pruned.coords['parcel'].values, Adot_pruned.coords['parcel'].values)))})
+    A = get_Adot_stacked(get_sensitivity_operator(Adot, wavelength),
+                         pruning_mask.values if C_meas is None else None, cfg_img_recon['BRAIN_ONLY'])
 
 
     #
@@ -646,11 +1197,8 @@ def do_image_recon_DB( hrf_od = None, head = None, Adot = None, C_meas = None, w
                 W = D @ np.linalg.inv(C  + lambda_meas * np.eye(A.shape[0]) )
             else:
                 lambda_meas = alpha_meas * f
-                # check if C_meas has 2 dimensions
-                if len(C_meas.shape) == 2:
-                    W = D @ np.linalg.inv(C + lambda_meas * C_meas)
-                else:
-                    W = D @ np.linalg.inv(C + lambda_meas * np.diag(C_meas))
+                # C_meas can be the variances, a dense covariance or a get_C_meas_cov
+                W = _solve_W(D, C, lambda_meas, C_meas)
             nvertices = W.shape[0]//2
         
             #% GENERATE IMAGES FOR DIFFERENT IMAGE PARAMETERS AND ALSO FOR THE FULL TIMESERIES
@@ -771,9 +1319,8 @@ def img_noise_tstat(X_grp, W, C_meas):
         X_tstat : iamge t-stat (i.e. CNR)
     '''
     
-    # scale columns of W by y_stderr_weighted**2
-    cov_img_tmp = W * np.sqrt(C_meas.values) # W is pseudo inverse  --- diagonal (faster than W C W.T)
-    cov_img_diag = np.nansum(cov_img_tmp**2, axis=1)
+    # diag of W C W.T with C = y_stderr_weighted**2
+    cov_img_diag = get_image_variance(W, C_meas)
 
     nV = X_grp.shape[0]
     cov_img_diag = np.reshape( cov_img_diag, (2,nV) ).T
@@ -792,6 +1339,77 @@ def img_noise_tstat(X_grp, W, C_meas):
     return X_noise, X_tstat
 
 
+def combine_subj_images(X_subj_lst, X_mse_lst, subj_ids):
+    ''' Weighted group average of the subject images, weighted by the inverse of the image MSE
+    as in the subject image loop of the analysis pipelines. The subjects can come from
+    different shards, the order of subj_ids is the order they are summed in.
+
+    Inputs:
+        X_subj_lst : image of each subject for one trial type (vertex, chromo)
+        X_mse_lst : image MSE of each subject (get_image_noise with the subject's C_meas)
+        subj_ids : subject IDs in the same order
+
+    Outputs:
+        dict with X_hrf_mag_mean, X_hrf_mag_mean_weighted, X_stderr_weighted, X_tstat,
+        X_weight_sum and the stacked X_hrf_mag_subj and X_mse_subj
+    '''
+
+    for idx_subj, subj_id in enumerate(subj_ids):
+        X_hrf_mag_tmp = X_subj_lst[idx_subj]
+        X_mse = X_mse_lst[idx_subj]
+
+        X_hrf_mag_subj_tmp = X_hrf_mag_tmp.expand_dims('subj')
+        X_hrf_mag_subj_tmp = X_hrf_mag_subj_tmp.assign_coords(subj=[subj_id])
+
+        X_mse_subj_tmp = X_mse.copy().expand_dims('subj')
+        X_mse_subj_tmp = X_mse_subj_tmp.assign_coords(subj=[subj_id])
+
+        # weighted average -- same as chan space - but now is vertex space
+        if idx_subj == 0:
+            all_subj_X_hrf_mag = X_hrf_mag_subj_tmp
+            X_mse_subj = X_mse_subj_tmp
+
+            X_hrf_mag_weighted = X_hrf_mag_tmp / X_mse
+            X_mse_inv_weighted = 1 / X_mse
+            X_mse_inv_weighted_max = 1 / X_mse
+        else:
+            all_subj_X_hrf_mag = xr.concat([all_subj_X_hrf_mag, X_hrf_mag_subj_tmp], dim='subj')
+            X_mse_subj = xr.concat([X_mse_subj, X_mse_subj_tmp], dim='subj')
+
+            X_hrf_mag_weighted = X_hrf_mag_weighted + X_hrf_mag_tmp / X_mse
+            X_mse_inv_weighted = X_mse_inv_weighted + 1 / X_mse
+            X_mse_inv_weighted_max = np.maximum(X_mse_inv_weighted_max, 1 / X_mse)
+
+    # get the average
+    X_hrf_mag_mean = all_subj_X_hrf_mag.mean('subj')
+    X_hrf_mag_mean_weighted = X_hrf_mag_weighted / X_mse_inv_weighted
+
+    X_mse_mean_within_subject = 1 / X_mse_inv_weighted
+
+    X_mse_subj_tmp = X_mse_subj.copy()
+    X_mse_subj_tmp = xr.where(X_mse_subj_tmp < 1e-6, 1e-6, X_mse_subj_tmp)
+    X_mse_weighted_between_subjects_tmp = (all_subj_X_hrf_mag - X_hrf_mag_mean)**2 / X_mse_subj_tmp # X_mse_subj_tmp is weights for each sub
+    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects_tmp.mean('subj')
+    X_mse_weighted_between_subjects = X_mse_weighted_between_subjects / (X_mse_subj**-1).mean('subj')
+
+    X_stderr_weighted = np.sqrt( X_mse_mean_within_subject + X_mse_weighted_between_subjects )
+
+    X_tstat = X_hrf_mag_mean_weighted / X_stderr_weighted
+
+    X_weight_sum = X_mse_inv_weighted / X_mse_inv_weighted_max
+
+    results = {'X_hrf_mag_mean': X_hrf_mag_mean,
+               'X_hrf_mag_mean_weighted': X_hrf_mag_mean_weighted,
+               'X_stderr_weighted': X_stderr_weighted,
+               'X_tstat': X_tstat,
+               'X_weight_sum': X_weight_sum,
+               'X_hrf_mag_subj': all_subj_X_hrf_mag,
+               'X_mse_subj': X_mse_subj
+               }
+
+    return results
+
+
 def save_image_results(X_matrix, X_matrix_name, save_path, trial_type_img, cfg_img_recon):
     '''Save image result matrices.
     Inputs:
@@ -807,6 +1425,7 @@ def save_image_results(X_matrix, X_matrix_name, save_path, trial_type_img, cfg_i
     
 
 #%%
+@pfDAB_inst.instrument('plotting')
 def plot_image_recon( X, head, shape, iax,clim=(0,1), flag_hbx='hbo_brain', view_position='superior', p0 = None, title_str = None, off_screen= True ):
     # pos_names = ['superior', 'left']
 
@@ -25,6 +25,10 @@ import cedalion.plots as plots
 from cedalion import units
 import scipy.signal
 import os.path
+import gzip
+import glob
+import pickle
+import hashlib
 import pandas as pd
 from cedalion.vis import plot_probe as vpp
 from cedalion.vis import time_series as vts
@@ -37,13 +41,15 @@ from scipy.interpolate import interp1d
 from sklearn.decomposition import FastICA
 from scipy.signal import butter, sosfilt
 
+import module_dqr_render as pfDAB_render
+
 
 import pdb
 
 
 #%%
 
-def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None):
+def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None, dqr_renderer = None):
     ''' Filter Walking portion of the data in dOD space 
         inputs: 
             rec - xarray 
@@ -51,6 +57,7 @@ def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None):
             cfg_imu_glm - params 
             filenm - 
             filepath - 
+            dqr_renderer - where to send the DQR figures (see module_dqr_render), None renders them inline
         
         output:
             dod_filtered - xarray containing filtered dOD data
@@ -102,12 +109,10 @@ def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None):
     accel_t_np = np.array(accel_t)
     gyr_t_np = np.array(gyro_t)
 
-    # Fast ICA
-    icaACC = FastICA( cfg_imu_glm['n_components'][1]) #, random_state=0)
-    #pdb.set_trace()
-    zAcc = icaACC.fit_transform(np.hstack([accel_np, accel_mag_np]))
-    icaGyr = FastICA( n_components = cfg_imu_glm['n_components'][0])
-    zGyr = icaGyr.fit_transform(gyro_np)
+    # Fast ICA, fitted for this file or reused for the subject / all files (see get_imu_ica)
+    icaACC, icaGyr = get_imu_ica(np.hstack([accel_np, accel_mag_np]), gyro_np, cfg_imu_glm, filenm, filepath)
+    zAcc = icaACC.transform(np.hstack([accel_np, accel_mag_np]))
+    zGyr = icaGyr.transform(gyro_np)
     
     # -------------------------
     # Downsample regressors (z) to match fnirs data
@@ -118,7 +123,7 @@ def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None):
     # -------------------------
     # Create GLM design matrix
     # -------------------------
-    lstWalktmp = lstWalk[(hWin[-1]):(len(lstWalk) + hWin[0])] # adjust lstWalk for time window
+    lstWalktmp = get_lagged_rows(lstWalk, hWin) # adjust lstWalk for time window
     
     A, AA = GLM_designMat(z_resamp, lstWalk, hWin, lstWalktmp) # get 2D and 3D design matrix
     
@@ -179,8 +184,8 @@ def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None):
     
     # Plot gait artifact ratio before and after correction & variance explained
     if cfg_imu_glm['plot_flag_imu']:
-        plotGaitRatio(rec, dod, gaitRatio_b4, gaitRatio_af, filenm, filepath)
-        plotVarExp(rec, dod, z_resamp, varExp, filenm, filepath)
+        plotGaitRatio(rec, dod, gaitRatio_b4, gaitRatio_af, filenm, filepath, dqr_renderer)
+        plotVarExp(rec, dod, z_resamp, varExp, filenm, filepath, dqr_renderer)
         
     # -------------------------
     # Create new xarray with filtered dOD data
@@ -200,7 +205,7 @@ def filterWalking(rec, rec_str, cfg_imu_glm, filenm = None, filepath = None):
     
     
 def id_walking(dod, stim ):
-    '''Function that identifies the walking period based on stim
+    '''Function that identifies the walking periods based on stim
     
     ** double check that this is right for all subs **
     
@@ -209,6 +214,10 @@ def id_walking(dod, stim ):
         stim - rec.stim
     output: 
         lsWalk and lstStand - arrays that have indices for walking and standing
+        
+    Every start_walk is paired with the next end_walk, so a recording can have several walking
+    periods. Standing is everything before the last end_stand except the walking periods and
+    one sample on each side of them.
     '''
     # DOUBLE CHECK when the person starts walking/ standing again after trial start
     #dod = np.array(rec["od_pruned"]) # -- shape = chans x wavelength x time 
@@ -218,87 +227,280 @@ def id_walking(dod, stim ):
     # endWalk = df[df['trial_type'] == 'DT']['onset'].max() + 21
     # endStand = df[df['trial_type'] == 'ST']['onset'].max() + 20
     
-    startWalk = stim[stim['trial_type'] == 'start_walk']['onset'].iloc[0]
-    endWalk = stim[stim['trial_type'] == 'end_walk']['onset'].iloc[0]
-    startStand = stim[stim['trial_type'] == 'start_stand']['onset'].iloc[0]
-    endStand = stim[stim['trial_type'] == 'end_stand']['onset'].iloc[0]
-    
-    
-    t_index = dod.get_index('time')
-    closest_start = t_index[np.abs(t_index - startWalk).argmin()]
-    start_idx = t_index.get_loc(closest_start) # start walk index
-    closest_stop = t_index[np.abs(t_index - endWalk).argmin()]
-    stop_idx = t_index.get_loc(closest_stop) # end walking period index
-    closestEnd = t_index[np.abs(t_index - endStand).argmin()]
-    stopStand_idx = t_index.get_loc(closestEnd)
-
-    lstWalk = np.arange(start_idx, stop_idx+1,1) # time indices for walking portion
-    lstStand = np.concatenate((np.arange(0,start_idx-1,1), np.arange(stop_idx+2, stopStand_idx,1)))
+    n_time = dod.sizes['time']
+    stim_idx = get_event_samples(dod.time.values, stim)
+
+    walk_segments = get_segments(stim_idx, 'start_walk', 'end_walk')
+    stand_end = stim_idx[stim_idx['trial_type'] == 'end_stand']['sample']
+    stopStand_idx = stand_end.max() if len(stand_end) > 0 else n_time
+
+    lstWalk = np.concatenate([np.arange(start_idx, stop_idx+1,1) for start_idx, stop_idx in walk_segments]) # time indices for walking portion
+
+    flag_stand = np.zeros(n_time, dtype=bool)
+    flag_stand[:stopStand_idx] = True
+    for start_idx, stop_idx in walk_segments:
+        flag_stand[max(start_idx-1, 0):stop_idx+2] = False
+    lstStand = np.where(flag_stand)[0]
     
     return lstWalk, lstStand
+
+
+def get_event_samples(t, stim):
+    ''' Sample index of every stim onset, the sample of t closest to the onset (the earlier one for
+    a tie). All onsets are found with one searchsorted on the sorted time axis t.
     
+    output:
+        copy of stim with the column 'sample'
+    '''
+    t = np.asarray(t)
+    onset = stim['onset'].values
+
+    idx_hi = np.clip(np.searchsorted(t, onset), 1, len(t) - 1)
+    idx_lo = idx_hi - 1
+    flag_lo = (onset - t[idx_lo]) <= (t[idx_hi] - onset)
+
+    stim_idx = stim.copy()
+    stim_idx['sample'] = np.where(flag_lo, idx_lo, idx_hi)
+
+    return stim_idx
+
+
+def get_segments(stim_idx, start_type, end_type):
+    ''' (start, end) sample indices of the segments between the start_type and end_type events of
+    stim_idx (from get_event_samples). Every start is paired with the first end after it.
+    '''
+    starts = np.sort(stim_idx[stim_idx['trial_type'] == start_type]['sample'].values)
+    ends = np.sort(stim_idx[stim_idx['trial_type'] == end_type]['sample'].values)
+    if len(starts) == 0:
+        raise ValueError(f'No {start_type} event in stim')
+
+    idx_end = np.searchsorted(ends, starts)
+    if np.any(idx_end >= len(ends)):
+        raise ValueError(f'A {start_type} event has no {end_type} after it')
+
+    segments = list(zip(starts, ends[idx_end]))
+
+    return segments
+
+
+# fitted IMU ICA models of this session, keyed by (filepath, ica_key), see get_imu_ica
+_imu_ica_cache = {}
+
+def get_imu_ica(accel_np, gyro_np, cfg_imu_glm, filenm = None, filepath = None):
+    ''' FastICA models of the accelerometer and gyroscope data
+        inputs:
+            accel_np - accelerometer data (time x [x, y, z, magnitude])
+            gyro_np - gyroscope data (time x [x, y, z])
+            cfg_imu_glm - params, the optional keys
+                'ica_reuse' - None fits the ICA on every file, 'subject' once per subject (first
+                              part of filenm) and 'all' once for all files (e.g. one headset)
+                'ica_random_state' - seed of FastICA (default 0), so the regressors are reproducible
+                'ica_fit_subsample' - fit on every n-th IMU sample (default 1)
+            filenm - file name, gives the subject for ica_reuse = 'subject'
+            filepath - dataset root dir. The reused models are saved in derivatives/imu_ica and
+                       used again on reruns. If None they are only kept in memory
+        The key of a reused model includes the dataset root and a hash of the names, sizes and
+        modification times of the SNIRF files it is reused for (those of the subject or of the
+        dataset), so a model is fitted again for another dataset or when files are added or changed.
+        
+        output:
+            icaACC, icaGyr - fitted FastICA models, the regressors are icaACC.transform(accel_np) and
+                             icaGyr.transform(gyro_np)
+    '''
+    ica_reuse = cfg_imu_glm.get('ica_reuse', None)
+    random_state = cfg_imu_glm.get('ica_random_state', 0)
+    subsample = cfg_imu_glm.get('ica_fit_subsample', 1)
+
+    if ica_reuse == 'subject' and filenm is not None:
+        ica_key = filenm.split('_')[0]
+    elif ica_reuse == 'all':
+        ica_key = 'all'
+    elif ica_reuse is None or ica_reuse == 'subject':
+        ica_key = None
+    else:
+        raise ValueError(f"cfg_imu_glm['ica_reuse'] must be None, 'subject' or 'all', not {ica_reuse}")
+
+    if ica_key is not None:
+        # the key includes the ICA params and the input files, so changing them fits new models
+        input_hash = _get_imu_ica_input_hash(filepath, None if ica_key == 'all' else ica_key)
+        ica_key = f"imu_ica_{ica_key}_ncomp-{cfg_imu_glm['n_components'][1]}-{cfg_imu_glm['n_components'][0]}_rs-{random_state}_ss-{subsample}_in-{input_hash}"
+        file_path = None if filepath is None else os.path.join(filepath, 'derivatives', 'imu_ica', ica_key + '.pkl.gz')
+
+        if (filepath, ica_key) in _imu_ica_cache:
+            return _imu_ica_cache[(filepath, ica_key)]
+        if file_path is not None and os.path.exists(file_path):
+            with gzip.open(file_path, 'rb') as f:
+                _imu_ica_cache[(filepath, ica_key)] = pickle.load(f)
+            print(f'Using the IMU ICA of {file_path}')
+            return _imu_ica_cache[(filepath, ica_key)]
+
+    icaACC = FastICA( n_components = cfg_imu_glm['n_components'][1], random_state = random_state)
+    icaACC.fit(accel_np[::subsample])
+    icaGyr = FastICA( n_components = cfg_imu_glm['n_components'][0], random_state = random_state)
+    icaGyr.fit(gyro_np[::subsample])
+
+    if ica_key is not None:
+        _imu_ica_cache[(filepath, ica_key)] = (icaACC, icaGyr)
+        if file_path is not None:
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with gzip.open(file_path + '.tmp', 'wb') as f:
+                pickle.dump((icaACC, icaGyr), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(file_path + '.tmp', file_path)
+
+    return icaACC, icaGyr
+
+
+def _get_imu_ica_input_hash(filepath, subj = None):
+    # hash of the SNIRF files (name, size, modification time) of subject subj or of all subjects
+    # of the dataset in filepath, 'none' without a dataset root
+    if filepath is None:
+        return 'none'
+
+    subj_dir = subj if subj is not None else 'sub-*'
+    file_paths = sorted(glob.glob(os.path.join(filepath, subj_dir, 'nirs', '*.snirf')))
+
+    h = hashlib.sha1(os.path.abspath(filepath).encode())
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        h.update(f'{os.path.basename(file_path)} {stat.st_size} {stat.st_mtime_ns}'.encode())
+
+    return h.hexdigest()[:12]
+
 
 def downsample_IMU(z, t, accel_t_np, statesPerDataFrame):
     ''' Downsample IMU regressor data to match fnirs sampling rate
     '''
-    z_resamp = np.zeros((len(t), z.shape[1]))
-
     # mean subtract to ensure mean centered around 0 (remove DC offset)
     #z = z - np.ones((z.shape[0],1))*np.mean(z,axis=0) # mean subtract 
 
     z = z - np.mean(z, axis=0, keepdims=True)  # Center data by subtracting column-wise mean
 
-    # loop thru each col of z (ica components)
-    for iz in range(z.shape[1]):
-        # low pass filter data w/ zero-phase filter data to smooth the signal
-        z[:,iz] = signal.filtfilt(np.ones((statesPerDataFrame)), statesPerDataFrame, z[:,iz])
-        
-        # resample and align signal
-        interp_mdl = interp1d(accel_t_np, z[:,iz], kind='linear', bounds_error=False, fill_value='extrapolate')
-        z_resamp[:,iz] = interp_mdl(t)
+    # low pass filter all cols of z (ica components) w/ a zero-phase boxcar to smooth the signal
+    # same as signal.filtfilt(np.ones((statesPerDataFrame)), statesPerDataFrame, z[:,iz]) for each col
+    z = filtfilt_boxcar(z, statesPerDataFrame)
+
+    # resample and align signal, linear w/ extrapolation as interp1d(..., fill_value='extrapolate')
+    z_resamp = interp_linear(t, accel_t_np, z)
     
     return z_resamp
 
 
-def GLM_designMat(z_resamp, lstWalk, hWin, lstWalktmp):
+def filtfilt_boxcar(x, n_taps):
+    ''' Zero-phase moving average of n_taps samples along axis 0 of x (samples x components), the
+    same as signal.filtfilt(np.ones(n_taps), n_taps, x, axis=0) (odd padding of 3*n_taps samples and
+    steady state initial conditions) but with cumulative sums instead of a convolution.
+    '''
+    padlen = 3 * n_taps
+    if x.shape[0] <= padlen:
+        # filtfilt raises the error for too short signals
+        return signal.filtfilt(np.ones((n_taps)), n_taps, x, axis=0)
+
+    # odd extension at both ends as in filtfilt
+    x_ext = np.concatenate((2 * x[:1] - x[padlen:0:-1], x, 2 * x[-1:] - x[-2:-(padlen + 2):-1]), axis=0)
+
+    # forward and backward pass, the steady state initial conditions of the FIR filter are the
+    # same as repeating the first sample n_taps-1 times
+    y = _moving_average_causal(x_ext, n_taps)
+    y = _moving_average_causal(y[::-1], n_taps)[::-1]
+
+    return y[padlen:-padlen]
+
+
+def _moving_average_causal(x, n_taps):
+    x_pad = np.concatenate((np.repeat(x[:1], n_taps - 1, axis=0), x), axis=0)
+    x_cumsum = np.concatenate((np.zeros((1,) + x.shape[1:]), np.cumsum(x_pad, axis=0)), axis=0)
+    return (x_cumsum[n_taps:] - x_cumsum[:-n_taps]) / n_taps
+
+
+def interp_linear(x_new, x, y):
+    ''' Linear interpolation of all columns of y (samples x components) from x to x_new, with linear
+    extrapolation beyond x as interp1d(x, y, axis=0, fill_value='extrapolate').
+    '''
+    x = np.asarray(x)
+    if np.any(np.diff(x) < 0):
+        idx_sort = np.argsort(x, kind='mergesort')
+        x = x[idx_sort]
+        y = y[idx_sort]
+
+    # the segment of every new sample, the first or last one outside of x
+    idx_hi = np.clip(np.searchsorted(x, x_new), 1, len(x) - 1)
+    idx_lo = idx_hi - 1
+
+    slope = (y[idx_hi] - y[idx_lo]) / (x[idx_hi] - x[idx_lo])[:, np.newaxis]
+    return slope * (x_new - x[idx_lo])[:, np.newaxis] + y[idx_lo]
+
+
+def GLM_designMat(z_resamp, lstWalk, hWin, lstWalktmp = None):
     ''' Create GLM design matrix 
         inputs:
             z_resamp - downsampled imu regressor data
             lstWalk - array of indices that indicate walk period
-            hWin - array of time shifts
+            hWin - array of time shifts (any lags and leads)
+            lstWalktmp - samples modelled by the GLM, get_lagged_rows(lstWalk, hWin) if None
         output:
-            A - 3D GLM design matrix
-            AA - 2D GLM deisgn matrix
+            A - 3D GLM design matrix (sample, lag, component), a view of AA
+            AA - 2D GLM deisgn matrix, the lags of each component side by side
         
     '''
-    # Initialize 3D design matrix
-    A = np.zeros((len(lstWalk)-len(hWin)+1, len(hWin), z_resamp.shape[1]))
+    if lstWalktmp is None:
+        lstWalktmp = get_lagged_rows(lstWalk, hWin)
+    hWin = np.asarray(hWin)
+    n_comp = z_resamp.shape[1]
 
-    # construct 3D matrix 
-    for ih in range(len(hWin)): # loop over each time lag or lead
-        for ic in range(z_resamp.shape[1]): # loop over each predictor/ component / regressor
-            A[:,ih,ic] = z_resamp[lstWalktmp - hWin[ih], ic] 
-            # ^ extracts vals from z_resamp corresponding to time-shifted indices for each component
-            # creates time lagged predictors for each component
+    # a single gather builds AA, AA[t, ic*len(hWin) + ih] = z_resamp[lstWalktmp[t] - hWin[ih], ic]
+    idx_time = lstWalktmp[:, np.newaxis, np.newaxis] - hWin[np.newaxis, np.newaxis, :]
+    idx_comp = np.arange(n_comp)[np.newaxis, :, np.newaxis]
+    AA = z_resamp[idx_time, idx_comp].reshape(len(lstWalktmp), n_comp * len(hWin))
 
-        
-    AA = np.hstack([A[:, :, ic] for ic in range(z_resamp.shape[1])]) # concat predictors w/ time-lagged versions along col axis
+    A = AA.reshape(len(lstWalktmp), n_comp, len(hWin)).transpose(0, 2, 1)
     
     return A, AA
 
-def plotGaitRatio(rec, dod, gaitRatio_b4, gaitRatio_af, filenm = None, filepath = None):
+
+def get_lagged_rows(lstWalk, hWin):
+    ''' The samples of lstWalk whose lagged samples (sample - hWin) are all in lstWalk, i.e. the
+    samples the GLM can model. For a single walking period and hWin = np.arange(-3,5) this is
+    lstWalk[hWin[-1]:len(lstWalk)+hWin[0]]. Works for several walking periods and any hWin.
+    '''
+    lstWalk = np.asarray(lstWalk)
+    flag_valid = np.ones(len(lstWalk), dtype=bool)
+    for h in np.asarray(hWin):
+        flag_valid &= np.isin(lstWalk - h, lstWalk, assume_unique=True)
+
+    return lstWalk[flag_valid]
+
+
+def plotGaitRatio(rec, dod, gaitRatio_b4, gaitRatio_af, filenm = None, filepath = None, dqr_renderer = None):
+    ''' Plot gait artifact ratio before and after correction '''
+    dqr_metrics = {
+        'type' : 'imu_glm_gaitRatio',
+        'filenm' : filenm,
+        'filepath' : filepath,
+        'ts' : dod.isel(time=slice(0, 1)),
+        'geo3d' : rec.geo3d,
+        'gaitRatio_b4' : gaitRatio_b4[0,:],
+        'gaitRatio_af' : gaitRatio_af[0,:]
+        }
+    pfDAB_render.submit( dqr_renderer, plotGaitRatio_metrics, dqr_metrics )
+
+
+def plotGaitRatio_metrics( dqr_metrics ):
+    filenm = dqr_metrics['filenm']
+    filepath = dqr_metrics['filepath']
+
     # If save path for plot does not exist, create it
     der_dir = os.path.join(filepath, 'derivatives', 'plots', 'DQR', 'walking_filter')
     if not os.path.exists(der_dir):
         os.makedirs(der_dir)
         
     # Plot gait artifact ratio before and after correction
-    foo = gaitRatio_b4[0,:]
+    foo = dqr_metrics['gaitRatio_b4']
 
     f, ax = plt.subplots(2, 1, figsize=(10, 10))
     plots.scalp_plot( 
-            dod,
-            rec.geo3d,
+            dqr_metrics['ts'],
+            dqr_metrics['geo3d'],
             foo,
             ax[0],
             cmap='jet',
@@ -309,10 +511,10 @@ def plotGaitRatio(rec, dod, gaitRatio_b4, gaitRatio_af, filenm = None, filepath
             optode_size=6
         )
         
-    foo2 = gaitRatio_af[0,:]
+    foo2 = dqr_metrics['gaitRatio_af']
     plots.scalp_plot( 
-            dod,
-            rec.geo3d,
+            dqr_metrics['ts'],
+            dqr_metrics['geo3d'],
             foo2,
             ax[1],
             cmap='jet',
@@ -328,15 +530,31 @@ def plotGaitRatio(rec, dod, gaitRatio_b4, gaitRatio_af, filenm = None, filepath
     plt.savefig( os.path.join(filepath, 'derivatives', 'plots','DQR', 'walking_filter', filenm + "_imu_glm_gaitRatio.png") )
     plt.close()
     
-def plotVarExp(rec, dod, z_resamp, varExp, filenm = None, filepath = None):
+def plotVarExp(rec, dod, z_resamp, varExp, filenm = None, filepath = None, dqr_renderer = None):
     '''  Plot variance explained by each ICA component '''
+    dqr_metrics = {
+        'type' : 'imu_glm_varExp',
+        'filenm' : filenm,
+        'filepath' : filepath,
+        'ts' : dod.isel(time=slice(0, 1)),
+        'geo3d' : rec.geo3d,
+        'varExp' : varExp[0,:,:]
+        }
+    pfDAB_render.submit( dqr_renderer, plotVarExp_metrics, dqr_metrics )
+
+
+def plotVarExp_metrics( dqr_metrics ):
+    filenm = dqr_metrics['filenm']
+    filepath = dqr_metrics['filepath']
+    varExp = dqr_metrics['varExp']
+
     f, ax = plt.subplots(5, 1, figsize=(8, 15))
 
-    for ic in range(z_resamp.shape[1]):
-        foo = varExp[0,:,ic]*100
+    for ic in range(varExp.shape[1]):
+        foo = varExp[:,ic]*100
         plots.scalp_plot( 
-                dod,
-                rec.geo3d,
+                dqr_metrics['ts'],
+                dqr_metrics['geo3d'],
                 foo,
                 ax[ic],
                 cmap='jet',
@@ -350,4 +568,4 @@ def plotVarExp(rec, dod, z_resamp, varExp, filenm = None, filepath = None):
     plt.suptitle(filenm)
 
     plt.savefig( os.path.join(filepath, 'derivatives', 'plots','DQR', 'walking_filter', filenm + "_imu_glm_varExp.png") )
-    plt.close()
\ No newline at end of file
+    plt.close()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation of the pipeline stages.
+
+The pipeline modules mark their stages with
+
+    with pfDAB_inst.stage('prune', subj=subj_id, file=filenm):
+        ...
+
+or decorate whole functions with @pfDAB_inst.instrument('W_build'). Every stage measures
+its wall time and CPU time (all threads of the process, so BLAS threads are included).
+Nothing is recorded unless a trace was started, so the stages cost two clock reads when
+tracing is off.
+
+A pipeline script starts and writes the trace with
+
+    pfDAB_inst.start_trace()
+    ...
+    pfDAB_inst.stop_trace( os.path.join(root_dir, 'derivatives', 'trace', 'trace.json') )
+
+While a trace is active a sampler thread polls the resident set size (RSS) of the process
+so every stage also gets its peak RSS. The trace file is in the Chrome trace event format
+and can be opened in chrome://tracing, https://ui.perfetto.dev or https://www.speedscope.app
+(flame graph). A per-stage summary is written next to it as a csv file.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+
+import pandas as pd
+
+try:
+    import psutil
+    flag_psutil = True
+except ImportError:
+    flag_psutil = False
+
+
+# the active trace, None when not tracing
+_trace = None
+
+
+def start_trace( cfg_trace = None ):
+    '''
+    Start recording the stages. cfg_trace = {'sample_interval': s} sets how often the RSS
+    is sampled (default 0.05 s). Returns the trace dict.
+    '''
+    global _trace
+
+    if _trace is not None:
+        print('Warning: a trace is already active, it is replaced by the new one')
+        _stop_sampler( _trace )
+
+    cfg_trace = cfg_trace or {}
+
+    _trace = {
+        't0' : time.perf_counter(),
+        'pid' : os.getpid(),
+        'events' : [],
+        'rss_samples' : [],
+        'stack' : [],
+        'lock' : threading.Lock(),
+        'sample_interval' : cfg_trace.get('sample_interval', 0.05),
+        'stop_event' : threading.Event(),
+        'sampler' : None,
+        }
+
+    _trace['sampler'] = threading.Thread( target=_sample_rss, args=(_trace,), daemon=True )
+    _trace['sampler'].start()
+
+    return _trace
+
+
+def stop_trace( file_path = None ):
+    '''
+    Stop recording. If file_path is given the trace is written there (see write_trace).
+    Returns the trace dict, or None if no trace was active.
+    '''
+    global _trace
+
+    trace = _trace
+    if trace is None:
+        return None
+
+    _stop_sampler( trace )
+    _trace = None
+
+    if file_path is not None:
+        write_trace( trace, file_path )
+
+    return trace
+
+
+@contextlib.contextmanager
+def stage( name, **args ):
+    '''
+    Context manager that measures the enclosed code as stage 'name'. The keyword
+    arguments (e.g. subj, file) are stored with the stage.
+    Yields a dict that holds 'wall_s' and 'cpu_s' after the block, also when not tracing.
+    '''
+    trace = _trace
+    frame = {'name' : name, 'args' : args}
+
+    if trace is not None:
+        rss = _get_rss()
+        frame['rss_start'] = rss
+        frame['peak_rss'] = rss
+        frame['tid'] = threading.get_ident()
+        with trace['lock']:
+            trace['stack'].append( frame )
+
+    t_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield frame
+    finally:
+        frame['wall_s'] = time.perf_counter() - t_start
+        frame['cpu_s'] = time.process_time() - cpu_start
+
+        if trace is not None:
+            rss = _get_rss()
+            with trace['lock']:
+                trace['stack'].remove( frame )
+                frame['peak_rss'] = max( frame['peak_rss'], rss )
+                # the enclosing stages see the peak of this one
+                for frame_outer in trace['stack']:
+                    frame_outer['peak_rss'] = max( frame_outer['peak_rss'], frame['peak_rss'] )
+
+            trace['events'].append({
+                'name' : name,
+                'ts' : (t_start - trace['t0']) * 1e6,
+                'dur' : frame['wall_s'] * 1e6,
+                'tid' : frame['tid'],
+                'args' : {
+                    **{key : str(val) for key, val in args.items()},
+                    'cpu_s' : frame['cpu_s'],
+                    'rss_start_mb' : frame['rss_start'] / 1024**2,
+                    'rss_end_mb' : rss / 1024**2,
+                    'peak_rss_mb' : frame['peak_rss'] / 1024**2,
+                    }
+                })
+
+
+def instrument( name = None ):
+    '''
+    Decorator that measures every call of the function as a stage (named after the
+    function unless name is given).
+    '''
+    def decorator( fn ):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper( *args, **kwargs ):
+            with stage( stage_name ):
+                return fn( *args, **kwargs )
+
+        return wrapper
+
+    return decorator
+
+
+def write_trace( trace, file_path ):
+    '''
+    Write the trace in the Chrome trace event format, plus a per-stage summary csv
+    (file_path with _summary.csv instead of .json).
+    '''
+    dir_path = os.path.dirname(file_path)
+    if dir_path != '' and not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+    pid = trace['pid']
+    trace_events = [{'name' : 'process_name', 'ph' : 'M', 'pid' : pid, 'args' : {'name' : os.path.basename(sys.argv[0]) or 'python'}}]
+    for event in sorted(trace['events'], key=lambda e: e['ts']):
+        trace_events.append({**event, 'ph' : 'X', 'cat' : 'stage', 'pid' : pid})
+    for t, rss in trace['rss_samples']:
+        trace_events.append({'name' : 'RSS (MB)', 'ph' : 'C', 'ts' : t * 1e6, 'pid' : pid, 'args' : {'rss' : rss / 1024**2}})
+
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents' : trace_events, 'displayTimeUnit' : 'ms'}, f)
+
+    df_summary = get_stage_summary( trace )
+    df_summary.to_csv( os.path.splitext(file_path)[0] + '_summary.csv' )
+
+    print(f'Trace written to {file_path}')
+
+    return
+
+
+def get_stage_summary( trace = None ):
+    '''
+    One row per stage name with the number of calls, the total and max wall and CPU time
+    and the max peak RSS, sorted by total wall time. Uses the active trace if trace is None.
+    '''
+    trace = trace if trace is not None else _trace
+    if trace is None or len(trace['events']) == 0:
+        return pd.DataFrame()
+
+    df = pd.DataFrame({
+        'stage' : [e['name'] for e in trace['events']],
+        'wall_s' : [e['dur'] / 1e6 for e in trace['events']],
+        'cpu_s' : [e['args']['cpu_s'] for e in trace['events']],
+        'peak_rss_mb' : [e['args']['peak_rss_mb'] for e in trace['events']],
+        })
+
+    df_summary = df.groupby('stage').agg(
+        n_calls = ('wall_s', 'size'),
+        wall_s_total = ('wall_s', 'sum'),
+        wall_s_max = ('wall_s', 'max'),
+        cpu_s_total = ('cpu_s', 'sum'),
+        peak_rss_mb = ('peak_rss_mb', 'max'),
+        )
+
+    return df_summary.sort_values('wall_s_total', ascending=False)
+
+
+def _get_rss():
+    # current resident set size in bytes
+    if flag_psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # no /proc (macOS without psutil), fall back to the peak RSS of the process
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _sample_rss( trace ):
+    while not trace['stop_event'].wait( trace['sample_interval'] ):
+        rss = _get_rss()
+        with trace['lock']:
+            trace['rss_samples'].append( (time.perf_counter() - trace['t0'], rss) )
+            for frame in trace['stack']:
+                frame['peak_rss'] = max( frame['peak_rss'], rss )
+
+
+def _stop_sampler( trace ):
+    trace['stop_event'].set()
+    if trace['sampler'] is not None:
+        trace['sampler'].join()
@@ -21,6 +21,13 @@ import json
 import sys
 import module_plot_DQR as pfDAB_dqr
 import module_imu_glm_filter as pfDAB_imu
+import module_quality as pfDAB_qual
+import module_dqr_render as pfDAB_render
+import module_qc_store as pfDAB_qc
+import module_sidecar as pfDAB_sidecar
+import module_instrument as pfDAB_inst
+import module_units as pfDAB_units
+import module_dataset as pfDAB_ds
 
 import pdb
 
@@ -39,14 +46,33 @@ def load_and_preprocess( cfg_dataset, cfg_preprocess ):
                apply a 3 point median filter to remove outliers.
             'amp_pruned' - the 'amp' data pruned according to the SNR, SD, and amplitude thresholds.
             'od' - the optical density data
-            'od_tddr' - the optical density data after TDDR motion correction is applied
-            'conc_tddr' - the concentration data obtained from 'od_tddr'
+            'od_corrected' - the optical density data after motion correction (IMU GLM and/or TDDR) and bandpass filtering
+            'conc' - the concentration data obtained from 'od_corrected'
             'od_splineSG' and 'conc_splineSG' - returned if splineSG motion correction is applied (i.e. flag_do_splineSG=True)
       stim - the stimulus data with 'onset', 'duration', and 'trial_type' fields and more from the events.tsv files.
       aux_ts - the auxiliary time series data from the SNIRF files.
          In addition, the following aux sub-fields are added during pre-processing:
             'gvtd' - the global variance of the time derivative of the 'od' data.
-            'gvtd_tddr' - the global variance of the time derivative of the 'od_tddr' data.
+            'gvtd_corrected' - the global variance of the time derivative of the 'od_corrected' data.
+            'tInc_all_corrected' - the percent of channels free of motion artifacts in 'od_corrected' at each time point.
+    The DQR figures are rendered according to cfg_preprocess['cfg_dqr'] = {'mode', 'n_workers'}, where mode
+    is 'inline' (default), 'background' (rendered by a pool of worker processes) or 'metrics_only'
+    (see module_dqr_render).
+    The per-file, per-channel and motion artifact QC metrics are written to derivatives/qc as each file is processed
+    and can be loaded with module_qc_store.load_qc_table().
+    Every processing step is a stage of module_instrument, so its wall time, CPU time and peak RSS are
+    recorded per file when a trace was started with module_instrument.start_trace().
+    The lists hold the subjects not in subj_id_exclude, use load_and_preprocess_dataset to get the
+    recordings and their QC summaries keyed by (subject, run) instead (see module_dataset).
+    '''
+    dataset = load_and_preprocess_dataset( cfg_dataset, cfg_preprocess )
+
+    return pfDAB_ds.get_subj_lists( dataset, 'rec' ), pfDAB_ds.get_subj_lists( dataset, 'chs_pruned' )
+
+
+def load_and_preprocess_dataset( cfg_dataset, cfg_preprocess ):
+    '''
+    load_and_preprocess returning the dataset dict of module_dataset.
     '''
 
 
@@ -71,198 +97,206 @@ def load_and_preprocess( cfg_dataset, cfg_preprocess ):
     n_subjects = len(cfg_dataset['subj_ids'])
     n_files_per_subject = len(cfg_dataset['file_ids'])
     
-    n_subjects_corrected =  len(cfg_dataset['subj_ids']) - len(cfg_dataset['subj_id_exclude'])
+    # the recordings and QC summaries keyed by (subject, run)
+    dataset = pfDAB_ds.new_dataset( cfg_dataset )
 
-    # loop over subjects and files
-    for subj_idx in range(n_subjects):
-        for file_idx in range(n_files_per_subject):
-            
-            if subj_ids[subj_idx] in cfg_dataset['subj_id_exclude']:  # if current subj is excluded then skip processing
-                print(f'Subject {subj_ids[subj_idx]} listed in subj_id_exclude. Skipping processing for this subject.')    
-                continue 
+    # the DQR figures are rendered inline, in background worker processes, or only saved as metrics
+    dqr_renderer = pfDAB_render.start_renderer( cfg_preprocess.get('cfg_dqr', None) )
+
+    # the worker pool of the renderer is shut down also if the preprocessing fails
+    try:
+        # loop over subjects and files
+        for subj_idx in range(n_subjects):
+
+            if pfDAB_ds.is_excluded( dataset, subj_ids[subj_idx] ):  # if current subj is excluded then skip processing
+                print(f'Subject {subj_ids[subj_idx]} listed in subj_id_exclude. Skipping processing for this subject.')
+                continue
+
+            for file_idx in range(n_files_per_subject):
             
-            filenm = cfg_dataset['filenm_lst'][subj_idx][file_idx]
+                filenm = cfg_dataset['filenm_lst'][subj_idx][file_idx]
             
 
-            print( f"Loading {subj_idx+1} of {n_subjects} subjects, {file_idx+1} of {n_files_per_subject} files : {filenm}" )
+                print( f"Loading {subj_idx+1} of {n_subjects} subjects, {file_idx+1} of {n_files_per_subject} files : {filenm}" )
+                stage_args = {'subj': subj_ids[subj_idx], 'file': filenm}   # identifies the file in the instrumentation trace
 
-            subStr = filenm.split('_')[0]
-            subDir = os.path.join(cfg_dataset['root_dir'], subStr, 'nirs')
+                subStr = filenm.split('_')[0]
+                subDir = os.path.join(cfg_dataset['root_dir'], subStr, 'nirs')
 
-            file_path = os.path.join(subDir, filenm )
-            records = cedalion.io.read_snirf( file_path ) 
+                file_path = os.path.join(subDir, filenm )
+                with pfDAB_inst.stage('load', **stage_args):
+                    records = cedalion.io.read_snirf( file_path ) 
 
-            recTmp = records[0]
+                    recTmp = records[0]
 
-            foo = file_path[:-5] + '_events.tsv'
-            # check if the events.tsv file exists
-            if not os.path.exists( foo ):  # !!! assert?
-                print( f"Error: File {foo} does not exist" )
-            else:
-                stim_df = pd.read_csv( file_path[:-5] + '_events.tsv', sep='\t' )
-                recTmp.stim = stim_df
+                    foo = file_path[:-5] + '_events.tsv'
+                    # check if the events.tsv file exists
+                    if not os.path.exists( foo ):  # !!! assert?
+                        print( f"Error: File {foo} does not exist" )
+                    else:
+                        stim_df = pd.read_csv( file_path[:-5] + '_events.tsv', sep='\t' )
+                        recTmp.stim = stim_df
                 
-            # Walking filter checks:
-            if cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm']:
+                # Walking filter checks:
+                if cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm']:
                 
-                # Check if walking condition exists in rec.stim, if no then sets flag_do_imu_glm to false
-                if not recTmp.stim.isin(["start_walk", "end_walk"]).any().any():
-                    cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm'] = False
-                    print("No walking condition found in events.tsv. Skipping imu glm filtering step.")
+                    # Check if walking condition exists in rec.stim, if no then sets flag_do_imu_glm to false
+                    if not recTmp.stim.isin(["start_walk", "end_walk"]).any().any():
+                        cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm'] = False
+                        print("No walking condition found in events.tsv. Skipping imu glm filtering step.")
                     
-                 # Check if at least 1 imu value (using ACCEL_X) is non-zero (making sure there is imu data in snirf)
-                if not np.any(recTmp.aux_ts['ACCEL_X'] != 0):   # !!! this might not always work and I'm only checking aux_x
-                    cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm'] = False
-                    print("There is no valid imu data in aux, skipping walking filter")
+                     # Check if at least 1 imu value (using ACCEL_X) is non-zero (making sure there is imu data in snirf)
+                    if not np.any(recTmp.aux_ts['ACCEL_X'] != 0):   # !!! this might not always work and I'm only checking aux_x
+                        cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm'] = False
+                        print("There is no valid imu data in aux, skipping walking filter")
 
 
-            recTmp = preprocess( recTmp, cfg_preprocess['median_filt'] )
-            recTmp, chs_pruned, sci, psp = pruneChannels( recTmp, cfg_preprocess['cfg_prune'] )
+                with pfDAB_inst.stage('median_filt', **stage_args):
+                    recTmp = preprocess( recTmp, cfg_preprocess['median_filt'] )
+                with pfDAB_inst.stage('prune', **stage_args):
+                    recTmp, chs_pruned, sci, psp = pruneChannels( recTmp, cfg_preprocess['cfg_prune'] )
             
-            pruned_chans = chs_pruned.where(chs_pruned != 0.4, drop=True).channel.values # get array of channels that were pruned
-
-            # Calculate OD 
-            # if flag pruned channels is True, then do rest of preprocessing on pruned amp, if not then do preprocessing on unpruned data
-            if cfg_preprocess['flag_prune_channels']:
-                recTmp["od"] = cedalion.nirs.int2od(recTmp['amp_pruned'])                
-            else:
-                recTmp["od"] = cedalion.nirs.int2od(recTmp['amp'])
-                del recTmp.timeseries['amp_pruned']   # delete pruned amp from time series
+                pruned_chans = chs_pruned.where(chs_pruned != 0.4, drop=True).channel.values # get array of channels that were pruned
+
+                # Calculate OD 
+                # if flag pruned channels is True, then do rest of preprocessing on pruned amp, if not then do preprocessing on unpruned data
+                if cfg_preprocess['flag_prune_channels']:
+                    recTmp["od"] = cedalion.nirs.int2od(recTmp['amp_pruned'])                
+                else:
+                    recTmp["od"] = cedalion.nirs.int2od(recTmp['amp'])
+                    del recTmp.timeseries['amp_pruned']   # delete pruned amp from time series
             
-            # Calculate GVTD on pruned data
-            amp_masked = prune_mask_ts(recTmp['amp'], pruned_chans)  # use chs_pruned to get gvtd w/out pruned data (could also zscore in gvtd func)
-            recTmp.aux_ts["gvtd"], _ = quality.gvtd(amp_masked) 
+                # Calculate GVTD on pruned data
+                with pfDAB_inst.stage('qc_metrics', **stage_args):
+                    recTmp.aux_ts["gvtd"] = pfDAB_qual.gvtd_od(recTmp['od'], pruned_chans)  # pruned channels are excluded from the gvtd
             
-            # Walking filter
-            if cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm']: 
-                print('Starting imu glm filtering step on walking portion of data.')
-                recTmp["od_corrected"] = pfDAB_imu.filterWalking(recTmp, "od", cfg_preprocess['cfg_motion_correct']['cfg_imu_glm'], filenm, cfg_dataset['root_dir'])
+                # Walking filter
+                if cfg_preprocess['cfg_motion_correct']['flag_do_imu_glm']: 
+                    print('Starting imu glm filtering step on walking portion of data.')
+                    with pfDAB_inst.stage('imu_glm', **stage_args):
+                        recTmp["od_corrected"] = pfDAB_imu.filterWalking(recTmp, "od", cfg_preprocess['cfg_motion_correct']['cfg_imu_glm'], filenm, cfg_dataset['root_dir'], dqr_renderer)
                 
-            # Get the slope of 'od' before motion correction and any bandpass filtering
-            slope_base = quant_slope(recTmp, "od", True)
-
-            # Spline SG # !!! fix me in future
-            # if cfg_preprocess['cfg_motion_correct']['flag_do_splineSG']:
-            #     recTmp, slope = motionCorrect_SplineSG( recTmp, cfg_preprocess['cfg_bandpass'] ) 
-            # else:
-            #     slope = None
+                # Get the slope of 'od' before motion correction and any bandpass filtering
+                with pfDAB_inst.stage('qc_metrics', **stage_args):
+                    slope_base = quant_slope(recTmp, "od", True)
+
+                # Spline SG # !!! fix me in future
+                # if cfg_preprocess['cfg_motion_correct']['flag_do_splineSG']:
+                #     recTmp, slope = motionCorrect_SplineSG( recTmp, cfg_preprocess['cfg_bandpass'] ) 
+                # else:
+                #     slope = None
             
-            # TDDR
-            if cfg_preprocess['cfg_motion_correct']['flag_do_tddr']:
-                if 'od_corrected' in recTmp.timeseries.keys():
-                    recTmp['od_corrected'] = motion_correct.tddr( recTmp['od_corrected'] )  
-                else:   # do tddr on uncorrected od
-                    recTmp['od_corrected'] = motion_correct.tddr( recTmp['od'] )  
-            else:
-                if 'od_corrected' not in recTmp.timeseries.keys():
-                    recTmp['od_corrected'] = recTmp['od']
+                # TDDR
+                if cfg_preprocess['cfg_motion_correct']['flag_do_tddr']:
+                    with pfDAB_inst.stage('tddr', **stage_args):
+                        if 'od_corrected' in recTmp.timeseries.keys():
+                            recTmp['od_corrected'] = motion_correct.tddr( recTmp['od_corrected'] )  
+                        else:   # do tddr on uncorrected od
+                            recTmp['od_corrected'] = motion_correct.tddr( recTmp['od'] )  
+                else:
+                    if 'od_corrected' not in recTmp.timeseries.keys():
+                        recTmp['od_corrected'] = recTmp['od']
             
-            # Get slopes after TDDR before bandpass filtering
-            slope_corrected = quant_slope(recTmp, "od_corrected", False)  
-            
-            
-            # GVTD for Corrected od before bandpass filtering
-            amp_corrected = recTmp['od_corrected'].copy()  
-            amp_corrected.values = np.exp(-amp_corrected.values)
-            amp_corrected_masked = prune_mask_ts(amp_corrected, pruned_chans)  # get "pruned" amp data post tddr
-            recTmp.aux_ts['gvtd_corrected'], _ = quality.gvtd(amp_corrected_masked)    
+                # Get slopes after TDDR before bandpass filtering
+                with pfDAB_inst.stage('qc_metrics', **stage_args):
+                    slope_corrected = quant_slope(recTmp, "od_corrected", False)  
+
+                    # GVTD for Corrected od before bandpass filtering
+                    recTmp.aux_ts['gvtd_corrected'] = pfDAB_qual.gvtd_od(recTmp['od_corrected'], pruned_chans)  # no need to convert back to amp
+
+                    # motion artifacts before and after correction, written to the motion QC tables
+                    tInc_all, n_events = pfDAB_qual.motion_artifact_stats( recTmp, ['od', 'od_corrected'] )
+                    recTmp.aux_ts['tInc_all_corrected'] = tInc_all.sel(variant='od_corrected', drop=True)
+
+                    df_motion_channel, df_motion_time = pfDAB_qc.get_motion_qc( subj_ids[subj_idx], filenm, tInc_all, n_events )
+                    pfDAB_qc.write_file_qc( cfg_dataset['root_dir'], filenm, df_motion_channel = df_motion_channel, df_motion_time = df_motion_time )
             
             
-            # Bandpass filter od_tddr
-            fmin = cfg_preprocess['cfg_bandpass']['fmin']
-            fmax = cfg_preprocess['cfg_bandpass']['fmax']
-            recTmp['od_corrected'] = cedalion.sigproc.frequency.freq_filter(recTmp['od_corrected'], fmin, fmax)  
+                # Bandpass filter od_corrected
+                fmin = cfg_preprocess['cfg_bandpass']['fmin']
+                fmax = cfg_preprocess['cfg_bandpass']['fmax']
+                with pfDAB_inst.stage('bandpass', **stage_args):
+                    recTmp['od_corrected'] = cedalion.sigproc.frequency.freq_filter(recTmp['od_corrected'], fmin, fmax)  
             
-            # Convert OD to Conc
-            dpf = xr.DataArray(
-                [1, 1],
-                dims="wavelength",
-                coords={"wavelength": recTmp['amp'].wavelength},
-            )
+                # Convert OD to Conc
+                dpf = xr.DataArray(
+                    [1, 1],
+                    dims="wavelength",
+                    coords={"wavelength": recTmp['amp'].wavelength},
+                )
             
            
-            # Conc
-            recTmp['conc'] = cedalion.nirs.od2conc(recTmp['od_corrected'], recTmp.geo3d, dpf, spectrum="prahl")
-
-            # GLM filtering step
-            if cfg_preprocess['flag_do_GLM_filter']:
-                recTmp = GLM(recTmp, 'conc', cfg_preprocess['cfg_GLM'])
+                # Conc
+                with pfDAB_inst.stage('conc', **stage_args):
+                    recTmp['conc'] = cedalion.nirs.od2conc(recTmp['od_corrected'], recTmp.geo3d, dpf, spectrum="prahl")
+
+                # GLM filtering step
+                if cfg_preprocess['flag_do_GLM_filter']:
+                    with pfDAB_inst.stage('glm_filter', **stage_args):
+                        recTmp = GLM(recTmp, 'conc', cfg_preprocess['cfg_GLM'])
                 
-                recTmp['od_corrected'] = cedalion.nirs.conc2od(recTmp['conc'], recTmp.geo3d, dpf)  # Convert GLM filtered data back to OD
-                recTmp['od_corrected'] = recTmp['od_corrected'].transpose('channel', 'wavelength', 'time') # need to transpose to match recTmp['od'] bc conc2od switches the axes
+                        recTmp['od_corrected'] = cedalion.nirs.conc2od(recTmp['conc'], recTmp.geo3d, dpf)  # Convert GLM filtered data back to OD
+                        recTmp['od_corrected'] = recTmp['od_corrected'].transpose('channel', 'wavelength', 'time') # need to transpose to match recTmp['od'] bc conc2od switches the axes
             
-            #
-            # Plot DQRs
-            #
+                #
+                # Plot DQRs
+                #
            
-            lambda0 = amp_masked.wavelength[0].wavelength.values
-            lambda1 = amp_masked.wavelength[1].wavelength.values
-            snr0, _ = quality.snr(amp_masked.sel(wavelength=lambda0), cfg_preprocess['cfg_prune']['snr_thresh'])
-            snr1, _ = quality.snr(amp_masked.sel(wavelength=lambda1), cfg_preprocess['cfg_prune']['snr_thresh'])
+                with pfDAB_inst.stage('dqr', **stage_args):
+                    # SNR of the unpruned channels. Mask the (channel, wavelength) result rather than the time series
+                    snr, _ = quality.snr(recTmp['amp'], cfg_preprocess['cfg_prune']['snr_thresh'])
+                    snr_unpruned = snr.where(~snr.channel.isin(pruned_chans))
+                    snr0 = snr_unpruned.isel(wavelength=0)
+                    snr1 = snr_unpruned.isel(wavelength=1)
 
             
-            pfDAB_dqr.plotDQR( recTmp, chs_pruned, cfg_preprocess, filenm, cfg_dataset['root_dir'], cfg_dataset['cfg_hrf']['stim_lst'] )
+                    pfDAB_dqr.plotDQR( recTmp, chs_pruned, cfg_preprocess, filenm, cfg_dataset['root_dir'], cfg_dataset['cfg_hrf']['stim_lst'], dqr_renderer )
             
-            # Plot slope before and after MA
-            if cfg_preprocess['cfg_motion_correct']['flag_do_tddr']:
-                pfDAB_dqr.plot_slope(recTmp, [slope_base, slope_corrected], cfg_preprocess, filenm, cfg_dataset['root_dir'])
-
-            # load the sidecar json file 
-            if os.path.exists(file_path + '.json'):
-                with open(file_path + '.json') as json_file:
-                    file_json = json.load(json_file)
-                if 'dataSDWP_LowHigh' in file_json:
-                    pfDAB_dqr.plotDQR_sidecar(file_json, recTmp, cfg_dataset['root_dir'], filenm )
-
-            snr0 = np.nanmedian(snr0.values)
-            snr1 = np.nanmedian(snr1.values)
-
-
-            #
-            # Organize the processed data
-            #
-            if subj_idx == 0 and file_idx == 0:
-                rec = []
-                chs_pruned_subjs = []
-                slope_base_subjs = []
-                slope_corrected_subjs = []
-                gvtd_corrected_subjs = []
-                snr0_subjs = []
-                snr1_subjs = []
-
-                rec.append( [recTmp] )
-                chs_pruned_subjs.append( [chs_pruned] )
-                slope_base_subjs.append( [slope_base] )
-                slope_corrected_subjs.append( [slope_corrected] )
-                gvtd_corrected_subjs.append( [np.nanmean(recTmp.aux_ts['gvtd_corrected'].values)] )
-                snr0_subjs.append( [snr0] )
-                snr1_subjs.append( [snr1] )
-            elif file_idx == 0:
-                rec.append( [recTmp] )
-                chs_pruned_subjs.append( [chs_pruned] )
-                slope_base_subjs.append( [slope_base] )
-                slope_corrected_subjs.append( [slope_corrected] )
-                gvtd_corrected_subjs.append( [np.nanmean(recTmp.aux_ts['gvtd_corrected'].values)] )
-                snr0_subjs.append( [snr0] )
-                snr1_subjs.append( [snr1] )
-            else:
-                rec[subj_idx].append( recTmp )
-                chs_pruned_subjs[subj_idx].append( chs_pruned )
-                slope_base_subjs[subj_idx].append( slope_base )
-                slope_corrected_subjs[subj_idx].append( slope_corrected )
-                gvtd_corrected_subjs[subj_idx].append( np.nanmean(recTmp.aux_ts['gvtd_corrected'].values) )
-                snr0_subjs[subj_idx].append( snr0 )
-                snr1_subjs[subj_idx].append( snr1 )
-
-        # End of file loop
-    # End of subject loop
-
-    # plot the group DQR
-    pfDAB_dqr.plot_group_dqr( n_subjects, n_files_per_subject, chs_pruned_subjs, slope_base_subjs, slope_corrected_subjs, gvtd_corrected_subjs, snr0_subjs, snr1_subjs, cfg_dataset['subj_ids'], cfg_dataset['subj_id_exclude'], rec, cfg_dataset['root_dir'], flag_plot=False )
-    # !!! plot_group_dqr will fail if no tddr ?
-
+                    # Plot slope before and after MA
+                    if cfg_preprocess['cfg_motion_correct']['flag_do_tddr']:
+                        pfDAB_dqr.plot_slope(recTmp, [slope_base, slope_corrected], cfg_preprocess, filenm, cfg_dataset['root_dir'], dqr_renderer)
+
+                    # load the sidecar json file (parsed once and cached next to the snirf file)
+                    sidecar = pfDAB_sidecar.load_sidecar(file_path)
+                    if sidecar is not None:
+                        pfDAB_dqr.plotDQR_sidecar(sidecar, recTmp, cfg_dataset['root_dir'], filenm, dqr_renderer )
+
+                    snr0 = np.nanmedian(snr0.values)
+                    snr1 = np.nanmedian(snr1.values)
+
+                    # write the QC metrics of this file to the dataset QC tables
+                    df_qc_file, df_qc_channel = pfDAB_qc.get_file_qc( subj_ids[subj_idx], cfg_dataset['file_ids'][file_idx], filenm, recTmp, chs_pruned, snr, slope_base, slope_corrected )
+                    pfDAB_qc.write_file_qc( cfg_dataset['root_dir'], filenm, df_qc_file, df_qc_channel )
+
+
+                #
+                # Organize the processed data
+                #
+                pfDAB_ds.add_run( dataset, subj_ids[subj_idx], cfg_dataset['file_ids'][file_idx], {
+                    'rec' : recTmp,
+                    'filenm' : filenm,
+                    'chs_pruned' : chs_pruned,
+                    'slope_base' : slope_base,
+                    'slope_corrected' : slope_corrected,
+                    'gvtd_corrected' : np.nanmean(recTmp.aux_ts['gvtd_corrected'].values),
+                    'snr0' : snr0,
+                    'snr1' : snr1,
+                    } )
+
+            # End of file loop
+        # End of subject loop
+
+        # plot the group DQR
+        with pfDAB_inst.stage('dqr_group'):
+            subj_lists = {key : pfDAB_ds.get_subj_lists( dataset, key ) for key in pfDAB_ds.run_keys}
+            pfDAB_dqr.plot_group_dqr( n_subjects, n_files_per_subject, subj_lists['chs_pruned'], subj_lists['slope_base'], subj_lists['slope_corrected'], subj_lists['gvtd_corrected'], subj_lists['snr0'], subj_lists['snr1'], cfg_dataset['subj_ids'], cfg_dataset['subj_id_exclude'], subj_lists['rec'], cfg_dataset['root_dir'], flag_plot=False )
+        # !!! plot_group_dqr will fail if no tddr ?
+    finally:
+        # wait for the background DQR figures to be written
+        with pfDAB_inst.stage('dqr_finish'):
+            pfDAB_render.finish( dqr_renderer )
     
-    return rec, chs_pruned_subjs
+    return dataset
 
 
 #%%
@@ -427,9 +461,13 @@ def GLM(rec, rec_str, cfg_GLM):
     betas = glm.fit(rec[rec_str], dm, channel_wise_regressors, noise_model=cfg_GLM['noise_model'])
     
     pred_all = glm.predict(rec[rec_str], betas, dm, channel_wise_regressors)
-    pred_all = pred_all.pint.quantify('micromolar')
     
-    residual = rec[rec_str] - pred_all
+    # the predictions are in micromolar, subtract them without units (see module_units)
+    y, y_units = pfDAB_units.strip_units(rec[rec_str])
+    if y_units is None:
+        raise ValueError(f'{rec_str} has no units, the GLM filter expects a concentration time series')
+    y = y * pfDAB_units.get_magnitude(1 * y_units, units.micromolar)
+    residual = y - pred_all
     
     # prediction of all HRF regressors, i.e. all regressors that start with 'HRF '
     pred_hrf = glm.predict(
@@ -439,9 +477,7 @@ def GLM(rec, rec_str, cfg_GLM):
                             channel_wise_regressors
                         )
     
-    pred_hrf = pred_hrf.pint.quantify('micromolar')
-    
-    rec[rec_str] = pred_hrf + residual 
+    rec[rec_str] = pfDAB_units.attach_units(pred_hrf + residual, units.micromolar)
     
     #### get average HRF prediction 
     rec[rec_str] = rec[rec_str].transpose('chromo', 'channel', 'time')
@@ -512,8 +548,7 @@ def Conc( rec = None ):
 
 def quant_slope(rec, timeseries, dequantify):
     if dequantify:
-        foo = rec[timeseries].copy()
-        foo = foo.pint.dequantify()
+        foo, _ = pfDAB_units.strip_units(rec[timeseries])
         slope = foo.polyfit(dim='time', deg=1).sel(degree=1)
     else:
         slope = rec[timeseries].polyfit(dim='time', deg=1).sel(degree=1)
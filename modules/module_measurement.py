@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Flat measurement layout of the (channel, wavelength) data.
+
+Image recon, C_meas and the ICA use a flat measurement dim with all channels of the first
+wavelength followed by all channels of the second wavelength, i.e. what
+
+    da.stack(measurement=('channel', 'wavelength')).sortby('wavelength')
+
+gives. stack_measurement gives the same DataArray by transposing the data to
+(..., wavelength, channel) and reshaping it, which is a view when the data already has that
+layout, instead of stacking and then sorting (and copying) along the new MultiIndex.
+The measurement index of a channel / wavelength set is built once and cached.
+unstack_measurement is the inverse.
+
+The same works for 'chromo' instead of 'wavelength' (meas_dim='chromo').
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# (channel, wavelength) values and dim names -> measurement MultiIndex
+_measurement_index_cache = {}
+_measurement_coords_cache = {}
+
+
+def get_measurement_index(channel, wavelength, meas_dim = 'wavelength'):
+    '''
+    The measurement MultiIndex (levels channel and meas_dim) of the flat layout,
+    channels within wavelength. Cached.
+    '''
+    channel = np.asarray(channel)
+    wavelength = np.asarray(wavelength)
+    key = (meas_dim, channel.dtype.str, channel.tobytes(), wavelength.dtype.str, wavelength.tobytes())
+
+    if key not in _measurement_index_cache:
+        n_chs = len(channel)
+        n_wav = len(wavelength)
+        _measurement_index_cache[key] = pd.MultiIndex(
+            levels = [pd.Index(channel), pd.Index(wavelength)],
+            codes = [np.tile(np.arange(n_chs), n_wav), np.repeat(np.arange(n_wav), n_chs)],
+            names = ['channel', meas_dim],
+            )
+
+    return _measurement_index_cache[key]
+
+
+def stack_measurement(da, meas_dim = 'wavelength'):
+    '''
+    Same as da.stack(measurement=('channel', meas_dim)).sortby(meas_dim): the other dims
+    keep their order and measurement is the last dim.
+    '''
+    # coords that are not simply along channel or meas_dim are left to xarray
+    for name, coord in da.coords.items():
+        if name not in ['channel', meas_dim] and ('channel' in coord.dims or meas_dim in coord.dims) and len(coord.dims) > 1:
+            return da.stack(measurement=('channel', meas_dim)).sortby(meas_dim)
+
+    if not da.indexes[meas_dim].is_monotonic_increasing:
+        da = da.sortby(meas_dim)
+
+    other_dims = [dim for dim in da.dims if dim not in ['channel', meas_dim]]
+    da_t = da.transpose(*other_dims, meas_dim, 'channel')
+    n_wav = da.sizes[meas_dim]
+    n_chs = da.sizes['channel']
+    data = da_t.data.reshape(da_t.shape[:-2] + (n_wav * n_chs,))
+
+    midx = get_measurement_index(da.channel.values, da[meas_dim].values, meas_dim)
+    midx_coords = _get_measurement_coords(midx)
+
+    # build the coords in one go, assign_coords aligns every time and is slower than the reshape
+    variables = dict(midx_coords.variables)
+    indexes = dict(midx_coords.xindexes)
+    idx_chs = midx.codes[0]
+    idx_wav = midx.codes[1]
+    for name, coord in da.coords.items():
+        if name in ['channel', meas_dim]:
+            continue
+        if coord.dims == ('channel',):
+            variables[name] = xr.Variable('measurement', coord.values[idx_chs], coord.attrs)
+        elif coord.dims == (meas_dim,):
+            variables[name] = xr.Variable('measurement', coord.values[idx_wav], coord.attrs)
+        else:
+            variables[name] = coord.variable
+            if name in da.xindexes:
+                indexes[name] = da.xindexes[name]
+
+    return xr.DataArray(data, coords=xr.Coordinates(variables, indexes), dims=other_dims + ['measurement'], name=da.name, attrs=da.attrs)
+
+
+def _get_measurement_coords(midx):
+    # the measurement coords of a cached MultiIndex, cached with it
+    key = id(midx)
+    if key not in _measurement_coords_cache:
+        _measurement_coords_cache[key] = xr.Coordinates.from_pandas_multiindex(midx, 'measurement')
+    return _measurement_coords_cache[key]
+
+
+def unstack_measurement(da, meas_dim = 'wavelength'):
+    '''
+    Inverse of stack_measurement: the measurement dim (channels within meas_dim) becomes the
+    channel and meas_dim dims at the end. Coords along measurement that are the same for all
+    wavelengths (e.g. source and detector) become channel coords.
+    '''
+    n_wav = len(da.indexes['measurement'].levels[1])
+    n_chs = da.sizes['measurement'] // n_wav
+    channel = da['channel'].values[:n_chs]
+    wavelength = da[meas_dim].values[::n_chs]
+
+    if not np.array_equal(da.indexes['measurement'], get_measurement_index(channel, wavelength, meas_dim)):
+        raise ValueError('The measurement dim is not in the channel within wavelength layout, use unstack')
+
+    other_dims = [dim for dim in da.dims if dim != 'measurement']
+    da_t = da.transpose(*other_dims, 'measurement')
+    data = da_t.data.reshape(da_t.shape[:-1] + (n_wav, n_chs))
+    data = np.swapaxes(data, -1, -2)
+
+    coords = {'channel' : channel, meas_dim : wavelength}
+    for name, coord in da.coords.items():
+        if name in ['measurement', 'channel', meas_dim]:
+            continue
+        if coord.dims == ('measurement',):
+            values = coord.values.reshape(n_wav, n_chs)
+            if (values == values[0]).all():
+                coords[name] = ('channel', values[0], coord.attrs)
+            else:
+                coords[name] = (('channel', meas_dim), values.T, coord.attrs)
+        else:
+            coords[name] = coord
+
+    return xr.DataArray(data, dims=other_dims + ['channel', meas_dim], coords=coords, name=da.name, attrs=da.attrs)
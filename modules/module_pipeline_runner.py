@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Run the analysis as a DAG of stages with cached outputs.
+
+A stage is a dict
+
+    {'name' : 'block_average',
+     'fn' : run_block_average,                 # module level function
+     'inputs' : ['rec', 'chs_pruned_subjs'],   # outputs of other stages
+     'outputs' : ['blockaverage_results'],
+     'cfg' : cfg_blockavg}                     # parameters, part of the cache key
+
+fn is called as fn(cfg, **inputs) and returns its outputs as a dict, a tuple in the order
+of 'outputs', or a single value when there is one output.
+
+Every output is written to <cache_dir>/<output>.pkl.gz as soon as its stage finishes and the
+stage is recorded in <cache_dir>/manifest.json with a key built from the stage name, the
+source code of fn and of the modules of this directory it uses (directly or through other
+modules), cfg, cfg_runner['code_version'] and the keys of the stages it depends on. On the next run a stage is
+skipped when its key is unchanged, its outputs exist and it ran on the latest outputs of its
+upstream stages. A stage whose cfg, code or inputs
+changed is rerun together with everything downstream of it, so a crashed run resumes from the
+last completed stage instead of starting over from the SNIRF files. Changes of other code
+(e.g. an update of cedalion) are not detected, change cfg_runner['code_version'] or use
+cfg_runner['force'] then.
+
+With cfg_runner['n_workers'] > 1 the stages whose inputs are ready run in parallel in worker
+processes (forked, so the stage functions of the pipeline script do not need an import guard).
+Each worker gets cfg_runner['n_threads_per_worker'] BLAS threads, by default the cores divided
+by the workers, and every stage runs with the threads set for it in module_threads.configure.
+"""
+
+import os
+import gzip
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+import module_instrument as pfDAB_inst
+import module_threads as pfDAB_threads
+
+
+cfg_runner_default = {
+    'n_workers' : 1,            # > 1 runs independent stages in parallel
+    'executor' : 'process',     # 'process' or 'thread' for n_workers > 1
+    'n_threads_per_worker' : None,  # BLAS threads of each worker process, None splits the cores evenly (see module_threads)
+    'force' : [],               # stages to rerun even if they are fresh (their downstream stages rerun too)
+    'targets' : None,           # only run these stages and what they depend on. None runs all stages
+    'code_version' : '',        # part of every stage key, change it to rerun all stages after e.g. a cedalion update
+    }
+
+
+def run_pipeline( stages, cache_dir, cfg_runner = None ):
+    '''
+    Run the stages that are not fresh, in dependency order.
+
+    Parameters
+    ----------
+    stages : list of dict
+        the stages, see the module docstring. The order does not matter.
+    cache_dir : str
+        directory for the stage outputs and the manifest.
+    cfg_runner : dict, optional
+        overrides for cfg_runner_default.
+
+    Returns
+    -------
+    status : dict
+        'skipped', 'done' or 'failed: <error>' for every stage that was considered.
+        Load the outputs with load_output(cache_dir, name).
+
+    '''
+    cfg_runner = {**cfg_runner_default, **(cfg_runner or {})}
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    stages = get_stage_order( stages, cfg_runner['targets'] )
+    stage_dict = {stage['name'] : stage for stage in stages}
+    producer = {output : stage['name'] for stage in stages for output in stage['outputs']}
+
+    manifest = _load_manifest( cache_dir )
+
+    # the key of a stage depends on the keys of its upstream stages, so a change propagates downstream
+    keys = {}
+    stale = set()
+    deps = {}
+    for stage in stages:
+        deps[stage['name']] = sorted(set(producer[inp] for inp in stage['inputs']))
+        keys[stage['name']] = _get_stage_key( stage, [keys[dep] for dep in deps[stage['name']]], cfg_runner['code_version'] )
+
+        flag_fresh = _is_fresh( manifest, cache_dir, stage, keys[stage['name']], deps[stage['name']] )
+        if not flag_fresh or stage['name'] in cfg_runner['force'] or any(dep in stale for dep in deps[stage['name']]):
+            stale.add(stage['name'])
+
+    status = {stage['name'] : 'skipped' for stage in stages if stage['name'] not in stale}
+    for name in status:
+        print(f'Stage {name} is up to date, skipping')
+
+    # run the stale stages as soon as their upstream stages are done
+    pending = [stage['name'] for stage in stages if stage['name'] in stale]
+    running = {}
+    executor = _get_executor( cfg_runner ) if cfg_runner['n_workers'] > 1 else None
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+
+            ready = [name for name in pending if all(producer[inp] in status and status[producer[inp]] in ['skipped', 'done'] for inp in stage_dict[name]['inputs'])]
+            blocked = [name for name in pending if any(status.get(producer[inp], '').startswith('failed') for inp in stage_dict[name]['inputs'])]
+
+            for name in blocked:
+                pending.remove(name)
+                status[name] = 'failed: upstream stage failed'
+                print(f'Stage {name} not run because an upstream stage failed')
+
+            for name in ready:
+                pending.remove(name)
+                print(f'Running stage {name}')
+                if executor is None:
+                    status[name] = _finish_stage( manifest, cache_dir, stage_dict[name], keys[name], deps[name], _run_stage_safe, (stage_dict[name], cache_dir) )
+                else:
+                    running[executor.submit(_run_stage_safe, stage_dict[name], cache_dir)] = name
+
+            if len(running) > 0:
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status[name] = _finish_stage( manifest, cache_dir, stage_dict[name], keys[name], deps[name], future.result )
+            elif len(ready) == 0 and len(blocked) == 0 and len(pending) > 0:
+                raise RuntimeError(f'Stages {pending} can not run, check their inputs')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return status
+
+
+def get_stage_order( stages, targets = None ):
+    '''
+    Check the stages and return them in dependency order. If targets is given only the
+    target stages and the stages they depend on are returned.
+    '''
+    stage_dict = {}
+    producer = {}
+    for stage in stages:
+        for key in ['name', 'fn', 'inputs', 'outputs']:
+            if key not in stage:
+                raise ValueError(f"Stage {stage.get('name', stage)} has no '{key}'")
+        if stage['name'] in stage_dict:
+            raise ValueError(f"Stage name '{stage['name']}' is used twice")
+        stage_dict[stage['name']] = stage
+        for output in stage['outputs']:
+            if output in producer:
+                raise ValueError(f"Output '{output}' is produced by the stages {producer[output]} and {stage['name']}")
+            producer[output] = stage['name']
+
+    for stage in stages:
+        for inp in stage['inputs']:
+            if inp not in producer:
+                raise ValueError(f"Input '{inp}' of stage {stage['name']} is not produced by any stage")
+
+    # depth first topological sort
+    order = []
+    state = {}
+    def visit( name ):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError(f'The stages have a cycle through {name}')
+        state[name] = 'visiting'
+        for inp in stage_dict[name]['inputs']:
+            visit( producer[inp] )
+        state[name] = 'done'
+        order.append( stage_dict[name] )
+
+    for name in (targets if targets is not None else stage_dict.keys()):
+        if name not in stage_dict:
+            raise ValueError(f"Unknown target stage '{name}'")
+        visit( name )
+
+    return order
+
+
+def load_output( cache_dir, name ):
+    '''
+    Load a cached stage output.
+    '''
+    with gzip.open(_get_output_path(cache_dir, name), 'rb') as f:
+        return pickle.load(f)
+
+
+def get_pipeline_status( stages, cache_dir, cfg_runner = None ):
+    '''
+    Print and return which stages would be skipped (fresh) or run (stale) by run_pipeline.
+    '''
+    cfg_runner = {**cfg_runner_default, **(cfg_runner or {})}
+    stages = get_stage_order( stages )
+    producer = {output : stage['name'] for stage in stages for output in stage['outputs']}
+    manifest = _load_manifest( cache_dir )
+
+    keys = {}
+    status = {}
+    for stage in stages:
+        deps = sorted(set(producer[inp] for inp in stage['inputs']))
+        keys[stage['name']] = _get_stage_key( stage, [keys[dep] for dep in deps], cfg_runner['code_version'] )
+        entry = manifest['stages'].get(stage['name'])
+        flag_fresh = _is_fresh( manifest, cache_dir, stage, keys[stage['name']], deps ) and all(status[dep] == 'fresh' for dep in deps)
+        status[stage['name']] = 'fresh' if flag_fresh else 'stale'
+        print(f"{stage['name']:<24} {status[stage['name']]}" + (f" (done {entry['t_done']})" if flag_fresh else ''))
+
+    return status
+
+
+def _run_stage( stage, cache_dir ):
+    # runs in the worker: load the inputs, call the stage and write its outputs
+    inputs = {inp : load_output(cache_dir, inp) for inp in stage['inputs']}
+
+    with pfDAB_inst.stage(stage['name']) as frame, pfDAB_threads.stage(stage['name']):
+        result = stage['fn']( stage.get('cfg'), **inputs )
+
+    if isinstance(result, dict) and set(result.keys()) == set(stage['outputs']):
+        outputs = result
+    elif len(stage['outputs']) == 1:
+        outputs = {stage['outputs'][0] : result}
+    else:
+        if not isinstance(result, tuple) or len(result) != len(stage['outputs']):
+            raise ValueError(f"Stage {stage['name']} must return {len(stage['outputs'])} outputs {stage['outputs']}")
+        outputs = dict(zip(stage['outputs'], result))
+
+    for name, value in outputs.items():
+        file_path = _get_output_path(cache_dir, name)
+        with gzip.open(file_path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file_path + '.tmp', file_path)   # a crash never leaves a half written output
+
+    return frame['wall_s']
+
+
+def _run_stage_safe( stage, cache_dir ):
+    # errors are returned rather than raised so a failed stage does not stop the independent branches
+    try:
+        return ('done', _run_stage( stage, cache_dir ))
+    except Exception as e:
+        return ('failed', f'{type(e).__name__}: {e}')
+
+
+def _is_fresh( manifest, cache_dir, stage, key, deps ):
+    # the stage ran with the same key, on the outputs of the latest runs of its upstream
+    # stages (a forced upstream stage may produce different outputs with the same key)
+    entry = manifest['stages'].get(stage['name'])
+    if entry is None or entry['key'] != key:
+        return False
+    if not all(os.path.exists(_get_output_path(cache_dir, output)) for output in stage['outputs']):
+        return False
+    return all(dep in manifest['stages'] and entry['dep_run_ids'].get(dep) == manifest['stages'][dep]['run_id'] for dep in deps)
+
+
+def _finish_stage( manifest, cache_dir, stage, key, deps, result_fn, args = () ):
+    result, info = result_fn( *args )
+
+    if result == 'failed':
+        print(f"Error: stage {stage['name']} failed: {info}")
+        manifest['stages'].pop(stage['name'], None)
+        _save_manifest( cache_dir, manifest )
+        return f'failed: {info}'
+
+    manifest['stages'][stage['name']] = {
+        'key' : key,
+        'run_id' : uuid.uuid4().hex,
+        'dep_run_ids' : {dep : manifest['stages'][dep]['run_id'] for dep in deps},
+        'outputs' : stage['outputs'],
+        'wall_s' : info,
+        't_done' : time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    _save_manifest( cache_dir, manifest )
+    print(f"Stage {stage['name']} done in {info:.1f} s")
+
+    return 'done'
+
+
+def _get_stage_key( stage, dep_keys, code_version = '' ):
+    try:
+        source = inspect.getsource(stage['fn'])
+    except (OSError, TypeError):
+        source = getattr(stage['fn'], '__qualname__', repr(stage['fn']))
+
+    cfg_str = json.dumps(stage.get('cfg'), sort_keys=True, default=_get_cfg_str)
+
+    h = hashlib.sha1()
+    for part in [stage['name'], source, cfg_str, code_version] + _get_module_hashes(stage['fn']) + list(dep_keys):
+        h.update(part.encode())
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def _get_cfg_str( value ):
+    # the cfg dicts hold pint quantities and numpy arrays. str() summarizes large arrays with
+    # '...', so arrays are hashed by their bytes
+    if hasattr(value, 'magnitude') and hasattr(value, 'units'):
+        return f'{_get_cfg_str(value.magnitude)} {value.units}'
+    if hasattr(value, 'values') and isinstance(getattr(value, 'values', None), np.ndarray):
+        value = value.values
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return str(value.tolist())
+        return f'array {value.dtype} {value.shape} ' + hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+    return str(value)
+
+
+def _get_module_hashes( fn ):
+    # hashes of the sources of the modules of this directory that fn uses, directly through
+    # its globals (e.g. pfDAB_grp_avg) or through the modules these import
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    fn_globals = getattr(fn, '__globals__', {})
+    todo = [value for name, value in fn_globals.items() if name in getattr(getattr(fn, '__code__', None), 'co_names', ())]
+    if hasattr(inspect.getmodule(fn), '__file__'):
+        todo.append(inspect.getmodule(fn))
+
+    hashes = {}
+    while len(todo) > 0:
+        module = todo.pop()
+        file_path = getattr(module, '__file__', None) if inspect.ismodule(module) else None
+        if file_path is None or file_path in hashes or os.path.dirname(os.path.abspath(file_path)) != module_dir:
+            continue
+        with open(file_path, 'rb') as f:
+            hashes[file_path] = os.path.basename(file_path) + ' ' + hashlib.sha1(f.read()).hexdigest()
+        todo.extend(value for value in vars(module).values() if inspect.ismodule(value))
+
+    return sorted(hashes.values())
+
+
+def _get_output_path( cache_dir, name ):
+    return os.path.join(cache_dir, name + '.pkl.gz')
+
+
+def _load_manifest( cache_dir ):
+    file_path = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.exists(file_path):
+        return {'stages' : {}}
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def _save_manifest( cache_dir, manifest ):
+    file_path = os.path.join(cache_dir, 'manifest.json')
+    with open(file_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def _get_executor( cfg_runner ):
+    if cfg_runner['executor'] == 'thread':
+        return ThreadPoolExecutor( max_workers = cfg_runner['n_workers'] )
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context()
+    # the workers split the cores instead of each starting a BLAS pool with all of them
+    n_threads = cfg_runner['n_threads_per_worker'] or pfDAB_threads.get_threads_per_worker( cfg_runner['n_workers'] )
+    return ProcessPoolExecutor( max_workers = cfg_runner['n_workers'], mp_context = mp_context,
+                                initializer = pfDAB_threads.init_worker, initargs = (n_threads,) )
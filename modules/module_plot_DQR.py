@@ -17,29 +17,106 @@ import numpy as np
 from scipy.signal import filtfilt
 from scipy.signal.windows import gaussian
 
+import module_quality as pfDAB_qual
+import module_dqr_render as pfDAB_render
+import module_qc_store as pfDAB_qc
+
 import pdb
 
 
-def plotDQR( rec = None, chs_pruned = None, cfg_preprocess = None, filenm = None, filepath = None, stim_lst_str = None ):
+def plotDQR( rec = None, chs_pruned = None, cfg_preprocess = None, filenm = None, filepath = None, stim_lst_str = None, dqr_renderer = None ):
+    '''
+    Plot the DQR for one file. The metrics are gathered with get_dqr_metrics() and the figure is
+    rendered by plotDQR_metrics(), either right away or by dqr_renderer (see module_dqr_render).
+    '''
+    dqr_metrics = get_dqr_metrics( rec, chs_pruned, cfg_preprocess, filenm, filepath, stim_lst_str )
+    pfDAB_render.submit( dqr_renderer, plotDQR_metrics, dqr_metrics )
+
+    return
+
+
+def get_dqr_metrics( rec = None, chs_pruned = None, cfg_preprocess = None, filenm = None, filepath = None, stim_lst_str = None ):
+    '''
+    Collect the compact metrics needed to render the DQR figure so that the time series
+    do not need to be passed to the renderer.
+    '''
+    # give a title to the figure
+    if cfg_preprocess['flag_prune_channels']:  # !!! add if puned or unpruned to title and file name? - matters for gvtd and variance
+        flag_prune = '_pruned'
+    else:
+        flag_prune = '_unpruned'
+
+    # log10 variance of OD along time axis (post correction)
+    # !!! will want to make more modular by allowing any od rec_str in future
+    variance_vals = np.log10( rec['od_corrected'].values.var(axis=2))
+    variance_vals_da = xr.DataArray(variance_vals, dims=["channel", "wavelength"], coords={"channel": rec["od"].channel, "wavelength": rec["od"].wavelength})
+
+    snr_thresh = cfg_preprocess['cfg_prune']['snr_thresh']
+    snr, snr_mask = quality.snr(rec['amp'], snr_thresh)
+
+    stim = rec.stim.copy()
+    if stim_lst_str is not None:
+        stim = stim[stim.trial_type.isin(stim_lst_str)]
+
+    dqr_metrics = {
+        'type' : 'DQR',
+        'filenm' : filenm,
+        'filepath' : filepath,
+        'fig_title' : filenm + flag_prune,
+        'ts' : get_scalp_template(rec['amp']),
+        'geo3d' : rec.geo3d,
+        'stim' : stim,
+        'stim_lst_str' : stim_lst_str,
+        'gvtd' : rec.aux_ts['gvtd'],
+        'gvtd_corrected' : rec.aux_ts['gvtd_corrected'] if 'gvtd_corrected' in rec.aux_ts.keys() else None,
+        'chs_pruned' : chs_pruned,
+        'variance' : variance_vals_da,
+        'snr' : snr,
+        'snr_mask' : snr_mask,
+        'snr_thresh' : snr_thresh
+        }
+
+    return dqr_metrics
+
+
+def get_scalp_template(ts):
+    '''
+    Return a single sample of ts. scalp_plot only needs the channel, source and detector coordinates.
+    '''
+    return ts.isel(time=slice(0, 1))
+
+
+def plotDQR_metrics( dqr_metrics ):
+    '''
+    Render and save the DQR figure from the metrics returned by get_dqr_metrics().
+    '''
+    filenm = dqr_metrics['filenm']
+    filepath = dqr_metrics['filepath']
+    fig_title = dqr_metrics['fig_title']
+    ts = dqr_metrics['ts']
+    geo3d = dqr_metrics['geo3d']
+    gvtd = dqr_metrics['gvtd']
+    gvtd_corrected = dqr_metrics['gvtd_corrected']
+    chs_pruned = dqr_metrics['chs_pruned']
+    stim_lst_str = dqr_metrics['stim_lst_str']
 
     f, ax = p.subplots(3, 2, figsize=(11, 14))
 
     # Plot GVTD
-    ax[0][0].plot( rec.aux_ts["gvtd"].time, rec.aux_ts["gvtd"], color='b', label="GVTD")
-    if 'gvtd_corrected' in rec.aux_ts.keys():
-        ax[0][0].plot( rec.aux_ts["gvtd"].time, rec.aux_ts["gvtd_corrected"], color='#ff4500', label="GVTD corrected")
+    ax[0][0].plot( gvtd.time, gvtd, color='b', label="GVTD")
+    if gvtd_corrected is not None:
+        ax[0][0].plot( gvtd.time, gvtd_corrected, color='#ff4500', label="GVTD corrected")
     ax[0][0].set_xlabel("time / s")
     ax[0][0].set_title(f"{filenm}")
-    thresh = quality._get_gvtd_threshold(rec.aux_ts['gvtd'], 'histogram_mode', n_std = 10)
+    thresh = quality._get_gvtd_threshold(gvtd, 'histogram_mode', n_std = 10)
     ax[0][0].axhline(thresh.values, color='b', linestyle='--', label=f'Thresh {thresh:.1e}')
-    if 'gvtd_corrected' in rec.aux_ts.keys():
-        thresh_corrected = quality._get_gvtd_threshold(rec.aux_ts['gvtd_corrected'], 'histogram_mode', n_std = 10)
+    if gvtd_corrected is not None:
+        thresh_corrected = quality._get_gvtd_threshold(gvtd_corrected, 'histogram_mode', n_std = 10)
         ax[0][0].axhline(thresh_corrected.values, color='#ff4500', linestyle='--', label=f'Thresh {thresh_corrected:.1e}')
     ax[0][0].legend()
 
-    stim = rec.stim.copy()
     if stim_lst_str is not None:
-        plots.plot_stim_markers(ax[0][0], stim[stim.trial_type.isin(stim_lst_str)], y=1)
+        plots.plot_stim_markers(ax[0][0], dqr_metrics['stim'], y=1)
     # add stim_lst_str to the legend
     handles, labels = ax[0][0].get_legend_handles_labels()
     labels.append(stim_lst_str)
@@ -49,8 +126,8 @@ def plotDQR( rec = None, chs_pruned = None, cfg_preprocess = None, filenm = None
     # Plot the pruned channels
     idx_good = np.where(chs_pruned.values == 0.4)[0]
     plots.scalp_plot( 
-            rec["amp"],
-            rec.geo3d,
+            ts,
+            geo3d,
             chs_pruned,
             ax[0][1],
             cmap='gist_rainbow',
@@ -62,129 +139,59 @@ def plotDQR( rec = None, chs_pruned = None, cfg_preprocess = None, filenm = None
         )
     
     
-    # plot variance of OD along time axis for wavelength 1 (post corrected) 
-    # !!! will want to make more modular by allowing any od rec_str in future
-    ax1 = ax[1][0]
-    #pdb.set_trace()
-    variance_vals = np.log10( rec['od_corrected'].values.var(axis=2))
-    variance_vals_da = xr.DataArray(variance_vals, dims=["channel", "wavelength"], coords={"channel": rec["od"].channel, "wavelength": rec["od"].wavelength})
-    max_variance = np.nanmax(variance_vals)
-    min_variance = np.nanmin(variance_vals)
-    wav = rec['amp'].wavelength.values[0]  # first wav
-    plots.scalp_plot(
-            rec["od"],
-            rec.geo3d,
-            variance_vals_da.isel(wavelength=0),  # first wav
-            ax1,
-            cmap='jet',
-            vmin=min_variance,
-            vmax=max_variance,
-            optode_labels=False,
-            title=f"OD Variance - {wav} nm",
-            optode_size=6
-        )
-    
-    # plot variance of OD along time axis for wavelength 2 (post correction) 
-    ax1 = ax[1][1]
-    variance_vals = np.log10( rec['od_corrected'].values.var(axis=2))
-    variance_vals_da = xr.DataArray(variance_vals, dims=["channel", "wavelength"], coords={"channel": rec["od"].channel, "wavelength": rec["od"].wavelength})
-    max_variance = np.nanmax(variance_vals)
-    min_variance = np.nanmin(variance_vals)
-    wav = rec['amp'].wavelength.values[1]  # 2nd wav
-    plots.scalp_plot(
-            rec["od"],
-            rec.geo3d,
-            variance_vals_da.isel(wavelength=1),  # 2nd wav
-            ax1,
-            cmap='jet',
-            vmin=min_variance,
-            vmax=max_variance,
-            optode_labels=False,
-            title=f"OD  Variance - {wav} nm",
-            optode_size=6
-        )
-
-    # Plot SNR (for wav 1)
-    ax1 = ax[2][0]
-    snr_thresh = cfg_preprocess['cfg_prune']['snr_thresh']
-    snr, snr_mask = quality.snr(rec['amp'], snr_thresh)
-    
-    snr_mask_wav = snr_mask.isel(wavelength=0)
-    num_above_thresh = snr_mask_wav.sum().item() # count 'True' (num chans where SNR > thresh)
-    
-    wav = rec['amp'].wavelength.values[0]
-    plots.scalp_plot(
-            rec["amp"],
-            rec.geo3d,
-            snr.isel(wavelength=0),
-            ax1,
-            cmap='jet',
-            vmin = 0,  #np.min(snr.isel(wavelength=0)),
-            vmax = 25,  #np.max(snr.isel(wavelength=0)),
-            optode_labels=False,
-            title=f"SNR - {wav} nm ({num_above_thresh/len(chs_pruned)*100:.1f}% chans > threshold = {snr_thresh})",
-            optode_size=6
-        )
-    
-    # Plot SNR (for wav 2)
-    ax1 = ax[2][1]
-    snr_thresh = cfg_preprocess['cfg_prune']['snr_thresh']
-    snr, snr_mask = quality.snr(rec['amp'], snr_thresh)
-    
-    snr_mask_wav = snr_mask.isel(wavelength=1)
-    num_above_thresh = snr_mask_wav.sum().item() # count 'True' (num chans where SNR > thresh)
-    
-    wav = rec['amp'].wavelength.values[1]
-    plots.scalp_plot(
-            rec["amp"],
-            rec.geo3d,
-            snr.isel(wavelength=1),
-            ax1,
-            cmap='jet',
-            vmin = 0,  #np.min(snr.isel(wavelength=1)),
-            vmax = 25,  #np.max(snr.isel(wavelength=1)),
-            optode_labels=False,
-            title=f"SNR - {wav} nm ({num_above_thresh/len(chs_pruned)*100:.1f}% chans > threshold = {snr_thresh})",
-            optode_size=6
-        )
+    # plot variance of OD along time axis for each wavelength (post corrected) 
+    variance_vals_da = dqr_metrics['variance']
+    max_variance = np.nanmax(variance_vals_da.values)
+    min_variance = np.nanmin(variance_vals_da.values)
+    for i_wav in range(2):
+        wav = ts.wavelength.values[i_wav]
+        plots.scalp_plot(
+                ts,
+                geo3d,
+                variance_vals_da.isel(wavelength=i_wav),
+                ax[1][i_wav],
+                cmap='jet',
+                vmin=min_variance,
+                vmax=max_variance,
+                optode_labels=False,
+                title=f"OD Variance - {wav} nm",
+                optode_size=6
+            )
 
+    # Plot SNR for each wavelength
+    snr = dqr_metrics['snr']
+    snr_mask = dqr_metrics['snr_mask']
+    snr_thresh = dqr_metrics['snr_thresh']
+    for i_wav in range(2):
+        snr_mask_wav = snr_mask.isel(wavelength=i_wav)
+        num_above_thresh = snr_mask_wav.sum().item() # count 'True' (num chans where SNR > thresh)
         
-    # give a title to the figure
-    if cfg_preprocess['flag_prune_channels']:  # !!! add if puned or unpruned to title and file name? - matters for gvtd and variance
-        flag_prune = '_pruned'
-    else:
-        flag_prune = '_unpruned'
-        
-    fig_title = filenm + flag_prune
-    
+        wav = ts.wavelength.values[i_wav]
+        plots.scalp_plot(
+                ts,
+                geo3d,
+                snr.isel(wavelength=i_wav),
+                ax[2][i_wav],
+                cmap='jet',
+                vmin = 0,
+                vmax = 25,
+                optode_labels=False,
+                title=f"SNR - {wav} nm ({num_above_thresh/len(chs_pruned)*100:.1f}% chans > threshold = {snr_thresh})",
+                optode_size=6
+            )
+
     p.suptitle(fig_title)
 
     p.savefig( os.path.join(filepath, 'derivatives', 'plots', 'DQR', fig_title + "_DQR.png") )
     p.close()
     
     # GVTD plots:
-    der_dir = os.path.join(filepath, 'derivatives', 'plots', 'DQR', 'gvtd')
-    if not os.path.exists(der_dir):
-        os.makedirs(der_dir)
-
-    # Plot the GVTD Histograms
-    # thresh = make_gvtd_hist(rec.aux_ts['gvtd'], plot_thresh=True, stat_type='histogram_mode', n_std=10) # !!! why recalc thresh? do we need to?
-    # p.suptitle(fig_title)
-    # p.savefig( os.path.join(filepath, 'derivatives', 'plots', 'DQR','gvtd', fig_title + "_DQR_gvtd_hist.png") )
-    # p.close()
-    
-    # if 'gvtd_corrected' in rec.aux_ts.keys():
-        # thresh_corrected = make_gvtd_hist(rec.aux_ts['gvtd_corrected'], plot_thresh=True, stat_type='histogram_mode', n_std=10)
-        # p.suptitle(fig_title)
-        # p.savefig( os.path.join(filepath, 'derivatives', 'plots', 'DQR','gvtd', fig_title + "_DQR_gvtd_hist_corrected.png") )
-        # p.close()
-    
-    if 'gvtd_corrected' in rec.aux_ts.keys():
+    if gvtd_corrected is not None:
         der_dir = os.path.join(filepath, 'derivatives', 'plots', 'DQR', 'gvtd')
         if not os.path.exists(der_dir):
             os.makedirs(der_dir)
         
-        thresh_b4, thresh_corrected = make_gvtd_hist_compare_corrected(rec.aux_ts['gvtd'], rec.aux_ts['gvtd_corrected'], plot_thresh=True, stat_type='histogram_mode', n_std=10)
+        thresh_b4, thresh_corrected = make_gvtd_hist_compare_corrected(gvtd, gvtd_corrected, plot_thresh=True, stat_type='histogram_mode', n_std=10)
         p.suptitle(filenm)
         p.savefig( os.path.join(filepath, 'derivatives', 'plots', 'DQR','gvtd', fig_title + "_DQR_gvtd_hist_compare.png") )
         p.close()
@@ -339,65 +346,70 @@ def make_gvtd_hist(gvtd_time_trace, plot_thresh=True, stat_type=None, n_std=None
 
 
 
-def plot_slope(rec = None, slope = None, cfg_preprocess=None, filenm = None, filepath = None):
+def plot_slope(rec = None, slope = None, cfg_preprocess=None, filenm = None, filepath = None, dqr_renderer = None):
     '''
     Plot slope before and after correction on a scalp plot.
     '''
+    # give a title to the figure
+    if cfg_preprocess['flag_prune_channels']:  # !!! add if puned or unpruned to title and file name? - matters for gvtd and variance
+        flag_prune = '_pruned'
+    else:
+        flag_prune = '_unpruned'
+
+    # get the slope values for each channel and change units to per 10min rather than per second
+    slope_vals_da = []
+    for slope_tmp in slope:
+        if slope_tmp is None:
+            slope_vals_da.append( None )
+        else:
+            slope_vals_da.append( xr.DataArray(slope_tmp.slope.values * 60 * 10, dims=["channel", "wavelength"], coords={"channel": rec["od"].channel, "wavelength": rec["od"].wavelength}) )
+
+    dqr_metrics = {
+        'type' : 'slope',
+        'filenm' : filenm,
+        'filepath' : filepath,
+        'fig_title' : filenm + flag_prune,
+        'ts' : get_scalp_template(rec['od']),
+        'geo3d' : rec.geo3d,
+        'slope_base' : slope_vals_da[0],
+        'slope_corrected' : slope_vals_da[1]
+        }
+    pfDAB_render.submit( dqr_renderer, plot_slope_metrics, dqr_metrics )
+
+    return
+
+
+def plot_slope_metrics( dqr_metrics ):
+    '''
+    Render and save the slope figure from the metrics collected in plot_slope().
+    '''
+    filepath = dqr_metrics['filepath']
+    fig_title = dqr_metrics['fig_title']
+
     der_dir = os.path.join(filepath, 'derivatives', 'plots', 'DQR', 'motion')
     if not os.path.exists(der_dir):
         os.makedirs(der_dir)
     
     f, ax = p.subplots(2, 1, figsize=(10, 10))
-    # plot the base slope as a scalp plot
-    # get the slope values for each channel and change units to per 10min rather than per second
-    if slope[0] is not None:
-        ax1 = ax[0]
-        slope_vals = slope[0].slope.values * 60 * 10
-        # create a data array of the slope values
-        slope_vals_da = xr.DataArray(slope_vals, dims=["channel", "wavelength"], coords={"channel": rec["od"].channel, "wavelength": rec["od"].wavelength})
+    # plot the base slope and the tddr slope as a scalp plot
+    for i_ax, slope_str, title in [(0, 'slope_base', "Baseline Slope"), (1, 'slope_corrected', "OD Corrected Slope")]:
+        slope_vals_da = dqr_metrics[slope_str]
+        if slope_vals_da is None:
+            continue
         # get max of the absolute value of the slope values
-        max_slope = np.nanmax(np.abs(slope_vals))
+        max_slope = np.nanmax(np.abs(slope_vals_da.values))
         plots.scalp_plot(
-                rec["od"],
-                rec.geo3d,
+                dqr_metrics['ts'],
+                dqr_metrics['geo3d'],
                 slope_vals_da.isel(wavelength=0),
-                ax1,
+                ax[i_ax],
                 cmap='jet',
                 vmin=-max_slope,
                 vmax=max_slope,
                 optode_labels=False,
-                title="Baseline Slope",
+                title=title,
                 optode_size=6
             )
-
-    # plot the tddr slope as a scalp plot
-    ax1 = ax[1]
-    # get the slope values for each channel and change units to per 10min rather than per second
-    slope_vals = slope[1].slope.values * 60 * 10
-    # create a data array of the slope values
-    slope_vals_da = xr.DataArray(slope_vals, dims=["channel", "wavelength"], coords={"channel": rec["od_corrected"].channel, "wavelength": rec["od_corrected"].wavelength})
-    # get max of the absolute value of the slope values
-    max_slope = np.nanmax(np.abs(slope_vals))
-    plots.scalp_plot(
-            rec["od_corrected"],
-            rec.geo3d,
-            slope_vals_da.isel(wavelength=0),
-            ax1,
-            cmap='jet',
-            vmin=-max_slope,
-            vmax=max_slope,
-            optode_labels=False,
-            title="OD Corrected Slope",
-            optode_size=6
-        )
-    
-    # give a title to the figure
-    if cfg_preprocess['flag_prune_channels']:  # !!! add if puned or unpruned to title and file name? - matters for gvtd and variance
-        flag_prune = '_pruned'
-    else:
-        flag_prune = '_unpruned'
-        
-    fig_title = filenm + flag_prune
     
     p.suptitle(fig_title)
 
@@ -409,47 +421,44 @@ def plot_slope(rec = None, slope = None, cfg_preprocess=None, filenm = None, fil
     
     
 
-def plotDQR_sidecar(file_json, rec, filepath, filenm):
-
-    # get the variables from the json file
-    dataSDWP_LowHigh = file_json['dataSDWP_LowHigh']
-    powerLevelSetting = file_json['powerLevelSetting']
-    powerLevelSetLowHigh = file_json['powerLevelSetLowHigh']
-    srcModuleGroups = file_json['srcModuleGroups']
-    dataSDWP_LowHigh = file_json['dataSDWP_LowHigh']
-
-    SDj = file_json['SD']
-    SD = SDj.copy()
-    SD['DetPos2D'] = np.array(SDj['DetPos2D'])
-    SD['SrcPos2D'] = np.array(SDj['SrcPos2D'])
-    SD['SrcPos3D'] = np.array(SDj['SrcPos3D'])
-    SD['DetPos3D'] = np.array(SDj['DetPos3D'])
-    SD['Lambda'] = np.array(SDj['Lambda'])
-    SD['MeasList'] = np.array(SDj['MeasList'])
-
-    #srcModuleGroups[2]
-    # get dimensions of dataSDWP_LowHigh
-    nSrc = len(dataSDWP_LowHigh)
-    nDet = len(dataSDWP_LowHigh[0])
-    nWav = len(dataSDWP_LowHigh[0][0])
-    nPower = len(dataSDWP_LowHigh[0][0][0])
-
-    # convert the dataSDWP_LowHigh to a numpy array
-    dataSDWP_LowHigh_np = np.zeros((nSrc, nDet, nWav, nPower))
-    for iSrc in range(nSrc):
-        for iDet in range(nDet):
-            for iWav in range(nWav):
-                for iPower in range(nPower):
-                    dataSDWP_LowHigh_np[iSrc, iDet, iWav, iPower] = dataSDWP_LowHigh[iSrc][iDet][iWav][iPower]
+def plotDQR_sidecar(sidecar, rec, filepath, filenm, dqr_renderer = None):
+    '''
+    Plot the signal vs distance, calibration and cross-talk figures from the sidecar json file.
+    sidecar is the parsed sidecar returned by module_sidecar.load_sidecar().
+    '''
+    dqr_metrics = {
+        'type' : 'sidecar',
+        'filenm' : filenm,
+        'filepath' : filepath,
+        'ts' : get_scalp_template(rec['amp']),
+        'geo3d' : rec.geo3d,
+        'sidecar' : sidecar
+        }
+    pfDAB_render.submit( dqr_renderer, plotDQR_sidecar_metrics, dqr_metrics )
+
+    return
+
+
+def plotDQR_sidecar_metrics( dqr_metrics ):
+    '''
+    Render and save the sidecar figures from the metrics collected in plotDQR_sidecar().
+    '''
+    sidecar = dqr_metrics['sidecar']
+    filepath = dqr_metrics['filepath']
+    filenm = dqr_metrics['filenm']
+    ts = dqr_metrics['ts']
+    geo3d = dqr_metrics['geo3d']
+
+    # get the variables from the parsed sidecar
+    dataSDWP_LowHigh_np = sidecar['dataSDWP_LowHigh']
+    powerLevelSetting = sidecar['powerLevelSetting']
+    srcModuleGroups = sidecar['srcModuleGroups']
+    SD = sidecar['SD']
 
     # get rho_sds
     nS = SD['SrcPos3D'].shape[0]
     nD = SD['DetPos3D'].shape[0]
-    rho_sds = np.zeros((nS, nD))
-
-    for iS in range(nS):
-        posS = np.ones((nD, 1)) * SD['SrcPos3D'][iS, :]
-        rho_sds[iS, :] = np.sqrt(np.sum((posS - SD['DetPos3D'])**2, axis=1))
+    rho_sds = sidecar['rho_sds'].copy()
 
     # Identify the first short separation detector
     lstSSr, lstSSc = np.where(rho_sds < 12)
@@ -518,17 +527,14 @@ def plotDQR_sidecar(file_json, rec, filepath, filenm):
 
     # power level setting lambda0
     lst0 = np.where(SD['MeasList'][:, 3]==1)[0]
-    power_level = []
-    for i in lst0:
-        power_level.append(powerLevelSetting[i])
     power_level = xr.DataArray(
-        power_level,
+        powerLevelSetting[lst0],
         dims="channel",
-        coords={"channel": rec["amp"].channel},
+        coords={"channel": ts.channel},
     )
     plots.scalp_plot(
-            rec["conc_tddr"],
-            rec.geo3d,
+            ts,
+            geo3d,
             power_level,
             ax[1,0],
             cmap='jet',
@@ -541,17 +547,14 @@ def plotDQR_sidecar(file_json, rec, filepath, filenm):
 
     # power level setting lambda1
     lst0 = np.where(SD['MeasList'][:, 3]==2)[0]
-    power_level = []
-    for i in lst0:
-        power_level.append(powerLevelSetting[i])
     power_level = xr.DataArray(
-        power_level,
+        powerLevelSetting[lst0],
         dims="channel",
-        coords={"channel": rec["amp"].channel},
+        coords={"channel": ts.channel},
     )
     plots.scalp_plot(
-            rec["conc_tddr"],
-            rec.geo3d,
+            ts,
+            geo3d,
             power_level,
             ax[1,1],
             cmap='jet',
@@ -576,9 +579,6 @@ def plotDQR_sidecar(file_json, rec, filepath, filenm):
     dataCrosstalk = np.zeros((len(ml), 1))
     dataCrosstalkLow = np.zeros((len(ml), 1))
 
-    # Convert dataSDWP_LowHigh to numpy array
-    dataSDWP_LowHigh_np = np.array(dataSDWP_LowHigh)
-
     for iML in range(len(ml)):
         iS = ml[iML, 0]
         iD = ml[iML, 1]
@@ -719,200 +719,189 @@ def plot_crosstalk(SD, dataCrosstalk, ax1, lst1, strTitle ):
 
 
 
-def plot_tIncCh_dqr( rec, filepath, filenm_lst, iqr_threshold_std=2, iqr_threshold_grad=1.5, flag_plot=False ):
-
+def plot_tIncCh_dqr( rec, filepath, filenm_lst, iqr_threshold_std=2, iqr_threshold_grad=1.5, flag_plot=False, dqr_renderer=None, flag_render=True ):
+    '''
+    Count the motion artifacts in 'od', 'od_corrected' and, if present, 'od_corrected_ica' of every
+    file, add the 'tInc_all_corrected' and 'tInc_all_corrected_ica' aux time series to rec, and write
+    the counts and tInc time series to the QC store (derivatives/qc/motion_*).
+    Variants that are not in a recording are skipped.
+    The DQR figure is only rendered if flag_render is True.
+    '''
     n_subjects = len(rec)
     n_files_per_subject = len(rec[0])
 
+    rec_strs = ['od', 'od_corrected', 'od_corrected_ica']
+
     # loop over the subjects
     for subj_idx in range( n_subjects ):
         for file_idx in range( n_files_per_subject ):
 
-            nan_chs = rec[subj_idx][file_idx]['od'].values
-            nan_chs = np.mean(nan_chs, axis=2) # mean over time
-            nan_chs = np.mean(nan_chs, axis=1) # mean over wavelengths
-            nan_chs = np.isnan(nan_chs) # identify channels that are NaN
-            idx_good = np.where( nan_chs == False )[0]
-            idx_pruned = np.where( nan_chs == True )[0]
-
-            #
-            # Analyze the 'od' data for motion artifacts
-            #
-            M = quality.detect_outliers(rec[subj_idx][file_idx]["od"], 1 * units.s, iqr_threshold_std, iqr_threshold_grad)
-            # get percent of unpruned channels that have no motion at each time point
-            tInc_all = M.sum( axis=1 ).sum( axis=0 ) # sum over wavelengths
-            #tInc_all = (tInc_all//2 - (len(nan_chs) - len(idx_good))) / len(nan_chs)
-            tInc_all = (1-(tInc_all//2) / len(nan_chs)) * 100
-
-            # get number of motion events per channel
-            foo = M.values
-            foo = foo.astype(int) # False=0, True=1
-            foo = np.diff(foo, axis=2) # diff along time to identify start of motion epochs
-            foo = np.where(foo==-1, 1, 0) # 1 where motion starts, 0 otherwise
-            foo = np.sum(foo, axis=2) # sum motion starts along time
-            foo = np.mean(foo, axis=1) # mean across wavelengths
-
-            tIncCh_n_per_ch = xr.DataArray(foo, dims=['channel'], coords={'channel':M.channel})
-            tIncCh_n_per_ch['source'] = M.source # add source coordinate from M
-            tIncCh_n_per_ch[idx_pruned] = np.nan # set pruned channels to nan
-
-            #
-            # analyze the 'od_tddr' data for motion artifacts
-            #
-            foo = rec[subj_idx][file_idx]['od_tddr'].copy()
-            # foo = cedalion.sigproc.frequency.freq_filter(foo, 0 * units.Hz, 1 * units.Hz)
-            # foo = foo[:,:,::3]
-            # foo = foo.interp(time=rec[subj_idx][file_idx]['od_tddr'].time) # this is done to handle when we downsample before ICA
-            M = quality.detect_outliers(foo, 1 * units.s, iqr_threshold_std, iqr_threshold_grad)
-            # get percent of unpruned channels that have no motion at each time point
-            tInc_all_tddr = M.sum( axis=1 ) # sum over wavelengths
-            tInc_all_tddr = tInc_all_tddr.sum( axis=0 ) # sum over channels
-            #tInc_tddr_all = (tIncCh_tddr_all//2 - (len(nan_chs) - len(idx_good))) / len(nan_chs)
-            tInc_all_tddr = (1-(tInc_all_tddr//2) / len(nan_chs))*100
-            rec[subj_idx][file_idx].aux_ts['tInc_all_tddr'] = tInc_all_tddr
-
-            # get number of motion events per channel
-            foo = M.values
-            foo = foo.astype(int) # False=0, True=1
-            foo = np.diff(foo, axis=2) # diff along time to identify start of motion epochs
-            foo = np.where(foo==-1, 1, 0) # 1 where motion starts, 0 otherwise
-            foo = np.sum(foo, axis=2) # sum motion starts along time
-            foo = np.mean(foo, axis=1) # mean across wavelengths
-
-            tIncCh_n_per_ch_tddr = xr.DataArray(foo, dims=['channel'], coords={'channel':M.channel})
-            tIncCh_n_per_ch_tddr['source'] = M.source # add source coordinate from M
-            tIncCh_n_per_ch_tddr[idx_pruned] = np.nan # set pruned channels to nan
-
-            #
-            # analyze the 'od_tddr_ica' data for motion artifacts
-            #
-            if 'od_tddr_ica' in rec[subj_idx][file_idx].timeseries.keys():
-                foo = rec[subj_idx][file_idx]['od_tddr_ica'].copy()
-                foo = foo.interp(time=rec[subj_idx][file_idx]['od_tddr'].time) # this is done to handle when we downsample before ICA
-                M = quality.detect_outliers(foo, 1 * units.s, iqr_threshold_std, iqr_threshold_grad)
-                # get percent of unpruned channels that have no motion at each time point
-                tInc_all_tddr_ica = M.sum( axis=1 ) # sum over wavelengths
-                tInc_all_tddr_ica = tInc_all_tddr_ica.sum( axis=0 ) # sum over channels
-                #tInc_tddr_all = (tIncCh_tddr_all//2 - (len(nan_chs) - len(idx_good))) / len(nan_chs)
-                tInc_all_tddr_ica = (1-(tInc_all_tddr_ica//2) / len(nan_chs))*100
-                rec[subj_idx][file_idx].aux_ts['tInc_all_tddr_ica'] = tInc_all_tddr_ica
-
-                # get number of motion events per channel
-                foo = M.values
-                foo = foo.astype(int) # False=0, True=1
-                foo = np.diff(foo, axis=2) # diff along time to identify start of motion epochs
-                foo = np.where(foo==-1, 1, 0) # 1 where motion starts, 0 otherwise
-                foo = np.sum(foo, axis=2) # sum motion starts along time
-                foo = np.mean(foo, axis=1) # mean across wavelengths
-
-                tIncCh_n_per_ch_tddr_ica = xr.DataArray(foo, dims=['channel'], coords={'channel':M.channel})
-                tIncCh_n_per_ch_tddr_ica['source'] = M.source # add source coordinate from M
-                tIncCh_n_per_ch_tddr_ica[idx_pruned] = np.nan # set pruned channels to nan
-
-
-            if 'od_tddr_ica' in rec[subj_idx][file_idx].timeseries.keys():
-                f, ax = p.subplots(3, 2, figsize=(9, 10))
-            else:
-                f, ax = p.subplots(2, 2, figsize=(9, 10))
-
-            plots.scalp_plot(
-                    rec[0][0]['od'],
-                    rec[0][0].geo3d,
-                    tIncCh_n_per_ch_tddr,
-                    ax[0][0],
-                    cmap='jet',
-                    optode_labels=False,
-                    optode_size=5,
-                    vmin = 0,
-                    vmax = np.min((np.nanmax(tIncCh_n_per_ch_tddr), 100)),
-                    title='# Motion Artifacts after TDDR'
-                )
-
-            plots.scalp_plot(
-                    rec[0][0]['od'],
-                    rec[0][0].geo3d,
-                    100*(1 - tIncCh_n_per_ch_tddr / tIncCh_n_per_ch),
-                    ax[0][1],
-                    cmap='jet',
-                    optode_labels=False,
-                    optode_size=5,
-                    vmin = 0,
-                    vmax = 100,
-                    title='Percent reduction '
-                )
-
-            if 'od_tddr_ica' in rec[subj_idx][file_idx].timeseries.keys():
-                plots.scalp_plot(
-                        rec[0][0]['od'],
-                        rec[0][0].geo3d,
-                        tIncCh_n_per_ch_tddr_ica,
-                        ax[1][0],
-                        cmap='jet',
-                        optode_labels=False,
-                        optode_size=5,
-                        vmin = 0,
-                        vmax = np.min((np.nanmax(tIncCh_n_per_ch_tddr_ica), 100)),
-                        title='# after TDDR ICA'
-                    )
-
-                plots.scalp_plot(
-                        rec[0][0]['od'],
-                        rec[0][0].geo3d,
-                        100*(1 - tIncCh_n_per_ch_tddr_ica / tIncCh_n_per_ch_tddr),
-                        ax[1][1],
-                        cmap='jet',
-                        optode_labels=False,
-                        optode_size=5,
-                        vmin = 0,
-                        vmax = 100,
-                        title='Percent reduction '
-                    )
-                ax1 = ax[2][0]
-                ax2 = ax[2][1]
-            else:
-                ax1 = ax[1][0]
-                ax2 = ax[1][1]
-
-            # plot the tInc_all with time and stim markers
-            ax1.plot( rec[subj_idx][file_idx]['od'].time, tInc_all_tddr, label='tInc_tddr', color='b' )
-            if 'od_tddr_ica' in rec[subj_idx][file_idx].timeseries.keys():
-                ax1.plot( rec[subj_idx][file_idx]['od'].time, tInc_all_tddr_ica, label='tInc_tddr_ica', color='m' )
-            plots.plot_stim_markers(ax1, rec[subj_idx][file_idx].stim, y=1)
-            ax1.set_title( f"Subject:{subj_idx+1}, Pruned: {(len(nan_chs)-len(idx_good))*100/len(nan_chs):.1f}%" )
-            #    p.xlabel( 'Time' )
-            #    p.ylabel( 'tInc_all' )
-            ax1.set_xlabel("time (s)")
-            ax1.grid()
-            ax1.legend()
-
-            # Plot GVTD
-            ax2.plot( rec[subj_idx][file_idx].aux_ts["gvtd"].time, rec[subj_idx][file_idx].aux_ts["gvtd_tddr"], label="GVTD TDDR", color='b') # color='#ff4500', 
-            thresh_tddr = quality.find_gvtd_thresh(rec[subj_idx][file_idx].aux_ts['gvtd_tddr'].values, quality.gvtd_stat_type.Histogram_Mode, n_std = 10)
-            ax2.axhline(thresh_tddr, color='b', linestyle='--', label=f'Thresh {thresh_tddr:.1e}')
-            if 'od_tddr_ica' in rec[subj_idx][file_idx].timeseries.keys():
-                amp_tddr = rec[subj_idx][file_idx]['od_tddr_ica'].copy()
-                amp_tddr.values = np.exp(-amp_tddr.values)
-                gvtd_tddr_ica = quality.gvtd(amp_tddr)
-                ax2.plot( rec[subj_idx][file_idx]['od_tddr_ica'].time, gvtd_tddr_ica, label="GVTD TDDR ICA", color='m' )
-                thresh_tddr = quality.find_gvtd_thresh(gvtd_tddr_ica.values, quality.gvtd_stat_type.Histogram_Mode, n_std = 10)
-                ax2.axhline(thresh_tddr, color='m', linestyle='--', label=f'Thresh {thresh_tddr:.1e}')
-            ax2.set_xlabel("time (s)")
-            plots.plot_stim_markers(ax2, rec[subj_idx][file_idx].stim, y=1)
-            ax2.legend()
-
-            # give a title to the figure and save it
+            recTmp = rec[subj_idx][file_idx]
             filenm = filenm_lst[subj_idx][file_idx]
-            p.suptitle(filenm)
-            p.savefig( os.path.join(filepath, 'derivatives', 'plots', 'DQR', filenm + '_DQR_tIncCh.png') )
-#            p.close()
 
-            if flag_plot:
-                p.show()
+            # motion artifacts of all signal variants in one pass, missing variants are skipped
+            tInc_all, tIncCh_n_per_ch = pfDAB_qual.motion_artifact_stats( recTmp, rec_strs, 1 * units.s, iqr_threshold_std, iqr_threshold_grad )
+            flag_corrected = 'od_corrected' in tInc_all.variant.values
+            flag_ica = 'od_corrected_ica' in tInc_all.variant.values
+
+            if flag_corrected:
+                recTmp.aux_ts['tInc_all_corrected'] = tInc_all.sel(variant='od_corrected', drop=True)
+            if flag_ica:
+                recTmp.aux_ts['tInc_all_corrected_ica'] = tInc_all.sel(variant='od_corrected_ica', drop=True)
+
+            # the subj_id of the cfg ('01' of 'sub-01_...'), as in the file and channel QC tables
+            subj_id = filenm.split('_')[0].replace('sub-', '')
+            df_motion_channel, df_motion_time = pfDAB_qc.get_motion_qc( subj_id, filenm, tInc_all, tIncCh_n_per_ch )
+            pfDAB_qc.write_file_qc( filepath, filenm, df_motion_channel = df_motion_channel, df_motion_time = df_motion_time )
+
+            if not flag_render:
+                continue
+            if not flag_corrected:
+                print(f'No od_corrected in {filenm}, skipping the tIncCh DQR')
+                continue
+
+            n_chs = tIncCh_n_per_ch.sizes['channel']
+            n_chs_pruned = int(np.isnan(tIncCh_n_per_ch.sel(variant='od').values).sum())
+
+            if 'gvtd_corrected' in recTmp.aux_ts.keys():
+                gvtd_corrected = recTmp.aux_ts['gvtd_corrected']
             else:
-                p.close()
+                gvtd_corrected = pfDAB_qual.gvtd_od(recTmp['od_corrected'])
+
+            dqr_metrics = {
+                'type' : 'tIncCh',
+                'filenm' : filenm,
+                'filepath' : filepath,
+                'subj_idx' : subj_idx,
+                'ts' : get_scalp_template(rec[0][0]['od']),
+                'geo3d' : rec[0][0].geo3d,
+                'stim' : recTmp.stim,
+                'time' : recTmp['od'].time,
+                'perc_pruned' : n_chs_pruned*100/n_chs,
+                'tIncCh_n_per_ch' : tIncCh_n_per_ch.sel(variant='od', drop=True),
+                'tIncCh_n_per_ch_corrected' : tIncCh_n_per_ch.sel(variant='od_corrected', drop=True),
+                'tIncCh_n_per_ch_corrected_ica' : tIncCh_n_per_ch.sel(variant='od_corrected_ica', drop=True) if flag_ica else None,
+                'tInc_all_corrected' : recTmp.aux_ts['tInc_all_corrected'],
+                'tInc_all_corrected_ica' : recTmp.aux_ts['tInc_all_corrected_ica'] if flag_ica else None,
+                'gvtd_corrected' : gvtd_corrected,
+                'gvtd_corrected_ica' : pfDAB_qual.gvtd_od(recTmp['od_corrected_ica']) if flag_ica else None,
+                'flag_plot' : flag_plot and (dqr_renderer is None or dqr_renderer['mode'] == 'inline')
+                }
+            pfDAB_render.submit( dqr_renderer, plot_tIncCh_dqr_metrics, dqr_metrics )
 
     return rec
 
+
+def plot_tIncCh_dqr_metrics( dqr_metrics ):
+    '''
+    Render and save the motion artifact figure from the metrics collected in plot_tIncCh_dqr().
+    '''
+    ts = dqr_metrics['ts']
+    geo3d = dqr_metrics['geo3d']
+    tIncCh_n_per_ch = dqr_metrics['tIncCh_n_per_ch']
+    tIncCh_n_per_ch_corrected = dqr_metrics['tIncCh_n_per_ch_corrected']
+    tIncCh_n_per_ch_corrected_ica = dqr_metrics['tIncCh_n_per_ch_corrected_ica']
+    gvtd_corrected_ica = dqr_metrics['gvtd_corrected_ica']
+    flag_ica = tIncCh_n_per_ch_corrected_ica is not None
+
+    if flag_ica:
+        f, ax = p.subplots(3, 2, figsize=(9, 10))
+    else:
+        f, ax = p.subplots(2, 2, figsize=(9, 10))
+
+    plots.scalp_plot(
+            ts,
+            geo3d,
+            tIncCh_n_per_ch_corrected,
+            ax[0][0],
+            cmap='jet',
+            optode_labels=False,
+            optode_size=5,
+            vmin = 0,
+            vmax = np.min((np.nanmax(tIncCh_n_per_ch_corrected), 100)),
+            title='# Motion Artifacts after correction'
+        )
+
+    plots.scalp_plot(
+            ts,
+            geo3d,
+            100*(1 - tIncCh_n_per_ch_corrected / tIncCh_n_per_ch),
+            ax[0][1],
+            cmap='jet',
+            optode_labels=False,
+            optode_size=5,
+            vmin = 0,
+            vmax = 100,
+            title='Percent reduction '
+        )
+
+    if flag_ica:
+        plots.scalp_plot(
+                ts,
+                geo3d,
+                tIncCh_n_per_ch_corrected_ica,
+                ax[1][0],
+                cmap='jet',
+                optode_labels=False,
+                optode_size=5,
+                vmin = 0,
+                vmax = np.min((np.nanmax(tIncCh_n_per_ch_corrected_ica), 100)),
+                title='# after correction and ICA'
+            )
+
+        plots.scalp_plot(
+                ts,
+                geo3d,
+                100*(1 - tIncCh_n_per_ch_corrected_ica / tIncCh_n_per_ch_corrected),
+                ax[1][1],
+                cmap='jet',
+                optode_labels=False,
+                optode_size=5,
+                vmin = 0,
+                vmax = 100,
+                title='Percent reduction '
+            )
+        ax1 = ax[2][0]
+        ax2 = ax[2][1]
+    else:
+        ax1 = ax[1][0]
+        ax2 = ax[1][1]
+
+    # plot the tInc_all with time and stim markers
+    ax1.plot( dqr_metrics['time'], dqr_metrics['tInc_all_corrected'], label='tInc_corrected', color='b' )
+    if flag_ica:
+        ax1.plot( dqr_metrics['time'], dqr_metrics['tInc_all_corrected_ica'], label='tInc_corrected_ica', color='m' )
+    plots.plot_stim_markers(ax1, dqr_metrics['stim'], y=1)
+    ax1.set_title( f"Subject:{dqr_metrics['subj_idx']+1}, Pruned: {dqr_metrics['perc_pruned']:.1f}%" )
+    ax1.set_xlabel("time (s)")
+    ax1.grid()
+    ax1.legend()
+
+    # Plot GVTD
+    gvtd_corrected = dqr_metrics['gvtd_corrected']
+    ax2.plot( gvtd_corrected.time, gvtd_corrected, label="GVTD corrected", color='b') # color='#ff4500', 
+    thresh_corrected = quality.find_gvtd_thresh(gvtd_corrected.values, quality.gvtd_stat_type.Histogram_Mode, n_std = 10)
+    ax2.axhline(thresh_corrected, color='b', linestyle='--', label=f'Thresh {thresh_corrected:.1e}')
+    if gvtd_corrected_ica is not None:
+        ax2.plot( gvtd_corrected_ica.time, gvtd_corrected_ica, label="GVTD corrected ICA", color='m' )
+        thresh_corrected = quality.find_gvtd_thresh(gvtd_corrected_ica.values, quality.gvtd_stat_type.Histogram_Mode, n_std = 10)
+        ax2.axhline(thresh_corrected, color='m', linestyle='--', label=f'Thresh {thresh_corrected:.1e}')
+    ax2.set_xlabel("time (s)")
+    plots.plot_stim_markers(ax2, dqr_metrics['stim'], y=1)
+    ax2.legend()
+
+    # give a title to the figure and save it
+    filenm = dqr_metrics['filenm']
+    p.suptitle(filenm)
+    p.savefig( os.path.join(dqr_metrics['filepath'], 'derivatives', 'plots', 'DQR', filenm + '_DQR_tIncCh.png') )
+
+    if dqr_metrics['flag_plot']:
+        p.show()
+    else:
+        p.close()
+
+    return
+
 # !!! plot_group_dqr will fail if no tddr ?
 def plot_group_dqr( n_subjects, n_files_per_subject, chs_pruned_subjs, slope_base_subjs, slope_corrected_subjs, gvtd_corrected_subjs, snr0_subjs, snr1_subjs, subj_ids, subj_id_exclude, rec, filepath, flag_plot = True):   
     n_subjects = n_subjects = len(subj_ids) - len(subj_id_exclude)
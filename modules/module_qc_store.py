@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Machine readable data quality (QC) metrics.
+
+load_and_preprocess writes one table row per file, one row per channel and wavelength and
+the motion artifact tables of 'od' and 'od_corrected' to derivatives/qc as soon as a file
+is processed, so the metrics survive partial runs and
+can be queried across the whole dataset, e.g.
+
+    df_file = load_qc_table(root_dir, 'file')
+    df_file[ df_file.perc_pruned > 30 ].subj_id.unique()
+
+The tables are written as Parquet files when pyarrow is installed and as csv files otherwise.
+"""
+
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    flag_parquet = True
+except ImportError:
+    flag_parquet = False
+
+# 'file'           - one row per file
+# 'channel'        - one row per channel and wavelength
+# 'motion_channel' - one row per signal variant and channel (motion artifact counts)
+# 'motion_time'    - one row per signal variant and time point (percent clean)
+qc_levels = ['file', 'channel', 'motion_channel', 'motion_time']
+
+
+def get_qc_dir(root_dir, level):
+    '''
+    Return the directory that holds the QC tables of the given level.
+    '''
+    if level not in qc_levels:
+        raise ValueError(f"Unknown QC table level '{level}'. Use one of {qc_levels}.")
+
+    return os.path.join(root_dir, 'derivatives', 'qc', level)
+
+
+def get_file_qc(subj_id, file_id, filenm, rec, chs_pruned, snr, slope_base, slope_corrected):
+    '''
+    Gather the QC metrics of one file.
+
+    Parameters
+    ----------
+    subj_id, file_id, filenm : str
+        identify the file.
+    rec : recording container
+        needs 'od_corrected' and the aux_ts 'gvtd' and optionally 'gvtd_corrected'.
+    chs_pruned : data array
+        channel pruning codes returned by pruneChannels (0.4 = kept).
+    snr : data array
+        SNR per channel and wavelength of the unpruned data.
+    slope_base, slope_corrected : data set
+        slopes returned by quant_slope. slope_base can be None.
+
+    Returns
+    -------
+    df_file : DataFrame
+        one row with the file level metrics.
+    df_channel : DataFrame
+        one row per channel and wavelength.
+
+    '''
+    channel = chs_pruned.channel.values
+    wavelength = snr.wavelength.values
+    flag_good = chs_pruned.values == 0.4
+    n_chs = len(channel)
+
+    # slopes in units per 10 min as in plot_group_dqr
+    if slope_base is not None:
+        slope_base_vals = slope_base.slope.transpose('channel', 'wavelength').values * 60 * 10
+    else:
+        slope_base_vals = np.full((n_chs, len(wavelength)), np.nan)
+    slope_corrected_vals = slope_corrected.slope.transpose('channel', 'wavelength').values * 60 * 10
+
+    od_var = np.log10( rec['od_corrected'].transpose('channel', 'wavelength', 'time').values.var(axis=2) )
+    snr_vals = snr.transpose('channel', 'wavelength').values
+
+    df_file = {
+        'subj_id' : subj_id,
+        'file_id' : file_id,
+        'filenm' : filenm,
+        'n_chs' : n_chs,
+        'n_chs_pruned' : int(np.sum(~flag_good)),
+        'perc_pruned' : 100 * np.sum(~flag_good) / n_chs,
+        'gvtd_mean' : float(np.nanmean(rec.aux_ts['gvtd'].values)),
+        'gvtd_corrected_mean' : float(np.nanmean(rec.aux_ts['gvtd_corrected'].values)) if 'gvtd_corrected' in rec.aux_ts.keys() else np.nan,
+        'slope_base_max' : float(np.nanmax(np.abs(slope_base_vals))) if slope_base is not None else np.nan,
+        'slope_corrected_max' : float(np.nanmax(np.abs(slope_corrected_vals)))
+        }
+    for i_wav, wav in enumerate(wavelength):
+        df_file[f'snr_median_{wav:g}'] = float(np.nanmedian(snr_vals[flag_good, i_wav]))
+    df_file = pd.DataFrame([df_file])
+
+    n_wav = len(wavelength)
+    df_channel = pd.DataFrame({
+        'subj_id' : subj_id,
+        'file_id' : file_id,
+        'filenm' : filenm,
+        'channel' : np.repeat(channel, n_wav),
+        'source' : np.repeat(snr.source.values, n_wav),
+        'detector' : np.repeat(snr.detector.values, n_wav),
+        'wavelength' : np.tile(wavelength, n_chs),
+        'chs_pruned' : np.repeat(chs_pruned.values, n_wav),
+        'snr' : snr_vals.ravel(),
+        'od_var_log10' : od_var.ravel(),
+        'slope_base' : slope_base_vals.ravel(),
+        'slope_corrected' : slope_corrected_vals.ravel()
+        })
+
+    return df_file, df_channel
+
+
+def get_motion_qc(subj_id, filenm, tInc_all, n_events):
+    '''
+    Convert the output of module_quality.motion_artifact_stats to the 'motion_channel' and
+    'motion_time' tables.
+    '''
+    df_motion_channel = n_events.to_dataframe(name='n_motion_events').reset_index()[['variant', 'channel', 'n_motion_events']]
+    df_motion_channel.insert(0, 'filenm', filenm)
+    df_motion_channel.insert(0, 'subj_id', subj_id)
+
+    df_motion_time = tInc_all.to_dataframe(name='tInc_all').reset_index()[['variant', 'time', 'tInc_all']]
+    df_motion_time.insert(0, 'filenm', filenm)
+    df_motion_time.insert(0, 'subj_id', subj_id)
+
+    return df_motion_channel, df_motion_time
+
+
+def write_file_qc(root_dir, filenm, df_file = None, df_channel = None, df_motion_channel = None, df_motion_time = None):
+    '''
+    Write (or overwrite) the QC tables of one file. Tables that are None are not written.
+    '''
+    for level, df in [('file', df_file), ('channel', df_channel), ('motion_channel', df_motion_channel), ('motion_time', df_motion_time)]:
+        if df is None:
+            continue
+
+        qc_dir = get_qc_dir(root_dir, level)
+        if not os.path.exists(qc_dir):
+            os.makedirs(qc_dir)
+
+        if flag_parquet:
+            df.to_parquet( os.path.join(qc_dir, filenm + '.parquet'), index=False )
+        else:
+            df.to_csv( os.path.join(qc_dir, filenm + '.csv'), index=False )
+
+    return
+
+
+def load_qc_table(root_dir, level = 'file'):
+    '''
+    Load the QC table of all the files processed so far as a single DataFrame.
+    level is one of qc_levels, e.g. 'file' (one row per file) or 'channel' (one row per
+    channel and wavelength).
+    '''
+    qc_dir = get_qc_dir(root_dir, level)
+
+    file_lst = sorted( glob.glob(os.path.join(qc_dir, '*.parquet')) + glob.glob(os.path.join(qc_dir, '*.csv')) )
+    if len(file_lst) == 0:
+        print(f"No QC tables found in {qc_dir}")
+        return pd.DataFrame()
+
+    df_lst = []
+    for file_path in file_lst:
+        if file_path.endswith('.parquet'):
+            df_lst.append( pd.read_parquet(file_path) )
+        else:
+            df_lst.append( pd.read_csv(file_path, dtype={'subj_id': str}) )
+
+    return pd.concat(df_lst, ignore_index=True)
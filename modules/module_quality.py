@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Light-weight data quality metrics that work directly on OD time series.
+
+The cedalion quality functions expect amplitude data and therefore force us to
+convert OD back to intensity (np.exp(-od)) and to build fully NaN-masked copies
+of the data just to exclude pruned channels. The functions here avoid those
+round trips. motion_artifact_stats runs the motion artifact detection on several
+versions of a recording at once.
+"""
+
+import numpy as np
+import xarray as xr
+import scipy.signal
+
+import cedalion.sigproc.frequency as frequency
+import cedalion.sigproc.quality as quality
+from cedalion import units
+
+
+def gvtd_od(od, pruned_chans=None, fmin=0.01, fmax=0.5, butter_order=4, chunk_size=None):
+    '''
+    Calculate GVTD directly on OD data.
+
+    This gives the same result as quality.gvtd( prune_mask_ts( np.exp(-od), pruned_chans ) )
+    without the exp() round trip and without building a masked copy of the data. The
+    conversion back to OD inside quality.gvtd only adds a constant offset per channel,
+    which is removed by the bandpass filter and the temporal derivative.
+    As in quality.gvtd, the metric is calculated on the first wavelength and masked
+    channels contribute zero to the channel mean.
+
+    Parameters
+    ----------
+    od : data array
+        OD time series with dimensions ('channel', 'wavelength', 'time').
+    pruned_chans : list or array, optional
+        channels that are excluded from the GVTD (e.g. the pruned channels).
+    fmin, fmax : float
+        bandpass filter cut-off frequencies in Hz (same as quality.gvtd).
+    butter_order : int
+        order of the Butterworth bandpass filter.
+    chunk_size : int, optional
+        if given, the channels are filtered and accumulated in blocks of chunk_size
+        channels. Only one block of filtered data is held in memory at a time, which
+        keeps the memory use flat for large channel counts.
+
+    Returns
+    -------
+    gvtd : data array
+        GVTD time trace with dimension 'time' and units of OD/s.
+
+    '''
+    if od.pint.units is not None:
+        od = od.pint.dequantify()
+
+    od = od.transpose('channel', 'wavelength', 'time')
+    data = od.values[:, 0, :]   # quality.gvtd only uses the first wavelength
+    n_chs, n_t = data.shape
+
+    fs = 1 / np.mean(np.diff(od.time.values))
+    sos = scipy.signal.butter(butter_order, [fmin / (fs/2), fmax / (fs/2)], 'bandpass', output='sos')
+
+    if pruned_chans is None:
+        idx_chs = np.arange(n_chs)
+    else:
+        idx_chs = np.where(~np.isin(od.channel.values, pruned_chans))[0]
+
+    if chunk_size is None:
+        chunk_size = max(len(idx_chs), 1)
+
+    # accumulate the sum of squared derivatives over the unmasked channels
+    sum_sq = np.zeros(n_t - 1)
+    for i_start in range(0, len(idx_chs), chunk_size):
+        foo = data[idx_chs[i_start:i_start + chunk_size], :]
+        foo = np.where(np.isfinite(foo), foo, 0)
+        foo = scipy.signal.sosfiltfilt(sos, foo, axis=-1)
+        sum_sq += np.sum(np.diff(foo, axis=-1)**2, axis=0)
+
+    # masked channels count as zero in the mean over all channels
+    gvtd = np.hstack([0, np.sqrt(sum_sq / n_chs)])
+
+    gvtd = xr.DataArray(gvtd, dims=['time'], coords={'time': od.time})
+    gvtd = gvtd * frequency.sampling_rate(od)
+
+    return gvtd
+
+
+def motion_artifact_stats(rec, rec_strs = ['od', 'od_corrected'], t_window_std = 1 * units.s, iqr_threshold_std = 2, iqr_threshold_grad = 1.5):
+    '''
+    Motion artifact statistics for several versions of the same recording in one pass.
+
+    The time series in rec_strs are stacked along a new 'variant' dimension and
+    quality.detect_outliers is called once on the stack. Time series that were not
+    sampled on the time grid of rec_strs[0] are interpolated onto it first.
+
+    Parameters
+    ----------
+    rec : recording container
+    rec_strs : list of str
+        time series to analyze. Entries that are not in rec are skipped.
+    t_window_std, iqr_threshold_std, iqr_threshold_grad :
+        passed to quality.detect_outliers.
+
+    Returns
+    -------
+    tInc_all : data array (variant, time)
+        100 * (1 - (number of clean channel/wavelength pairs // 2) / number of channels)
+        at each time point, as in plot_tIncCh_dqr.
+    n_events : data array (variant, channel)
+        number of motion onsets in each channel (mean over wavelengths). Channels that
+        are NaN in rec_strs[0] (pruned) are NaN.
+
+    '''
+    rec_strs = [rec_str for rec_str in rec_strs if rec_str in rec.timeseries.keys()]
+
+    ts_ref = rec[rec_strs[0]].transpose('channel', 'wavelength', 'time')
+    ts_lst = []
+    for rec_str in rec_strs:
+        ts = rec[rec_str].transpose('channel', 'wavelength', 'time')
+        if ts.pint.units is not None:
+            ts = ts.pint.dequantify()
+        if not np.array_equal(ts.time.values, ts_ref.time.values):
+            ts = ts.interp(time=ts_ref.time) # this is done to handle when we downsample before ICA
+        ts_lst.append(ts)
+
+    ts_all = xr.concat(ts_lst, dim='variant', coords='minimal', compat='override')
+    ts_all = ts_all.assign_coords(variant=rec_strs)
+    ts_all.time.attrs['units'] = ts_ref.time.attrs.get('units', 's')
+
+    M = quality.detect_outliers(ts_all, t_window_std, iqr_threshold_std, iqr_threshold_grad)
+    M = M.transpose('variant', 'channel', 'wavelength', 'time')
+    M_np = M.values.astype(bool)
+
+    n_chs = ts_ref.sizes['channel']
+    nan_chs = np.isnan(ts_lst[0].values.mean(axis=(1, 2)))
+
+    # percent of channels at each time point, sum over channels and wavelengths
+    tInc_all = (1 - (M_np.sum(axis=(1, 2)) // 2) / n_chs) * 100
+    tInc_all = xr.DataArray(tInc_all, dims=['variant', 'time'], coords={'variant': rec_strs, 'time': ts_ref.time})
+
+    # motion onsets are the clean -> tainted transitions, mean across wavelengths
+    n_events = np.count_nonzero(M_np[..., :-1] & ~M_np[..., 1:], axis=3).mean(axis=2)
+    n_events[:, nan_chs] = np.nan
+    n_events = xr.DataArray(n_events, dims=['variant', 'channel'], coords={'variant': rec_strs, 'channel': ts_ref.channel})
+
+    return tInc_all, n_events
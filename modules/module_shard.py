@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Subject level sharding of the pipeline, so that the cohort can be processed by several
+cluster jobs (e.g. an SGE array job) and combined afterwards.
+
+Each shard processes a subset of the subjects and writes one partial result file per
+subject and step to derivatives/shards/<step>/sub-<subj_id>.pkl.gz:
+
+    'preprocess'     - the preprocessed recordings and the channel pruning of the subject
+    'block_average'  - the block average and its MSE from module_group_avg.get_subj_block_average
+    'image_recon'    - the image and image MSE of every trial type
+
+The merge step loads the partial results of all subjects not in subj_id_exclude and combines
+them into the weighted group averages with module_group_avg.combine_subj_block_averages and
+module_image_recon.combine_subj_images. Because the subjects are combined in the order of
+cfg_dataset['subj_ids'] the group averages are the same as those of a single process run.
+
+See analysis_pipeline_shard.py for the command line.
+"""
+
+import os
+import gzip
+import pickle
+import argparse
+
+import numpy as np
+import xarray as xr
+
+import cedalion
+import cedalion.dataclasses as cdc
+from cedalion import units
+
+import module_group_avg as pfDAB_grp_avg
+import module_measurement as pfDAB_meas
+
+
+shard_steps = ['preprocess', 'block_average', 'image_recon']
+
+
+def parse_shard_args( argv = None ):
+    '''
+    Parse the shard options of the command line
+
+        --subj 01 02 03                   process these subjects
+        --shard-index 2 --n-shards 8      process the 3rd of 8 equal subject subsets
+        --merge                           combine the partial results of all shards
+
+    Without --shard-index the index is taken from the SGE_TASK_ID environment variable of an
+    array job (1 based) when it is set. Without any options all subjects are processed.
+    Unknown arguments (e.g. from an IPython kernel) are ignored.
+    '''
+    parser = argparse.ArgumentParser( description = 'Run the pipeline for a subset of the subjects or merge the shards' )
+    parser.add_argument( '--subj', nargs = '+', default = None, help = 'subject IDs to process' )
+    parser.add_argument( '--shard-index', type = int, default = None, help = 'index of this shard, 0 based' )
+    parser.add_argument( '--n-shards', type = int, default = None, help = 'number of shards' )
+    parser.add_argument( '--merge', action = 'store_true', help = 'merge the partial results of all shards' )
+    args, _ = parser.parse_known_args( argv )
+
+    shard_index = args.shard_index
+    if shard_index is None and args.n_shards is not None and os.environ.get('SGE_TASK_ID', 'undefined') != 'undefined':
+        shard_index = int(os.environ['SGE_TASK_ID']) - 1
+
+    if args.n_shards is not None and shard_index is None:
+        raise ValueError('--n-shards needs --shard-index or the SGE_TASK_ID of an array job')
+    if args.subj is not None and args.n_shards is not None:
+        raise ValueError('Use either --subj or --shard-index/--n-shards')
+
+    return {'subj_ids' : args.subj, 'shard_index' : shard_index, 'n_shards' : args.n_shards, 'flag_merge' : args.merge}
+
+
+def get_shard_subj_ids( cfg_dataset, shard_args ):
+    '''
+    Return the subject IDs processed by this shard, in the order of cfg_dataset['subj_ids'].
+    '''
+    subj_ids = cfg_dataset['subj_ids']
+
+    if shard_args['subj_ids'] is not None:
+        unknown = [s for s in shard_args['subj_ids'] if s not in subj_ids]
+        if len(unknown) > 0:
+            raise ValueError(f'Subjects {unknown} are not in cfg_dataset["subj_ids"]')
+        return [s for s in subj_ids if s in shard_args['subj_ids']]
+
+    if shard_args['n_shards'] is None:
+        return list(subj_ids)
+
+    if not 0 <= shard_args['shard_index'] < shard_args['n_shards']:
+        raise ValueError(f"Shard index {shard_args['shard_index']} is not in 0 to {shard_args['n_shards']-1}")
+
+    # contiguous subsets of (almost) equal size
+    return [str(s) for s in np.array_split( np.array(subj_ids, dtype=object), shard_args['n_shards'] )[shard_args['shard_index']]]
+
+
+def get_shard_cfg_dataset( cfg_dataset, subj_ids_shard ):
+    '''
+    Return a copy of cfg_dataset restricted to the subjects of the shard.
+    '''
+    idx_shard = [cfg_dataset['subj_ids'].index(s) for s in subj_ids_shard]
+
+    cfg_dataset_shard = dict(cfg_dataset)
+    cfg_dataset_shard['subj_ids'] = [cfg_dataset['subj_ids'][i] for i in idx_shard]
+    cfg_dataset_shard['filenm_lst'] = [cfg_dataset['filenm_lst'][i] for i in idx_shard]
+    cfg_dataset_shard['subj_id_exclude'] = [s for s in cfg_dataset['subj_id_exclude'] if s in subj_ids_shard]
+
+    return cfg_dataset_shard
+
+
+def get_shard_dir( root_dir ):
+    return os.path.join(root_dir, 'derivatives', 'shards')
+
+
+def write_subj_result( shard_dir, step, subj_id, result ):
+    '''
+    Write the partial result of one subject and step. The file is written under a temporary
+    name and renamed, so an interrupted job never leaves a partial file behind.
+    '''
+    if step not in shard_steps:
+        raise ValueError(f"Unknown shard step '{step}'. Use one of {shard_steps}.")
+
+    step_dir = os.path.join(shard_dir, step)
+    if not os.path.exists(step_dir):
+        os.makedirs(step_dir, exist_ok=True)
+
+    file_path = os.path.join(step_dir, f'sub-{subj_id}.pkl.gz')
+    with gzip.open(file_path + '.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_path + '.tmp', file_path)
+
+    return
+
+
+def load_subj_results( shard_dir, step, subj_ids ):
+    '''
+    Load the partial results of the subjects, in the order of subj_ids.
+    Raises FileNotFoundError listing the subjects whose shard did not finish.
+    '''
+    file_paths = [os.path.join(shard_dir, step, f'sub-{subj_id}.pkl.gz') for subj_id in subj_ids]
+
+    missing = [subj_id for subj_id, file_path in zip(subj_ids, file_paths) if not os.path.exists(file_path)]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"No '{step}' results for subjects {missing} in {shard_dir}. Did all shards finish?")
+
+    results = []
+    for file_path in file_paths:
+        with gzip.open(file_path, 'rb') as f:
+            results.append( pickle.load(f) )
+
+    return results
+
+
+def get_merge_subj_ids( cfg_dataset ):
+    # the subjects of the group average, in the order of a single process run
+    return [s for s in cfg_dataset['subj_ids'] if s not in cfg_dataset['subj_id_exclude']]
+
+
+#%% shard steps
+
+def write_shard_preprocessed( rec, chs_pruned_subjs, cfg_dataset_shard, shard_dir ):
+    '''
+    Write the output of load_and_preprocess for the subjects of the shard.
+    rec and chs_pruned_subjs hold the subjects not in subj_id_exclude.
+    '''
+    for subj_idx, subj_id in enumerate(get_merge_subj_ids(cfg_dataset_shard)):
+        write_subj_result( shard_dir, 'preprocess', subj_id, {'rec' : rec[subj_idx], 'chs_pruned' : chs_pruned_subjs[subj_idx]} )
+
+    return
+
+
+def run_shard_block_average( rec, chs_pruned_subjs, cfg_dataset_shard, cfg_blockavg, shard_dir ):
+    '''
+    Block average the subjects of the shard and write the block averages and their MSE.
+    '''
+    rec_str = cfg_blockavg['rec_str']
+    cfg_mse = pfDAB_grp_avg.get_cfg_mse( rec[0][0], rec_str, cfg_blockavg )
+
+    subj_ids_new = get_merge_subj_ids(cfg_dataset_shard)
+    filenm_lst_new = [cfg_dataset_shard['filenm_lst'][cfg_dataset_shard['subj_ids'].index(s)] for s in subj_ids_new]
+
+    for subj_idx, subj_id in enumerate(subj_ids_new):
+        print(f'Block averaging subject {subj_id}')
+        subj_result = pfDAB_grp_avg.get_subj_block_average( rec[subj_idx], rec_str, chs_pruned_subjs[subj_idx], subj_id, filenm_lst_new[subj_idx], cfg_blockavg, cfg_mse )
+
+        # a one sample recording with the probe for the group plots of the merge step
+        rec_plot = cdc.Recording( geo3d = rec[subj_idx][0].geo3d, geo2d = rec[subj_idx][0].geo2d )
+        rec_plot.timeseries[rec_str] = rec[subj_idx][0][rec_str].isel(time=slice(0, 1))
+
+        write_subj_result( shard_dir, 'block_average', subj_id, {'subj_result' : subj_result, 'rec_plot' : rec_plot} )
+
+    return
+
+
+def run_shard_image_recon( cfg_dataset_shard, cfg_img_recon, Adot, head, wavelength, shard_dir ):
+    '''
+    Reconstruct the image of every trial type for each subject of the shard from its block
+    average (written by run_shard_block_average) and write the image and the image MSE.
+    '''
+    import module_image_recon as pfDAB_img
+
+    subj_ids = []
+    hrf_od_mag_lst = []
+    C_meas_lst = []
+    for subj_id in get_merge_subj_ids(cfg_dataset_shard):
+        subj_result = load_subj_results( shard_dir, 'block_average', [subj_id] )[0]['subj_result']
+        if subj_result is None:
+            continue
+
+        hrf_od_mag_subj = []
+        C_meas_subj = []
+        for trial_type in subj_result['blockaverage'].trial_type:
+            hrf_od_mag, C_meas = get_subj_hrf_od_mag( subj_result, trial_type, wavelength, cfg_img_recon )
+            hrf_od_mag_subj.append( hrf_od_mag )
+            C_meas_subj.append( C_meas )
+
+        subj_ids.append( subj_id )
+        hrf_od_mag_lst.append( xr.concat(hrf_od_mag_subj, dim='trial_type') )
+        C_meas_lst.append( xr.concat(C_meas_subj, dim='trial_type') )
+
+    if len(subj_ids) == 0:
+        return
+
+    # reconstruct all subjects and trial types of the shard at once, the ones with the same
+    # pruning (or the same C_meas) share W
+    print(f'Starting image recon on subjects {subj_ids}')
+    hrf_od_mag = xr.concat(hrf_od_mag_lst, dim='subj').assign_coords(subj=subj_ids).transpose('subj', 'trial_type', 'wavelength', 'channel')
+    C_meas = xr.concat(C_meas_lst, dim='subj').assign_coords(subj=subj_ids).transpose('subj', 'trial_type', 'measurement')
+
+    X, recon = pfDAB_img.do_image_recon_batch( hrf_od_mag, head, Adot, C_meas if cfg_img_recon['flag_Cmeas'] else None, wavelength,
+                                               cfg_img_recon['BRAIN_ONLY'], cfg_img_recon['DIRECT'], cfg_img_recon['SB'],
+                                               cfg_img_recon['cfg_sb'], cfg_img_recon['alpha_spatial'], cfg_img_recon['alpha_meas'] )
+
+    # same layout as the images of do_image_recon, the indirect ones are (chromo, vertex)
+    img_dims = ('vertex', 'chromo') if cfg_img_recon['DIRECT'] else ('chromo', 'vertex')
+
+    for subj_id in subj_ids:
+        X_lst = []
+        X_mse_lst = []
+        for trial_type in X.trial_type.values:
+            X_hrf_mag_tmp = X.sel(subj=subj_id, trial_type=trial_type).drop_vars('subj').transpose(*img_dims)
+            i_group = int(recon['group'].sel(subj=subj_id, trial_type=trial_type))
+
+            # with flag_Cmeas the noise uses C_meas with the pruned channels set to bad values
+            C_meas_tmp = recon['C_meas'][i_group] if cfg_img_recon['flag_Cmeas'] else C_meas.sel(subj=subj_id, trial_type=trial_type)
+            X_mse = pfDAB_img.get_image_noise( C_meas_tmp, X_hrf_mag_tmp, recon['W'][i_group], SB=cfg_img_recon['SB'], DIRECT=cfg_img_recon['DIRECT'], G=recon['G'][i_group] )
+
+            X_lst.append( X_hrf_mag_tmp )
+            X_mse_lst.append( X_mse )
+
+        write_subj_result( shard_dir, 'image_recon', subj_id, {'X' : xr.concat(X_lst, dim='trial_type'), 'X_mse' : xr.concat(X_mse_lst, dim='trial_type')} )
+
+    return
+
+
+def get_subj_hrf_od_mag( subj_result, trial_type, wavelength, cfg_img_recon ):
+    '''
+    HRF magnitude of one subject and trial type over cfg_img_recon['t_win'] in OD and the MSE
+    of the block average as the stacked measurement variance C_meas. As in
+    analysis_pipeline_image_recon, C_meas is at least cfg_img_recon['mse_min_thresh'] (in OD**2,
+    not the cfg_mse threshold, which is in the units of the block average).
+    '''
+    t_win = slice(cfg_img_recon['t_win'][0], cfg_img_recon['t_win'][1])
+    blockaverage = subj_result['blockaverage'].sel(trial_type=trial_type)
+    blockaverage_mse = subj_result['mse_t_o'].sel(trial_type=trial_type)
+
+    if 'chromo' in blockaverage.dims:
+        # convert back to OD
+        E = cedalion.nirs.get_extinction_coefficients(cfg_img_recon.get('spectrum', 'prahl'), wavelength)
+        hrf_od_mag = xr.dot(E, blockaverage.sel(reltime=t_win).mean('reltime') * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # !!! assumes DPF = 1
+        blockaverage_mse = xr.dot(E, blockaverage_mse * 1*units.mm * 1e-6*units.molar / units.micromolar, dim=["chromo"]) # assumes DPF = 1
+    else:
+        hrf_od_mag = blockaverage.sel(reltime=t_win).mean('reltime')
+
+    C_meas = blockaverage_mse.sel(reltime=t_win).mean('reltime')
+    C_meas = C_meas.pint.dequantify()
+    C_meas = pfDAB_meas.stack_measurement(C_meas)
+    if cfg_img_recon.get('mse_min_thresh') is not None:
+        C_meas = xr.where(C_meas < cfg_img_recon['mse_min_thresh'], cfg_img_recon['mse_min_thresh'], C_meas)
+
+    return hrf_od_mag, C_meas
+
+
+#%% merge
+
+def merge_block_averages( shard_dir, cfg_dataset, cfg_blockavg, flag_plot = True ):
+    '''
+    Combine the block averages of all shards into the group averages.
+    Returns the same as module_group_avg.run_group_block_average.
+    '''
+    subj_ids_new = get_merge_subj_ids(cfg_dataset)
+    results = load_subj_results( shard_dir, 'block_average', subj_ids_new )
+
+    subj_ids_done = [subj_id for subj_id, result in zip(subj_ids_new, results) if result['subj_result'] is not None]
+    subj_results = [result['subj_result'] for result in results if result['subj_result'] is not None]
+
+    rec_str = cfg_blockavg['rec_str']
+    rec_plot = [[result['rec_plot']] for result in results if result['subj_result'] is not None]
+    cfg_mse = pfDAB_grp_avg.get_cfg_mse( rec_plot[0][0], rec_str, cfg_blockavg )
+
+    print(f'Merging the block averages of {len(subj_ids_done)} subjects')
+    blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted, blockaverage_subj, blockaverage_mse_subj, mse_mean_within_subject, mse_weighted_between_subjects = \
+        pfDAB_grp_avg.combine_subj_block_averages( subj_results, subj_ids_done, cfg_mse )
+
+    if flag_plot:
+        for trial_type in blockaverage_mean_weighted.trial_type.values:
+            pfDAB_grp_avg.plot_mean_stderr(rec_plot, rec_str, trial_type, cfg_dataset, cfg_blockavg, blockaverage_mean_weighted,
+                                           blockaverage_stderr_weighted, mse_mean_within_subject, mse_weighted_between_subjects)
+            pfDAB_grp_avg.plot_mse_hist(rec_plot, rec_str, trial_type, cfg_dataset, blockaverage_mse_subj, cfg_mse['mse_val_for_bad_data'], cfg_mse['mse_min_thresh'])
+
+    return blockaverage_mean, blockaverage_mean_weighted, blockaverage_stderr_weighted, blockaverage_subj, blockaverage_mse_subj
+
+
+def merge_images( shard_dir, cfg_dataset ):
+    '''
+    Combine the subject images of all shards into the weighted group images of every trial type.
+    Returns the dict saved by the image pipelines (X_hrf_mag_all_trial, X_hrf_mag_weighted_all_trial,
+    X_std_err_all_trial, X_tstat_all_trial).
+    '''
+    import module_image_recon as pfDAB_img
+
+    subj_ids_new = get_merge_subj_ids(cfg_dataset)
+    subj_ids_done = [subj_id for subj_id, result in zip(subj_ids_new, load_subj_results(shard_dir, 'block_average', subj_ids_new)) if result['subj_result'] is not None]
+    results = load_subj_results( shard_dir, 'image_recon', subj_ids_done )
+
+    print(f'Merging the images of {len(subj_ids_done)} subjects')
+    X_grp = {'X_hrf_mag_mean' : [], 'X_hrf_mag_mean_weighted' : [], 'X_stderr_weighted' : [], 'X_tstat' : []}
+    for trial_type in results[0]['X'].trial_type:
+        results_trial = pfDAB_img.combine_subj_images( [result['X'].sel(trial_type=trial_type) for result in results],
+                                                       [result['X_mse'].sel(trial_type=trial_type) for result in results],
+                                                       subj_ids_done )
+        for key in X_grp:
+            X_grp[key].append( results_trial[key].assign_coords(trial_type = trial_type) )
+
+    results_img_s = {'X_hrf_mag_all_trial': xr.concat(X_grp['X_hrf_mag_mean'], dim='trial_type'),
+                     'X_hrf_mag_weighted_all_trial': xr.concat(X_grp['X_hrf_mag_mean_weighted'], dim='trial_type'),
+                     'X_std_err_all_trial': xr.concat(X_grp['X_stderr_weighted'], dim='trial_type'),  # noise
+                     'X_tstat_all_trial': xr.concat(X_grp['X_tstat'], dim='trial_type')
+                     }
+
+    return results_img_s
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of the SNIRF sidecar json file with the instrument calibration data
+(dataSDWP_LowHigh, power levels, source module groups and the SD probe).
+
+The json lists are converted to typed numpy arrays in one call and the parsed sidecar is
+cached next to the SNIRF file (<file>.snirf_sidecar.npz) so it is only parsed once.
+"""
+
+import os
+import json
+
+import numpy as np
+
+
+# json fields that are converted to numpy arrays
+sidecar_array_fields = ['dataSDWP_LowHigh', 'powerLevelSetting', 'powerLevelSetLowHigh']
+sidecar_SD_fields = ['SrcPos2D', 'DetPos2D', 'SrcPos3D', 'DetPos3D', 'Lambda', 'MeasList']
+
+
+def load_sidecar(file_path, flag_use_cache = True):
+    '''
+    Load the parsed sidecar of the SNIRF file file_path.
+
+    Parameters
+    ----------
+    file_path : str
+        path of the SNIRF file. The sidecar is file_path + '.json'.
+    flag_use_cache : bool
+        if True, use (and create) the parsed cache file_path + '_sidecar.npz'. The cache is
+        refreshed when the json file is newer than the cache.
+
+    Returns
+    -------
+    sidecar : dict or None
+        the parsed sidecar (see parse_sidecar), or None if there is no sidecar json file or it
+        has no calibration data.
+
+    '''
+    file_json = file_path + '.json'
+    if not os.path.exists(file_json):
+        return None
+
+    file_cache = file_path + '_sidecar.npz'
+    if flag_use_cache and os.path.exists(file_cache) and os.path.getmtime(file_cache) >= os.path.getmtime(file_json):
+        return _load_sidecar_cache(file_cache)
+
+    with open(file_json) as f:
+        sidecar_json = json.load(f)
+    if 'dataSDWP_LowHigh' not in sidecar_json:
+        return None
+
+    sidecar = parse_sidecar(sidecar_json)
+
+    if flag_use_cache:
+        _save_sidecar_cache(file_cache, sidecar)
+
+    return sidecar
+
+
+def parse_sidecar(sidecar_json):
+    '''
+    Convert the json dictionary of the sidecar to numpy arrays.
+
+    Returns a dict with
+        'dataSDWP_LowHigh'      - (source, detector, wavelength, power) calibration data
+        'powerLevelSetting'     - power level of each measurement in SD['MeasList']
+        'powerLevelSetLowHigh'  - low and high power level settings
+        'srcModuleGroups'       - list of arrays with the source modules in each group
+        'SD'                    - dict with the SrcPos2D, DetPos2D, SrcPos3D, DetPos3D, Lambda and MeasList arrays
+        'rho_sds'               - (source, detector) source-detector distances of SD['SrcPos3D'] and SD['DetPos3D']
+    '''
+    sidecar = {}
+    for field in sidecar_array_fields:
+        sidecar[field] = np.asarray(sidecar_json[field], dtype=float)
+
+    sidecar['srcModuleGroups'] = [np.asarray(grp, dtype=int).ravel() for grp in sidecar_json['srcModuleGroups']]
+
+    sidecar['SD'] = {}
+    for field in sidecar_SD_fields:
+        sidecar['SD'][field] = np.asarray(sidecar_json['SD'][field])
+
+    sidecar['rho_sds'] = get_rho_sds(sidecar['SD']['SrcPos3D'], sidecar['SD']['DetPos3D'])
+
+    return sidecar
+
+
+def get_rho_sds(src_pos, det_pos):
+    '''
+    Distances between all the sources (rows) and all the detectors (columns).
+    '''
+    src_pos = np.asarray(src_pos, dtype=float)
+    det_pos = np.asarray(det_pos, dtype=float)
+
+    return np.linalg.norm(src_pos[:, None, :] - det_pos[None, :, :], axis=2)
+
+
+def _save_sidecar_cache(file_cache, sidecar):
+    arrays = {field: sidecar[field] for field in sidecar_array_fields}
+    arrays['rho_sds'] = sidecar['rho_sds']
+    for field in sidecar_SD_fields:
+        arrays['SD_' + field] = sidecar['SD'][field]
+
+    # the source module groups can have different lengths so store them flattened
+    arrays['srcModuleGroups_flat'] = np.concatenate(sidecar['srcModuleGroups']) if len(sidecar['srcModuleGroups']) > 0 else np.zeros(0, dtype=int)
+    arrays['srcModuleGroups_len'] = np.array([len(grp) for grp in sidecar['srcModuleGroups']], dtype=int)
+
+    np.savez(file_cache, **arrays)
+
+
+def _load_sidecar_cache(file_cache):
+    with np.load(file_cache) as arrays:
+        sidecar = {field: arrays[field] for field in sidecar_array_fields}
+        sidecar['rho_sds'] = arrays['rho_sds']
+        sidecar['SD'] = {field: arrays['SD_' + field] for field in sidecar_SD_fields}
+        if len(arrays['srcModuleGroups_len']) > 0:
+            idx_split = np.cumsum(arrays['srcModuleGroups_len'])[:-1]
+            sidecar['srcModuleGroups'] = np.split(arrays['srcModuleGroups_flat'], idx_split)
+        else:
+            sidecar['srcModuleGroups'] = []
+
+    return sidecar
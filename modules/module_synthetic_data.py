@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic fNIRS data for benchmarking and for trying out the pipeline without a data set.
+
+make_synthetic_rec builds a cedalion recording with a random probe on a hemisphere,
+intensity data with drift, cardiac pulsation, motion spikes and a few bad channels, a
+block design stim table and optionally IMU aux channels with a walking period.
+make_synthetic_head and make_synthetic_Adot build a two sphere head mesh and a matching
+sensitivity matrix that can be passed to module_image_recon.
+
+Everything is generated from a seed so that the same cfg_synth always gives the same data.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import trimesh
+
+import cedalion
+import cedalion.nirs
+import cedalion.dataclasses as cdc
+from cedalion import units
+
+
+cfg_synth_default = {
+    'n_sources' : 16,
+    'n_detectors' : 24,
+    'sd_max' : 45,                  # mm, longest source-detector separation that becomes a channel
+    'head_radius' : 90,             # mm
+    'probe_seed' : 0,               # the probe only depends on this seed, so all subjects share it
+    'wavelength' : [760., 850.],
+    'fs' : 10.,                     # Hz
+    'duration' : 600.,              # s
+    'stim_lst' : ['ST', 'DT'],      # trial types, presented in turn
+    'stim_interval' : 30.,          # s between stim onsets
+    'stim_duration' : 10.,          # s
+    'perc_bad_chs' : 5,             # percent of channels with very low intensity
+    'n_motion_artifacts' : 10,
+    'flag_imu' : True,              # add ACCEL_X/Y/Z and GYRO_X/Y/Z aux channels and walking markers
+    'statesPerDataFrame' : 89,      # IMU samples per fNIRS sample
+    }
+
+
+def make_synthetic_rec(cfg_synth = None, seed = 0):
+    '''
+    Make a synthetic recording.
+
+    Parameters
+    ----------
+    cfg_synth : dict, optional
+        overrides for cfg_synth_default.
+    seed : int
+        seed of the random number generator of the data (the probe uses cfg_synth['probe_seed']).
+
+    Returns
+    -------
+    rec : recording container
+        with the timeseries 'amp' and 'od', geo3d (sources, detectors and the Nz, Iz,
+        LPA, RPA and Cz landmarks), stim and, if cfg_synth['flag_imu'], the IMU aux_ts
+        and the start_walk, end_walk, start_stand and end_stand markers used by
+        module_imu_glm_filter.id_walking.
+
+    '''
+    cfg_synth = {**cfg_synth_default, **(cfg_synth or {})}
+    rng = np.random.default_rng(seed)
+
+    geo3d, src_pos, det_pos = _make_probe(cfg_synth, np.random.default_rng(cfg_synth['probe_seed']))
+
+    # channels are all the source-detector pairs closer than sd_max
+    rho = np.linalg.norm(src_pos[:, None, :] - det_pos[None, :, :], axis=2)
+    idx_src, idx_det = np.where(rho < cfg_synth['sd_max'])
+    n_chs = len(idx_src)
+    channel = [f"S{i_src+1}D{i_det+1}" for i_src, i_det in zip(idx_src, idx_det)]
+
+    fs = cfg_synth['fs']
+    n_t = int(round(cfg_synth['duration'] * fs))
+    t = np.arange(n_t) / fs
+    wavelength = cfg_synth['wavelength']
+    n_wav = len(wavelength)
+
+    # mean intensity falls off with distance, drift is a slow random walk and the cardiac
+    # pulsation is shared by the wavelengths of a channel (gives a realistic SCI)
+    amp_mean = np.exp(-rho[idx_src, idx_det] / 12)[:, None] * rng.uniform(0.5, 2, (n_chs, n_wav))
+    drift = np.cumsum(rng.normal(0, 1, (n_chs, n_wav, n_t)), axis=2) * 2e-4
+    f_cardiac = rng.uniform(1.0, 1.3)
+    cardiac = 0.01 * np.sin(2 * np.pi * f_cardiac * t + rng.uniform(0, 2*np.pi, (n_chs, 1, 1)))
+    noise = rng.normal(0, 0.005, (n_chs, n_wav, n_t))
+    amp = amp_mean[:, :, None] * np.exp(drift + cardiac + noise)
+
+    # motion artifacts are spikes and shifts shared by all channels
+    for i_onset in rng.integers(0, n_t - int(2*fs), cfg_synth['n_motion_artifacts']):
+        n_len = int(rng.uniform(0.2, 2) * fs)
+        amp[:, :, i_onset:i_onset + n_len] *= np.exp(rng.normal(0, 0.2, (n_chs, n_wav, 1)))
+
+    # bad channels
+    n_bad = int(round(n_chs * cfg_synth['perc_bad_chs'] / 100))
+    amp[rng.choice(n_chs, n_bad, replace=False)] *= 1e-6
+
+    stim, t_walk = _make_stim(cfg_synth, t)
+
+    # gait artifact during the walking period
+    if cfg_synth['flag_imu']:
+        f_gait = 1.8
+        lst_walk = (t >= t_walk[0]) & (t <= t_walk[1])
+        amp[:, :, lst_walk] *= np.exp(0.01 * rng.uniform(0.2, 1, (n_chs, n_wav, 1)) * np.sin(2 * np.pi * f_gait * t[lst_walk]))
+
+    amp = xr.DataArray(
+        amp,
+        dims = ['channel', 'wavelength', 'time'],
+        coords = {
+            'channel' : channel,
+            'wavelength' : wavelength,
+            'time' : t,
+            'samples' : ('time', np.arange(n_t)),
+            'source' : ('channel', [f"S{i+1}" for i in idx_src]),
+            'detector' : ('channel', [f"D{i+1}" for i in idx_det]),
+            }
+        )
+    amp.time.attrs['units'] = 's'
+    amp = amp.pint.quantify('dimensionless')
+
+    rec = cdc.Recording()
+    rec['amp'] = amp
+    rec['od'] = cedalion.nirs.int2od(rec['amp'])
+    rec.geo3d = geo3d
+    rec.stim = stim
+
+    if cfg_synth['flag_imu']:
+        for key, da in _make_imu(cfg_synth, t, t_walk, rng).items():
+            rec.aux_ts[key] = da
+
+    return rec
+
+
+def make_synthetic_head(subdivisions = 4, brain_radius = 70, scalp_radius = 90):
+    '''
+    Make a head with a spherical brain and scalp surface.
+
+    Returns an object with the brain and scalp TrimeshSurfaces as .brain and .scalp, which is
+    all module_spatial_basis_funs_ced uses of a TwoSurfaceHeadModel. subdivisions=4 gives
+    2562 vertices per surface.
+    '''
+    brain = trimesh.creation.icosphere(subdivisions = subdivisions, radius = brain_radius)
+    scalp = trimesh.creation.icosphere(subdivisions = subdivisions, radius = scalp_radius)
+
+    head = SimpleNamespace(
+        brain = cdc.TrimeshSurface(brain, 'digitized', units.mm),
+        scalp = cdc.TrimeshSurface(scalp, 'digitized', units.mm),
+        )
+
+    return head
+
+
+def make_synthetic_Adot(rec, head, n_parcels = 50, decay_length = 10, seed = 0):
+    '''
+    Make a sensitivity matrix Adot (channel, vertex, wavelength) for the channels of rec on
+    the vertices of head (brain vertices first, then scalp vertices).
+
+    The sensitivity of a vertex falls off exponentially with its distance to the channel
+    midpoint projected onto the surface, so Adot is dense in value but dominated by a few
+    hundred vertices per channel as with a Monte Carlo forward model.
+    The 'is_brain' and 'parcel' coordinates are set as in the Adot_wParcels files.
+    '''
+    rng = np.random.default_rng(seed)
+
+    vertices_brain = head.brain.mesh.vertices
+    vertices_scalp = head.scalp.mesh.vertices
+    vertices = np.vstack([vertices_brain, vertices_scalp])
+    n_brain = len(vertices_brain)
+    n_vertices = len(vertices)
+
+    ts = rec['amp']
+    geo3d = rec.geo3d.pint.dequantify()
+    pos_src = geo3d.loc[ts.source.values].values
+    pos_det = geo3d.loc[ts.detector.values].values
+    midpoint = (pos_src + pos_det) / 2
+    midpoint = midpoint / np.linalg.norm(midpoint, axis=1, keepdims=True)
+
+    # project the midpoints onto the brain and scalp spheres
+    radius = np.linalg.norm(vertices, axis=1)
+    dist = np.linalg.norm(vertices[None, :, :] - midpoint[:, None, :] * radius[None, :, None], axis=2)
+    sens = np.exp(-dist / decay_length)
+    sens[:, :n_brain] *= 0.1    # the brain is less sensitive than the scalp
+
+    wavelength = ts.wavelength.values
+    Adot = sens[:, :, None] * np.linspace(1, 1.2, len(wavelength))[None, None, :]
+
+    # random parcels, scalp vertices are labeled 'scalp'
+    parcel = np.array([f"parcel_{i}" for i in rng.integers(0, n_parcels, n_brain)] + ['scalp'] * (n_vertices - n_brain))
+
+    Adot = xr.DataArray(
+        Adot,
+        dims = ['channel', 'vertex', 'wavelength'],
+        coords = {
+            'channel' : ts.channel.values,
+            'source' : ('channel', ts.source.values),
+            'detector' : ('channel', ts.detector.values),
+            'wavelength' : wavelength,
+            'is_brain' : ('vertex', np.arange(n_vertices) < n_brain),
+            'parcel' : ('vertex', parcel),
+            }
+        )
+
+    return Adot
+
+
+def _make_probe(cfg_synth, rng):
+    # sources and detectors on a grid over the upper hemisphere, jittered a little
+    n_opt = cfg_synth['n_sources'] + cfg_synth['n_detectors']
+    idx = np.arange(n_opt) + 0.5
+    theta = np.arccos(1 - idx / n_opt)          # polar angle, upper hemisphere only
+    phi = np.pi * (1 + 5**0.5) * idx            # golden angle spiral
+    pos = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=1)
+    pos = pos + rng.normal(0, 0.02, pos.shape)
+    pos = cfg_synth['head_radius'] * pos / np.linalg.norm(pos, axis=1, keepdims=True)
+
+    # interleave sources and detectors along the spiral so that neighbours are SD pairs
+    idx_perm = rng.permutation(n_opt)
+    src_pos = pos[idx_perm[:cfg_synth['n_sources']]]
+    det_pos = pos[idx_perm[cfg_synth['n_sources']:]]
+
+    r = cfg_synth['head_radius']
+    landmarks = np.array([[0, r, 0], [0, -r, 0], [-r, 0, 0], [r, 0, 0], [0, 0, r]])
+
+    labels = [f"S{i+1}" for i in range(len(src_pos))] + [f"D{i+1}" for i in range(len(det_pos))] + ['Nz', 'Iz', 'LPA', 'RPA', 'Cz']
+    types = [cdc.PointType.SOURCE] * len(src_pos) + [cdc.PointType.DETECTOR] * len(det_pos) + [cdc.PointType.LANDMARK] * 5
+
+    geo3d = cdc.build_labeled_points(np.vstack([src_pos, det_pos, landmarks]), crs = 'digitized', units = 'mm', labels = labels, types = types)
+
+    return geo3d, src_pos, det_pos
+
+
+def _make_stim(cfg_synth, t):
+    duration = t[-1]
+
+    # the middle third of the run is the walking period
+    t_walk = [duration / 3, 2 * duration / 3]
+
+    onset = np.arange(cfg_synth['stim_interval'], duration - cfg_synth['stim_interval'], cfg_synth['stim_interval'])
+    trial_type = [cfg_synth['stim_lst'][i % len(cfg_synth['stim_lst'])] for i in range(len(onset))]
+    stim = pd.DataFrame({
+        'onset' : onset,
+        'duration' : cfg_synth['stim_duration'],
+        'value' : 1.,
+        'trial_type' : trial_type,
+        })
+
+    if cfg_synth['flag_imu']:
+        stim_walk = pd.DataFrame({
+            'onset' : [t_walk[0], t_walk[1], t_walk[1], duration - 1],
+            'duration' : 0.,
+            'value' : 1.,
+            'trial_type' : ['start_walk', 'end_walk', 'start_stand', 'end_stand'],
+            })
+        stim = pd.concat([stim, stim_walk], ignore_index=True).sort_values('onset', ignore_index=True)
+
+    return stim, t_walk
+
+
+def _make_imu(cfg_synth, t, t_walk, rng):
+    fs_imu = cfg_synth['fs'] * cfg_synth['statesPerDataFrame']
+    n_t_imu = int(round(t[-1] * fs_imu)) + 1
+    t_imu = np.arange(n_t_imu) / fs_imu
+
+    f_gait = 1.8
+    lst_walk = (t_imu >= t_walk[0]) & (t_imu <= t_walk[1])
+    gait = np.where(lst_walk, np.sin(2 * np.pi * f_gait * t_imu), 0)
+
+    imu = {}
+    for i_axis, axis in enumerate(['X', 'Y', 'Z']):
+        accel = 0.3 * gait * (i_axis + 1) + rng.normal(0, 0.02, n_t_imu)
+        if axis == 'Z':
+            accel = accel + 1           # gravity
+        gyro = 20 * np.roll(gait, 10 * i_axis) + rng.normal(0, 1, n_t_imu)
+
+        for key, vals in [('ACCEL_' + axis, accel), ('GYRO_' + axis, gyro)]:
+            da = xr.DataArray(vals, dims = ['time'], coords = {'time' : t_imu, 'samples' : ('time', np.arange(n_t_imu))})
+            da.time.attrs['units'] = 's'
+            imu[key] = da
+
+    return imu
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Control of the BLAS / OpenMP thread pools.
+
+The image recon (F = A_hat A_hat.T, the W solve, W y, H = A G) and the PCA of the ICA are
+BLAS heavy and use all cores by default. When stages run in parallel worker processes
+(module_pipeline_runner, the DQR renderer, several shards on one node) every worker would
+start its own full size BLAS pool, and the oversubscribed cores slow everything down.
+
+A pipeline script sets the thread counts once with
+
+    cfg_threads = {
+        'n_threads' : None,              # BLAS threads of this process, None uses all cores
+        'stages' : {'image_recon' : 8},  # per stage overrides, used by pfDAB_threads.stage()
+        }
+    pfDAB_threads.configure( cfg_threads )
+
+and marks the BLAS heavy parts with
+
+    with pfDAB_threads.stage('image_recon'):
+        ...
+
+Worker pools get n_cores // n_workers threads per worker through init_worker (see
+get_threads_per_worker). The thread pools are changed at run time with threadpoolctl when
+it is installed. Without it only the environment variables (OMP_NUM_THREADS, ...) are set,
+which affects processes started afterwards but not the BLAS already loaded in this process.
+"""
+
+import os
+import contextlib
+
+try:
+    import threadpoolctl
+    flag_threadpoolctl = True
+except ImportError:
+    flag_threadpoolctl = False
+
+
+# environment variables read by the BLAS / OpenMP libraries when they are loaded
+thread_env_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+cfg_threads_default = {
+    'n_threads' : None,     # BLAS threads of the process, None uses all cores
+    'stages' : {},          # stage name -> BLAS threads while the stage runs
+    }
+
+# the active configuration, see configure
+_cfg_threads = dict(cfg_threads_default)
+_process_limiter = None
+_flag_warned = False
+
+
+def get_n_cores():
+    '''
+    Number of cores this process may run on (respects the affinity set e.g. by the batch system).
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_threads_per_worker( n_workers, n_cores = None ):
+    '''
+    BLAS threads per worker so that n_workers workers do not oversubscribe n_cores cores.
+    '''
+    if n_cores is None:
+        n_cores = get_n_cores()
+    return max(1, n_cores // max(1, n_workers))
+
+
+def configure( cfg_threads = None ):
+    '''
+    Set the BLAS threads of this process and the per stage thread counts from cfg_threads
+    (see cfg_threads_default). Returns the active configuration.
+    '''
+    global _cfg_threads, _process_limiter
+
+    cfg_threads = {**cfg_threads_default, **(cfg_threads or {})}
+    for name, n_threads in [('n_threads', cfg_threads['n_threads'])] + list(cfg_threads['stages'].items()):
+        if n_threads is not None and (not isinstance(n_threads, int) or n_threads < 1):
+            raise ValueError(f"cfg_threads '{name}' must be None or a positive int, not {n_threads}")
+
+    _cfg_threads = cfg_threads
+
+    if _process_limiter is not None:
+        _process_limiter.restore_original_limits()
+        _process_limiter = None
+
+    if cfg_threads['n_threads'] is not None:
+        set_env_threads( cfg_threads['n_threads'] )
+        if flag_threadpoolctl:
+            _process_limiter = threadpoolctl.threadpool_limits( limits = cfg_threads['n_threads'] )
+        else:
+            _warn_no_threadpoolctl()
+
+    return _cfg_threads
+
+
+def set_env_threads( n_threads ):
+    '''
+    Set the thread environment variables, used by the processes started from now on.
+    '''
+    for var in thread_env_vars:
+        os.environ[var] = str(n_threads)
+
+    return
+
+
+@contextlib.contextmanager
+def limit_threads( n_threads ):
+    '''
+    Context manager that limits the BLAS / OpenMP pools to n_threads. None does nothing.
+    '''
+    if n_threads is None or not flag_threadpoolctl:
+        if n_threads is not None:
+            _warn_no_threadpoolctl()
+        yield
+        return
+
+    with threadpoolctl.threadpool_limits( limits = n_threads ):
+        yield
+
+
+def stage( name ):
+    '''
+    Context manager that uses the BLAS threads configured for stage 'name' in
+    cfg_threads['stages'], or the process setting if the stage has none.
+    '''
+    return limit_threads( _cfg_threads['stages'].get(name) )
+
+
+def init_worker( n_threads, cfg_threads = None ):
+    '''
+    Initializer of the worker processes: n_threads BLAS threads per worker, the stage
+    settings of cfg_threads (default the configuration of the parent) are capped at n_threads.
+    '''
+    cfg_threads = {**cfg_threads_default, **(cfg_threads or _cfg_threads)}
+    stages = {name : min(n, n_threads) for name, n in cfg_threads['stages'].items() if n is not None}
+    configure( {'n_threads' : n_threads, 'stages' : stages} )
+
+    return
+
+
+def get_thread_info():
+    '''
+    The BLAS / OpenMP libraries loaded in this process and their current thread counts.
+    '''
+    if not flag_threadpoolctl:
+        return [{'env' : {var : os.environ.get(var) for var in thread_env_vars}}]
+
+    return [{'internal_api' : info['internal_api'], 'num_threads' : info['num_threads'], 'version' : info.get('version')}
+            for info in threadpoolctl.threadpool_info()]
+
+
+def _warn_no_threadpoolctl():
+    global _flag_warned
+    if not _flag_warned:
+        print('Warning: threadpoolctl is not installed, the BLAS threads of the running process can not be changed (pip install threadpoolctl)')
+        _flag_warned = True
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Unit boundary of the numerical stages.
+
+pint wrapped arithmetic on xarray is many times slower than the same numpy arithmetic, so
+the hot stages (block average and MSE, GLM filter, image recon) do not carry units through
+their inner computations. A stage strips the units once when the data comes in, converts
+its cfg values to magnitudes in the units of the data, computes on plain arrays and
+attaches the units once to its outputs
+
+    ts, ts_units = pfDAB_units.strip_units( rec[rec_str] )
+    mse_min_thresh = pfDAB_units.get_magnitude( cfg_mse['mse_min_thresh'], ts_units**2 )
+    ...
+    mse_t = pfDAB_units.attach_units( mse_t, ts_units**2 )
+
+Data without units passes through unchanged (units None).
+"""
+
+import xarray as xr
+import pint
+
+from cedalion import units
+
+
+def strip_units(da):
+    '''
+    Return da without units and its pint units (None if da has no units).
+    The data is not copied.
+    '''
+    if not isinstance(da, xr.DataArray) or not isinstance(da.data, pint.Quantity):
+        return da, None
+
+    # swap the data instead of da.pint.dequantify(), which goes through a Dataset and is slow
+    return da.copy(deep=False, data=da.data.magnitude), da.data.units
+
+
+def attach_units(da, da_units):
+    '''
+    Attach da_units to the plain DataArray da. Does nothing if da_units is None.
+    '''
+    if da_units is None:
+        return da
+
+    return da.copy(deep=False, data=units.Quantity(da.data, da_units))
+
+
+def get_magnitude(value, value_units):
+    '''
+    Magnitude of the cfg value in value_units. Plain numbers are taken to already be in the
+    units of the data. value_units None means the data has no units, then a Quantity must be
+    dimensionless.
+    '''
+    if not isinstance(value, pint.Quantity):
+        return value
+
+    try:
+        return value.to(value_units if value_units is not None else units.dimensionless).magnitude
+    except pint.DimensionalityError:
+        raise ValueError(f'{value} can not be converted to the units of the data ({value_units})')
+
+
+def get_common_units(units_lst):
+    '''
+    The units shared by all entries of units_lst. Raises a ValueError if they differ, e.g.
+    if one file of a subject is in OD and another in concentration.
+    '''
+    units_set = set(units_lst)
+    if len(units_set) > 1:
+        raise ValueError(f'The data is in different units {sorted(str(u) for u in units_set)}')
+
+    return units_lst[0] if len(units_lst) > 0 else None
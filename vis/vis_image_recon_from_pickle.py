@@ -1,4 +1,5 @@
 import os
+import sys
 import gzip
 import pickle
 import tkinter as tk
@@ -15,6 +16,9 @@ import matplotlib.pyplot as p
 import pyvista as pv
 from matplotlib.colors import ListedColormap
 
+sys.path.append('/projectnb/nphfnirs/ns/Shannon/Code/cedalion-dab-funcs2/modules')
+import module_image_recon as pfDAB_img
+
 
 flag_choose_file = 0
 
@@ -74,8 +78,7 @@ head_model = 'ICBM152'
 # with open(os.path.join(rootDir_data, 'derivatives', 'fw',  head_model, 'Adot_wParcels.pkl'), 'rb') as f:
 #     Adot = pickle.load(f)
     
-with open(probe_dir + head_model + '/Adot_wParcels.pkl', 'rb') as f:
-    Adot = pickle.load(f) 
+Adot = pfDAB_img.read_Adot(probe_dir + head_model + '/Adot_wParcels.pkl')
     
     
     
@@ -88,25 +91,8 @@ with open(probe_dir + head_model + '/Adot_wParcels.pkl', 'rb') as f:
 #% GET EXTINCTION COEFFICIENTS
 # E = nirs.get_extinction_coefficients("prahl", amp.wavelength)
 
-#% LOAD HEAD MODEL 
-if head_model == 'ICBM152':
-    SEG_DATADIR, mask_files, landmarks_file = datasets.get_icbm152_segmentation()
-elif head_model == 'colin27':
-    SEG_DATADIR, mask_files, landmarks_file = datasets.get_colin27_segmentation()()
-
-masks, t_ijk2ras = io.read_segmentation_masks(SEG_DATADIR, mask_files)
-
-head = fw.TwoSurfaceHeadModel.from_surfaces(
-    segmentation_dir=SEG_DATADIR,
-    mask_files = mask_files,
-    brain_surface_file= os.path.join(SEG_DATADIR, "mask_brain.obj"),
-    scalp_surface_file= os.path.join(SEG_DATADIR, "mask_scalp.obj"),
-    landmarks_ras_file=landmarks_file,
-    smoothing=0.5,
-    fill_holes=True,
-) 
-head.scalp.units = units.mm
-head.brain.units = units.mm
+#% LOAD HEAD MODEL (cached after the first run, see module_image_recon.get_head_model)
+head = pfDAB_img.get_head_model(head_model, with_parcels=False)
 
 
 